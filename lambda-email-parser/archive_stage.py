@@ -0,0 +1,202 @@
+"""Expansion of zip, tar and gzip attachments, run after a part has been extracted.
+
+``expand`` picks the first expander that handles the part and streams every
+member of the archive into a sink opened for it, in chunks, so members are
+never staged in /tmp or held in memory as a whole. ArchiveLimits stop archive
+bombs: too many members, members that are too large, or a total expanded
+size out of proportion to the archive. Expanders are pluggable, anything
+with ``matches(content_type, filename)`` and ``members(fileobj, filename)``
+can be added to EXPANDERS. ``sniff`` tells the archive formats apart by
+their first bytes, for attachments whose content type and name can't be
+trusted.
+"""
+import gzip
+import logging
+import posixpath
+import tarfile
+import zipfile
+import zlib
+from dataclasses import dataclass
+
+from s3_writer import BufferReader
+
+logger = logging.getLogger()
+
+# number of bytes read from an archive member at a time
+READ_SIZE = 1024 * 1024
+
+# the first bytes of the archive formats, an empty zip archive starts with its end of central directory record
+_MAGIC = ((b'\x1f\x8b', 'application/gzip'), (b'PK\x03\x04', 'application/zip'), (b'PK\x05\x06', 'application/zip'))
+
+
+class ArchiveError(ValueError):
+   """The archive is corrupt or exceeds the ArchiveLimits."""
+
+
+class ArchiveLimitExceeded(ArchiveError):
+   pass
+
+
+@dataclass(frozen=True)
+class ArchiveLimits:
+   max_members: int = 1000
+   max_member_size: int = 256 * 1024 * 1024
+   # total expanded bytes per byte of the archive
+   max_ratio: float = 100.0
+
+
+class BytesSink:
+   """Sink that keeps a member in memory, for callers that need the content itself."""
+
+   def __init__(self):
+      self.data = bytearray()
+
+   def write(self, data):
+      self.data += data
+
+   def close(self):
+      return len(self.data)
+
+
+def member_name(name):
+   """Normalise a member path so it can't reach outside the key prefix it is stored under.
+
+   :return: the relative path, or None for names that can't be stored
+   """
+   name = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+   if name in ('', '.') or name == '..' or name.startswith('../'):
+      return None
+   return name
+
+
+def _has_suffix(filename, suffixes):
+   return bool(filename) and filename.lower().endswith(suffixes)
+
+
+class TarExpander:
+   """tar archives, plain or compressed with gzip, bzip2 or xz, read as a stream."""
+   content_types = ('application/x-tar', 'application/x-gtar', 'application/x-compressed-tar')
+   suffixes = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+   def matches(self, content_type, filename):
+      return content_type in self.content_types or _has_suffix(filename, self.suffixes)
+
+   def members(self, fileobj, filename):
+      with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+         for info in tar:
+            if info.isfile():
+               yield info.name, tar.extractfile(info)
+
+
+class ZipExpander:
+   content_types = ('application/zip', 'application/x-zip', 'application/x-zip-compressed')
+   suffixes = ('.zip',)
+
+   def matches(self, content_type, filename):
+      return content_type in self.content_types or _has_suffix(filename, self.suffixes)
+
+   def members(self, fileobj, filename):
+      with zipfile.ZipFile(fileobj) as archive:
+         for info in archive.infolist():
+            if not info.is_dir():
+               with archive.open(info) as member:
+                  yield info.filename, member
+
+
+class GzipExpander:
+   """A single gzip compressed file, stored under the attachment name without ``.gz``."""
+   content_types = ('application/gzip', 'application/x-gzip')
+   suffixes = ('.gz',)
+
+   def matches(self, content_type, filename):
+      return content_type in self.content_types or _has_suffix(filename, self.suffixes)
+
+   def members(self, fileobj, filename):
+      name = filename or 'untitled'
+      if name.lower().endswith('.gz'):
+         name = name[:-3]
+      with gzip.GzipFile(fileobj=fileobj, mode='rb') as member:
+         yield name, member
+
+
+def sniff(data):
+   """The content type of an archive told from its first bytes, None if it isn't a gzip, zip or tar archive.
+
+   A compressed tar archive is reported as gzip, it is a gzip file.
+   """
+   head = bytes(data[:262])
+   for magic, content_type in _MAGIC:
+      if head.startswith(magic):
+         return content_type
+   if head[257:262] == b'ustar':
+      return 'application/x-tar'
+   return None
+
+
+# tar first, so .tar.gz attachments aren't treated as a single gzip file
+EXPANDERS = [TarExpander(), ZipExpander(), GzipExpander()]
+
+
+def expander_for(content_type, filename, expanders=None):
+   for expander in EXPANDERS if expanders is None else expanders:
+      if expander.matches(content_type, filename):
+         return expander
+   return None
+
+
+def expand(archive, content_type, filename, open_sink, limits=ArchiveLimits(), expanders=None):
+   """Expand an archive attachment into one sink per member.
+
+   Members that were completely written before a limit was exceeded are
+   kept, the member being written is aborted.
+
+   :param archive: the attachment content, a bytes-like object
+   :param content_type: content type of the attachment
+   :param filename: file name of the attachment
+   :param open_sink: called with the normalised member name, returns a sink (write/close, optionally abort)
+   :param limits: ArchiveLimits
+   :param expanders: expanders to choose from, EXPANDERS by default
+   :return: list of (member name, size), or None if no expander handles the attachment
+   :raises ArchiveError: if the archive is corrupt or exceeds the limits
+   """
+   expander = expander_for(content_type, filename, expanders)
+   if expander is None:
+      return None
+   source = filename or content_type
+   max_total = limits.max_ratio * max(len(archive), 1)
+   total = 0
+   expanded = []
+   try:
+      for name, reader in expander.members(BufferReader(archive), filename):
+         name = member_name(name)
+         if name is None:
+            logger.warning(f"Skipping archive member with an unusable name in {source}")
+            continue
+         if len(expanded) >= limits.max_members:
+            raise ArchiveLimitExceeded(f"{source} has more than {limits.max_members} members")
+         sink = open_sink(name)
+         size = 0
+         try:
+            while True:
+               chunk = reader.read(READ_SIZE)
+               if not chunk:
+                  break
+               size += len(chunk)
+               total += len(chunk)
+               if size > limits.max_member_size:
+                  raise ArchiveLimitExceeded(f"{name} in {source} is larger than {limits.max_member_size} bytes")
+               if total > max_total:
+                  raise ArchiveLimitExceeded(f"{source} expands to more than {limits.max_ratio:g} times its size")
+               sink.write(chunk)
+         except BaseException:
+            abort = getattr(sink, 'abort', None)
+            if abort:
+               abort()
+            raise
+         sink.close()
+         expanded.append((name, size))
+   except (tarfile.TarError, zipfile.BadZipFile, zipfile.LargeZipFile, zlib.error, EOFError, gzip.BadGzipFile,
+           NotImplementedError, RuntimeError) as e:
+      # RuntimeError and NotImplementedError: encrypted zip members, unsupported compression methods
+      raise ArchiveError(f"Can't expand {source}: {e}") from e
+   return expanded
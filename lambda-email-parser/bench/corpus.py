@@ -0,0 +1,122 @@
+"""Generate synthetic .eml corpora for the email parser benchmarks.
+
+Each profile stresses a different part of the parser:
+
+- ``nested``: multipart/mixed around multipart/related around multipart/alternative,
+  with an inline logo and a couple of small attachments
+- ``forwarded``: a short note with one or two message/rfc822 attachments that
+  have their own attachments
+- ``large``: one large base64 attachment (``--attachment-mib``)
+- ``inline_images``: an HTML body referencing many small inline images
+
+Messages are deterministic for a given seed so runs can be compared.
+
+Usage: python bench/corpus.py --profile nested --count 100 --output corpus/
+"""
+import argparse
+import os
+import random
+from email.message import EmailMessage
+from email.policy import SMTP
+
+PROFILES = ('nested', 'forwarded', 'large', 'inline_images')
+
+WORDS = ('invoice', 'quarterly', 'report', 'meeting', 'deadline', 'shipment', 'review', 'budget', 'customer',
+         'update', 'schedule', 'contract', 'approval', 'status', 'summary', 'delivery', 'agenda', 'forecast')
+
+
+def _text(rng, words):
+   return ' '.join(rng.choice(WORDS) for _ in range(words)) + '\n'
+
+
+def _html(text, images=()):
+   tags = ''.join(f'<img src="cid:{cid}">' for cid in images)
+   return f'<html><body><p>{text}</p>{tags}</body></html>\n'
+
+
+def _blob(rng, size):
+   return rng.randbytes(size)
+
+
+def _message(rng, n, subject=None):
+   msg = EmailMessage()
+   msg['From'] = f'sender{n}@example.com'
+   msg['To'] = 'recipient@example.com'
+   msg['Subject'] = subject or _text(rng, 5).strip()
+   msg['Message-ID'] = f'<bench-{n}-{rng.getrandbits(32)}@example.com>'
+   return msg
+
+
+def nested(rng, n, **_):
+   msg = _message(rng, n)
+   text = _text(rng, 200)
+   msg.set_content(text)
+   msg.add_alternative(_html(text, ['logo']), subtype='html')
+   msg.get_payload()[1].add_related(_blob(rng, 4096), 'image', 'png', cid='<logo>')
+   for i in range(2):
+      msg.add_attachment(_blob(rng, rng.randint(2048, 65536)), 'application', 'octet-stream', filename=f'data{i}.bin')
+   msg.add_attachment(_text(rng, 400), filename='notes.txt')
+   return msg
+
+
+def forwarded(rng, n, **kwargs):
+   msg = _message(rng, n)
+   msg.set_content(_text(rng, 40))
+   for i in range(rng.randint(1, 2)):
+      msg.add_attachment(nested(rng, n * 10 + i), filename=f'forwarded{i}.eml')
+   return msg
+
+
+def large(rng, n, attachment_mib=8, **_):
+   msg = _message(rng, n)
+   msg.set_content(_text(rng, 60))
+   msg.add_attachment(_blob(rng, int(attachment_mib * 1024 * 1024)), 'application', 'pdf', filename='scan.pdf')
+   return msg
+
+
+def inline_images(rng, n, images=40, **_):
+   msg = _message(rng, n)
+   cids = [f'img{i}' for i in range(images)]
+   text = _text(rng, 80)
+   msg.set_content(text)
+   msg.add_alternative(_html(text, cids), subtype='html')
+   html = msg.get_payload()[1]
+   for cid in cids:
+      html.add_related(_blob(rng, rng.randint(512, 6144)), 'image', 'gif', cid=f'<{cid}>')
+   return msg
+
+
+def generate(profile, count, seed=0, **options):
+   """Generate ``count`` messages of a profile.
+
+   :param profile: one of PROFILES
+   :param count: number of messages
+   :param seed: random seed
+   :return: list of raw messages as bytes with CRLF line endings
+   """
+   if profile not in PROFILES:
+      raise ValueError(f"profile must be one of {', '.join(PROFILES)}, not {profile}")
+   build = globals()[profile]
+   rng = random.Random(f'{profile}-{seed}')
+   return [build(rng, n, **options).as_bytes(policy=SMTP) for n in range(count)]
+
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+   parser.add_argument('--profile', choices=PROFILES, default='nested')
+   parser.add_argument('--count', type=int, default=100)
+   parser.add_argument('--seed', type=int, default=0)
+   parser.add_argument('--attachment-mib', type=float, default=8, help='attachment size of the large profile')
+   parser.add_argument('--output', required=True, help='directory the .eml files are written to')
+   args = parser.parse_args()
+
+   os.makedirs(args.output, exist_ok=True)
+   messages = generate(args.profile, args.count, args.seed, attachment_mib=args.attachment_mib)
+   for n, raw in enumerate(messages):
+      with open(os.path.join(args.output, f'{args.profile}-{n:05d}.eml'), 'wb') as f:
+         f.write(raw)
+   print(f"Wrote {len(messages)} messages ({sum(map(len, messages))} bytes) to {args.output}")
+
+
+if __name__ == '__main__':
+   main()
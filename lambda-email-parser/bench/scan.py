@@ -0,0 +1,104 @@
+"""Compare the scan_mode part scanner with the msg.walk() path on a synthetic corpus.
+
+Only the parsing and decoding are measured, no uploads:
+
+- ``walk``: ``email.message_from_bytes`` and ``get_payload(decode=True)`` of every part
+- ``scan``: ``mime_stream.scan_parts`` and ``decode_body`` of every leaf part
+- ``scan_filtered``: ``scan_parts``, decoding only the parts that pass the
+  part filter (``--content-types`` and ``--dispositions``)
+
+Each path runs ``--rounds`` times over the whole corpus and the fastest round
+is reported, as ms/message, MiB/sec and speedup over ``walk``.
+
+Usage: python bench/scan.py [--count 200] [--profiles nested,large] [--output scan.json]
+"""
+import argparse
+import email
+import json
+import os
+import platform
+import sys
+import time
+
+PARSER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def walk(raw, part_filter):
+   for part in email.message_from_bytes(raw).walk():
+      part.get_payload(decode=True)
+
+
+def scan(raw, part_filter):
+   import mime_stream
+   for part in mime_stream.scan_parts(raw):
+      if not part.is_multipart():
+         mime_stream.decode_body(raw, part)
+
+
+def scan_filtered(raw, part_filter):
+   import mime_stream
+   for part in mime_stream.scan_parts(raw):
+      if not part.is_multipart() and part_filter.accepts(part.get_content_type(), part.get_content_disposition()):
+         mime_stream.decode_body(raw, part)
+
+
+PATHS = {'walk': walk, 'scan': scan, 'scan_filtered': scan_filtered}
+
+
+def measure(path, messages, part_filter, rounds):
+   best = None
+   for _ in range(rounds):
+      start = time.perf_counter()
+      for raw in messages:
+         path(raw, part_filter)
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+   return best
+
+
+def main():
+   from bench.corpus import PROFILES, generate
+   from parser_config import PartFilter
+
+   parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+   parser.add_argument('--count', type=int, default=200, help='messages per profile')
+   parser.add_argument('--seed', type=int, default=0)
+   parser.add_argument('--rounds', type=int, default=3)
+   parser.add_argument('--profiles', default=','.join(PROFILES), help='comma separated corpus profiles')
+   parser.add_argument('--attachment-mib', type=float, default=8, help='attachment size of the large profile')
+   parser.add_argument('--content-types', default='application/*, image/*', help='store_content_types of scan_filtered')
+   parser.add_argument('--dispositions', default='attachment', help='store_dispositions of scan_filtered')
+   parser.add_argument('--output', help='write the results to this JSON file')
+   args = parser.parse_args()
+
+   part_filter = PartFilter(args.content_types, args.dispositions)
+   results = {
+      'python': sys.version.split()[0],
+      'platform': platform.platform(),
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+      'filter': {'content_types': args.content_types, 'dispositions': args.dispositions},
+      'profiles': [],
+   }
+   for profile in args.profiles.split(','):
+      messages = generate(profile, args.count, args.seed, attachment_mib=args.attachment_mib)
+      corpus_bytes = sum(map(len, messages))
+      seconds = {name: measure(path, messages, part_filter, args.rounds) for name, path in PATHS.items()}
+      results['profiles'].append({
+         'profile': profile,
+         'messages': args.count,
+         'mean_message_bytes': corpus_bytes // args.count,
+         'paths': {name: {
+            'ms_per_message': round(elapsed / args.count * 1000, 3),
+            'mib_per_sec': round(corpus_bytes / elapsed / (1024 * 1024), 2),
+            'speedup': round(seconds['walk'] / elapsed, 2),
+         } for name, elapsed in seconds.items()},
+      })
+   print(json.dumps(results, indent=2))
+   if args.output:
+      with open(args.output, 'w') as f:
+         json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+   sys.path.insert(0, PARSER_DIR)
+   main()
@@ -0,0 +1,105 @@
+"""Measure cold-start and per-invocation overhead of the email parser Lambda functions.
+
+Each cold start runs in a fresh interpreter and times importing the handler
+module, building the configuration and creating each service client, so the
+cost of the lazily created WorkMail client is visible separately. The warm
+numbers time a handler invocation that has no records to process.
+
+Usage: python bench/startup.py [--runs 10] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PARSER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COLD_START = '''
+import json, time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+import parser_config
+parser_config.get_config()
+configured = time.perf_counter()
+parser_config.s3_client()
+s3_ready = time.perf_counter()
+parser_config.workmail_client()
+workmail_ready = time.perf_counter()
+print(json.dumps({{
+   'import_ms': (imported - start) * 1000,
+   'config_ms': (configured - imported) * 1000,
+   's3_client_ms': (s3_ready - configured) * 1000,
+   'workmail_client_ms': (workmail_ready - s3_ready) * 1000,
+}}))
+'''
+
+
+def bench_env():
+   env = dict(os.environ)
+   env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+   env.setdefault('destination_bucket', 'bench-destination')
+   return env
+
+
+def cold_start(module, runs):
+   samples = []
+   for _ in range(runs):
+      output = subprocess.run([sys.executable, '-c', COLD_START.format(module=module)], cwd=PARSER_DIR,
+                              env=bench_env(), check=True, capture_output=True, text=True).stdout
+      samples.append(json.loads(output.strip().splitlines()[-1]))
+   return {name: round(statistics.median(sample[name] for sample in samples), 3) for name in samples[0]}
+
+
+def warm_invocation(runs):
+   os.environ.update({key: value for key, value in bench_env().items() if key not in os.environ})
+   sys.path.insert(0, PARSER_DIR)
+   import lambda_function
+   import parser_config
+
+   parser_config.get_config()
+   start = time.perf_counter()
+   for _ in range(runs):
+      parser_config.get_config()
+   config_us = (time.perf_counter() - start) / runs * 1e6
+
+   start = time.perf_counter()
+   for _ in range(runs):
+      parser_config.ParserConfig.from_environ()
+   from_environ_us = (time.perf_counter() - start) / runs * 1e6
+
+   lambda_function.lambda_handler({'Records': []}, None)
+   start = time.perf_counter()
+   for _ in range(runs):
+      lambda_function.lambda_handler({'Records': []}, None)
+   handler_us = (time.perf_counter() - start) / runs * 1e6
+   return {
+      'cached_config_us': round(config_us, 3),
+      'config_from_environ_us': round(from_environ_us, 3),
+      'empty_invocation_us': round(handler_us, 3),
+   }
+
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+   parser.add_argument('--runs', type=int, default=10, help='cold starts per module')
+   parser.add_argument('--warm-runs', type=int, default=1000, help='warm invocations to average')
+   parser.add_argument('--output', help='write the results to this JSON file')
+   args = parser.parse_args()
+
+   results = {
+      'python': sys.version.split()[0],
+      'cold_start': {module: cold_start(module, args.runs) for module in ('lambda_function', 'lambda_function_dmarc')},
+      'warm': warm_invocation(args.warm_runs),
+   }
+   print(json.dumps(results, indent=2))
+   if args.output:
+      with open(args.output, 'w') as f:
+         json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,134 @@
+"""Measure the throughput and memory of lambda_handler on a synthetic corpus.
+
+Every scenario (corpus profile and parser mode) runs in a fresh interpreter so
+its peak RSS isn't inflated by the previous one. The handler is invoked once
+per message with an S3 event, against an in-process S3 stand-in
+(tests/unit/s3_stub.py) so the numbers measure the parser and not the network.
+Objects written by a message are dropped after it is processed.
+
+Reported per scenario: messages/sec, p50/p99 latency, peak RSS, and the
+number of S3 requests per message by operation.
+
+Usage: python bench/throughput.py [--count 50] [--profiles nested,large] [--output throughput.json]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from collections import Counter
+
+PARSER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_BUCKET = 'bench-source'
+DESTINATION_BUCKET = 'bench-destination'
+
+# parser settings of each mode, on top of the environment the benchmark runs in
+MODES = {
+   'in_memory': {},
+   'streaming': {'streaming_mode': 'true'},
+   'scan': {'scan_mode': 'true'},
+}
+
+
+def percentile(samples, fraction):
+   ordered = sorted(samples)
+   return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def peak_rss_mib():
+   peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   # kilobytes on Linux, bytes on macOS
+   return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_scenario(profile, mode, count, seed, attachment_mib):
+   """Run one scenario in this interpreter, see --scenario."""
+   sys.path.insert(0, PARSER_DIR)
+   os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+   os.environ['destination_bucket'] = DESTINATION_BUCKET
+   os.environ.update(MODES[mode])
+
+   from bench import corpus
+   import lambda_function
+   from tests.unit.s3_stub import StubS3Client
+
+   s3 = StubS3Client()
+   lambda_function.s3_client = lambda: s3
+   messages = corpus.generate(profile, count, seed, attachment_mib=attachment_mib)
+   corpus_bytes = sum(map(len, messages))
+   baseline_rss = peak_rss_mib()
+
+   latencies = []
+   requests = Counter()
+   for n, raw in enumerate(messages):
+      key = f'{profile}/{n}'
+      s3.objects[(SOURCE_BUCKET, key)] = raw
+      s3.calls.clear()
+      event = {'Records': [{'s3': {'bucket': {'name': SOURCE_BUCKET}, 'object': {'key': key}}}]}
+      start = time.perf_counter()
+      lambda_function.lambda_handler(event, None)
+      latencies.append(time.perf_counter() - start)
+      requests.update(call for call, _ in s3.calls if call != 'get_object')
+      # keep the stand-in from holding every stored part
+      s3.objects.clear()
+      s3.metadata.clear()
+
+   total = sum(latencies)
+   return {
+      'profile': profile,
+      'mode': mode,
+      'messages': count,
+      'mean_message_bytes': corpus_bytes // count,
+      'messages_per_sec': round(count / total, 2),
+      'mib_per_sec': round(corpus_bytes / total / (1024 * 1024), 2),
+      'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+      'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+      # the corpus itself is held in memory, the baseline is the peak before the first message
+      'baseline_rss_mib': baseline_rss,
+      'peak_rss_mib': peak_rss_mib(),
+      's3_requests_per_message': {call: round(n / count, 2) for call, n in sorted(requests.items())},
+   }
+
+
+def scenario(profile, mode, args):
+   command = [sys.executable, os.path.abspath(__file__), '--scenario', profile, mode, '--count', str(args.count),
+              '--seed', str(args.seed), '--attachment-mib', str(args.attachment_mib)]
+   output = subprocess.run(command, cwd=PARSER_DIR, check=True, capture_output=True, text=True).stdout
+   return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+   from bench.corpus import PROFILES
+
+   parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+   parser.add_argument('--count', type=int, default=50, help='messages per scenario')
+   parser.add_argument('--seed', type=int, default=0)
+   parser.add_argument('--profiles', default=','.join(PROFILES), help='comma separated corpus profiles')
+   parser.add_argument('--modes', default=','.join(MODES), help='comma separated parser modes')
+   parser.add_argument('--attachment-mib', type=float, default=8, help='attachment size of the large profile')
+   parser.add_argument('--output', help='write the results to this JSON file')
+   parser.add_argument('--scenario', nargs=2, metavar=('PROFILE', 'MODE'), help=argparse.SUPPRESS)
+   args = parser.parse_args()
+
+   if args.scenario:
+      print(json.dumps(run_scenario(*args.scenario, args.count, args.seed, args.attachment_mib)))
+      return
+
+   results = {
+      'python': sys.version.split()[0],
+      'platform': platform.platform(),
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+      'scenarios': [scenario(profile, mode, args) for profile in args.profiles.split(',') for mode in args.modes.split(',')],
+   }
+   print(json.dumps(results, indent=2))
+   if args.output:
+      with open(args.output, 'w') as f:
+         json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+   sys.path.insert(0, PARSER_DIR)
+   main()
@@ -0,0 +1,103 @@
+"""Compare xmltodict.parse_fast with xmltodict.parse on DMARC aggregate reports.
+
+Only the XML to dict conversion of the ``dmarc_output=json`` path is
+measured. The reports are read from ``--reports``, a directory of aggregate
+reports as they are received (``.xml``, ``.xml.gz`` or ``.zip``, told apart
+by their first bytes), or generated with ``--records`` records each. Both
+parsers must return the same document for every report.
+
+Each parser runs ``--rounds`` times over all reports and the fastest round is
+reported, as ms/report, MiB/sec, records/sec and the speedup over ``parse``.
+
+Usage: python bench/xmltodict_parse.py [--reports dmarc/] [--records 10,1000,20000] [--output xmltodict.json]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+PARSER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_reports(directory):
+   import archive_stage
+
+   reports = []
+   for name in sorted(os.listdir(directory)):
+      with open(os.path.join(directory, name), 'rb') as f:
+         content = f.read()
+      container = archive_stage.sniff(content)
+      if container in ('application/gzip', 'application/zip'):
+         sinks = []
+         archive_stage.expand(content, container, name, lambda member: sinks.append(archive_stage.BytesSink()) or sinks[-1])
+         reports += [bytes(sink.data) for sink in sinks]
+      else:
+         reports.append(content)
+   return reports
+
+
+def measure(parse, reports, rounds):
+   best = None
+   for _ in range(rounds):
+      start = time.perf_counter()
+      for report in reports:
+         parse(report)
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+   return best
+
+
+def main():
+   import xmltodict
+
+   parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+   parser.add_argument('--reports', help='directory of aggregate reports, instead of generated ones')
+   parser.add_argument('--records', default='10,1000,20000', help='comma separated records per generated report')
+   parser.add_argument('--count', type=int, default=5, help='generated reports per size')
+   parser.add_argument('--rounds', type=int, default=5)
+   parser.add_argument('--output', help='write the results to this JSON file')
+   args = parser.parse_args()
+
+   if args.reports:
+      corpora = {args.reports: read_reports(args.reports)}
+   else:
+      from tests.unit.messages import dmarc_report
+      corpora = {f'{records}_records': [dmarc_report(records, begin=1760659200 + n * 86400) for n in range(args.count)]
+                 for records in map(int, args.records.split(','))}
+
+   parsers = {'parse': xmltodict.parse, 'parse_fast': xmltodict.parse_fast}
+   results = {
+      'python': sys.version.split()[0],
+      'platform': platform.platform(),
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+      'corpora': [],
+   }
+   for corpus, reports in corpora.items():
+      for report in reports:
+         if xmltodict.parse_fast(report) != xmltodict.parse(report):
+            raise SystemExit(f"parse_fast and parse differ on a report of {corpus}")
+      corpus_bytes = sum(map(len, reports))
+      records = sum(report.count(b'<record>') for report in reports)
+      seconds = {name: measure(parse, reports, args.rounds) for name, parse in parsers.items()}
+      results['corpora'].append({
+         'corpus': corpus,
+         'reports': len(reports),
+         'mean_report_bytes': corpus_bytes // max(len(reports), 1),
+         'parsers': {name: {
+            'ms_per_report': round(elapsed / max(len(reports), 1) * 1000, 3),
+            'mib_per_sec': round(corpus_bytes / elapsed / (1024 * 1024), 2),
+            'records_per_sec': round(records / elapsed),
+            'speedup': round(seconds['parse'] / elapsed, 2),
+         } for name, elapsed in seconds.items()},
+      })
+   print(json.dumps(results, indent=2))
+   if args.output:
+      with open(args.output, 'w') as f:
+         json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+   sys.path.insert(0, PARSER_DIR)
+   main()
@@ -0,0 +1,249 @@
+"""Parquet output of the DMARC report rows, and compaction of the files.
+
+With ``dmarc_output=parquet`` the rows of ``dmarc_report`` are written with
+typed columns to one Parquet file per report, under Hive-style partitions by
+the report date (the UTC day of ``date_begin``) and the reporting
+organisation::
+
+   <dmarc_report_bucket_folder>/report_date=2026-10-17/org_name=google.com/<report_id>.parquet
+
+``org_name`` is a partition column, so it isn't repeated in the files; Athena
+rejects tables with a column of the same name as a partition key. The file is
+named after the report id, so a report that is delivered twice replaces its
+own file, as long as it hasn't been compacted yet.
+
+One small file per report makes Athena open many objects per query.
+``compact`` merges the files of a partition into files of about
+``target_size`` bytes, run by ``lambda_function_dmarc_compaction`` once the
+reports of a day are in. A compaction first writes a journal (an object whose
+name starts with ``_``, which Athena ignores) listing the files it merges,
+then the merged file, then deletes the merged files and the journal; an
+interrupted compaction is finished on the next run, so no row is ever counted
+twice.
+
+pyarrow is not in the Lambda runtime, add it with a layer (e.g. the AWS SDK
+for pandas layer) to use the Parquet output.
+"""
+import datetime
+import functools
+import hashlib
+import io
+import json
+import logging
+import posixpath
+import urllib.parse
+
+try:
+   import pyarrow
+   import pyarrow.parquet
+except ImportError:  # only needed for dmarc_output=parquet
+   pyarrow = None
+
+from object_keys import sanitise
+from s3_writer import head_object
+
+logger = logging.getLogger()
+
+# rows per row group, bounds the rows held in memory while a report is written
+ROW_GROUP_SIZE = 10000
+
+# the value Hive uses for partitions of rows without one
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+COMPACTED_PREFIX = 'compacted-'
+JOURNAL_PREFIX = '_compaction-'
+
+
+def _require_pyarrow():
+   if pyarrow is None:
+      raise RuntimeError("dmarc_output parquet needs pyarrow, e.g. from the AWS SDK for pandas Lambda layer")
+
+
+@functools.lru_cache(maxsize=None)
+def schema():
+   """The columns of the files, the fields of ``dmarc_report`` rows without the org_name partition."""
+   _require_pyarrow()
+   string = pyarrow.string()
+   timestamp = pyarrow.timestamp('s', tz='UTC')
+   return pyarrow.schema([
+      ('email', string),
+      ('report_id', string),
+      ('date_begin', timestamp),
+      ('date_end', timestamp),
+      ('policy_domain', string),
+      ('policy_adkim', string),
+      ('policy_aspf', string),
+      ('policy_p', string),
+      ('policy_sp', string),
+      ('policy_pct', pyarrow.int32()),
+      ('policy_fo', string),
+      ('source_ip', string),
+      ('count', pyarrow.int64()),
+      ('disposition', string),
+      ('dkim', string),
+      ('spf', string),
+      ('reasons', pyarrow.list_(pyarrow.struct([('type', string), ('comment', string)]))),
+      ('header_from', string),
+      ('envelope_from', string),
+      ('envelope_to', string),
+      ('dkim_results', pyarrow.list_(pyarrow.struct([('domain', string), ('selector', string), ('result', string)]))),
+      ('spf_results', pyarrow.list_(pyarrow.struct([('domain', string), ('scope', string), ('result', string)]))),
+   ])
+
+
+def _partition_value(value):
+   # Hive escapes the characters that can't be part of a path segment
+   return urllib.parse.quote(value, safe=" !$&'()+,;@~") if value else DEFAULT_PARTITION
+
+
+def partition(row):
+   """The Hive partition of a row, ``report_date=<day>/org_name=<org>``."""
+   day = None
+   if row.get('date_begin') is not None:
+      day = datetime.datetime.fromtimestamp(row['date_begin'], datetime.timezone.utc).strftime('%Y-%m-%d')
+   return f"report_date={_partition_value(day)}/org_name={_partition_value(row.get('org_name'))}"
+
+
+def object_key(folder, row, source_key):
+   """The key of the file of the report a row belongs to, source_key names reports without an id."""
+   name = sanitise(row.get('report_id') or '') or hashlib.sha256(source_key.encode('utf-8')).hexdigest()[:16]
+   return f"{folder}/{partition(row)}/{name}.parquet"
+
+
+class _SinkFile:
+   """The file interface the Parquet writer needs, on top of a sink."""
+
+   closed = False
+
+   def __init__(self, sink):
+      self._sink = sink
+      self._position = 0
+
+   def write(self, data):
+      self._sink.write(bytes(data))
+      self._position += len(data)
+      return len(data)
+
+   def tell(self):
+      return self._position
+
+   def flush(self):
+      pass
+
+   def close(self):
+      self.closed = True
+
+
+class ParquetRows:
+   """Row writer of one report's Parquet file.
+
+   The file is opened with the first row, ``open_sink(row)`` returns the
+   sink it is written to, so the partition can be taken from the report
+   metadata the rows carry. Rows are written in row groups of
+   ``row_group_size``; a report without records writes no file.
+   """
+
+   def __init__(self, open_sink, row_group_size=ROW_GROUP_SIZE):
+      _require_pyarrow()
+      self._open_sink = open_sink
+      self._row_group_size = row_group_size
+      self._rows = []
+      self._sink = None
+      self._writer = None
+
+   def write_row(self, row):
+      if self._sink is None:
+         self._sink = self._open_sink(row)
+         self._writer = pyarrow.parquet.ParquetWriter(_SinkFile(self._sink), schema(), compression='snappy')
+      self._rows.append(row)
+      if len(self._rows) >= self._row_group_size:
+         self._flush()
+
+   def _flush(self):
+      if self._rows:
+         self._writer.write_table(pyarrow.Table.from_pylist(self._rows, schema()))
+         self._rows = []
+
+   def close(self):
+      if self._writer is None:
+         return 0
+      self._flush()
+      self._writer.close()
+      return self._sink.close()
+
+   def abort(self):
+      self._rows = []
+      abort = getattr(self._sink, 'abort', None)
+      if abort:
+         abort()
+
+
+def list_objects(s3, bucket, prefix):
+   """(key, size) of every object under prefix."""
+   objects = []
+   kwargs = {'Bucket': bucket, 'Prefix': prefix}
+   while True:
+      response = s3.list_objects_v2(**kwargs)
+      objects += [(item['Key'], item['Size']) for item in response.get('Contents', [])]
+      if not response.get('IsTruncated'):
+         return objects
+      kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def _finish(s3, bucket, journal_key):
+   """Finish or roll back the compaction of a journal left behind by an interrupted run."""
+   journal = json.loads(s3.get_object(Bucket=bucket, Key=journal_key)['Body'].read())
+   if head_object(s3, bucket, journal['target']) is None:
+      # the merged file was never written, the sources are all still there
+      logger.warning(f"Rolling back the compaction of {journal['target']}")
+   else:
+      for key in journal['sources']:
+         s3.delete_object(Bucket=bucket, Key=key)
+   s3.delete_object(Bucket=bucket, Key=journal_key)
+
+
+def compact(s3, bucket, prefix, target_size=128 * 1024 * 1024):
+   """Merge the Parquet files of one partition into files of about target_size bytes.
+
+   :param prefix: the partition, ``<folder>/report_date=<day>/org_name=<org>/``
+   :return: (number of files merged, number of files written)
+   """
+   _require_pyarrow()
+   list_partition = lambda: [(key, size) for key, size in list_objects(s3, bucket, prefix) if posixpath.dirname(key) + '/' == prefix]
+   objects = list_partition()
+   journals = [key for key, _ in objects if posixpath.basename(key).startswith(JOURNAL_PREFIX)]
+   for key in journals:
+      _finish(s3, bucket, key)
+   if journals:
+      objects = list_partition()
+
+   # merge the small files, smallest first, into groups of up to target_size
+   small = sorted((size, key) for key, size in objects if key.endswith('.parquet') and size < target_size)
+   groups, group, group_size = [], [], 0
+   for size, key in small:
+      if group and group_size + size > target_size:
+         groups.append(group)
+         group, group_size = [], 0
+      group.append(key)
+      group_size += size
+   groups.append(group)
+
+   merged = written = 0
+   for group in groups:
+      if len(group) < 2:
+         continue
+      target = prefix + COMPACTED_PREFIX + hashlib.sha256('\n'.join(group).encode('utf-8')).hexdigest()[:16] + '.parquet'
+      journal_key = prefix + JOURNAL_PREFIX + posixpath.basename(target)[:-len('.parquet')] + '.json'
+      s3.put_object(Bucket=bucket, Key=journal_key, Body=json.dumps({'target': target, 'sources': group}))
+      tables = [pyarrow.parquet.read_table(pyarrow.BufferReader(s3.get_object(Bucket=bucket, Key=key)['Body'].read()))
+                for key in group]
+      output = io.BytesIO()
+      pyarrow.parquet.write_table(pyarrow.concat_tables(tables), output, compression='snappy')
+      s3.put_object(Bucket=bucket, Key=target, Body=output.getvalue())
+      for key in group:
+         s3.delete_object(Bucket=bucket, Key=key)
+      s3.delete_object(Bucket=bucket, Key=journal_key)
+      logger.info(f"Compacted {len(group)} files into s3://{bucket}/{target}")
+      merged += len(group)
+      written += 1
+   return merged, written
@@ -0,0 +1,225 @@
+"""Streaming conversion of DMARC aggregate reports (RFC 7489) to flat rows.
+
+ReportRows is a sink: the XML report is written to it in chunks, it is
+parsed incrementally with ``ElementTree.XMLPullParser`` and every
+``<record>`` becomes one row, handed to a row writer as soon as the record is
+read: JsonLines writes it as a JSON line, ``dmarc_parquet.ParquetRows`` to a
+Parquet file. Each record is dropped once it is converted, so
+memory stays constant however many records a report has. The
+``report_metadata`` and ``policy_published`` elements, which come before the
+records, are denormalised into every row:
+
+- report: ``org_name``, ``email``, ``report_id``, ``date_begin``, ``date_end``
+- policy: ``policy_domain``, ``policy_adkim``, ``policy_aspf``, ``policy_p``,
+  ``policy_sp``, ``policy_pct``, ``policy_fo``
+- record: ``source_ip``, ``count``, ``disposition``, ``dkim``, ``spf`` (the
+  evaluated policy), ``reasons`` (list of ``type``/``comment``),
+  ``header_from``, ``envelope_from``, ``envelope_to``, ``dkim_results``
+  (list of ``domain``/``selector``/``result``) and ``spf_results`` (list of
+  ``domain``/``scope``/``result``)
+
+The dates are Unix timestamps and ``count`` and ``policy_pct`` integers;
+missing elements are null. Element names are matched without their
+namespace, so DMARCbis reports are read the same way.
+"""
+import codecs
+import json
+import re
+from xml.etree import ElementTree
+
+# bytes handed to the XML parser at a time, the elements of one chunk are built before they are dropped
+FEED_SIZE = 64 * 1024
+
+
+# a report starts with the XML declaration, a comment or its feedback element, after an optional byte order mark
+_REPORT_START = re.compile(r'\s*<(\?xml|!--|([\w.-]+:)?feedback[\s/>])')
+
+
+def is_xml(data):
+   """Whether data starts like an XML report, for parts whose content type can't be trusted."""
+   head = bytes(data[:512])
+   if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+      head = head.decode('utf-16', 'ignore')
+   else:
+      head = head.removeprefix(codecs.BOM_UTF8).decode('latin-1')
+   return _REPORT_START.match(head) is not None
+
+
+class ReportError(ValueError):
+   """The report is not well-formed XML."""
+
+
+def _local(tag):
+   return tag.rpartition('}')[2]
+
+
+def _to_dict(element):
+   children = list(element)
+   if not children:
+      return (element.text or '').strip() or None
+   item = {}
+   for child in children:
+      key = _local(child.tag)
+      value = _to_dict(child)
+      if key not in item:
+         item[key] = value
+      elif isinstance(item[key], list):
+         item[key].append(value)
+      else:
+         item[key] = [item[key], value]
+   return item
+
+
+def _items(value):
+   """The dict elements of a repeatable element."""
+   values = value if isinstance(value, list) else [value]
+   return [v for v in values if isinstance(v, dict)]
+
+
+def _integer(value):
+   try:
+      return int(value)
+   except (TypeError, ValueError):
+      return None
+
+
+def _get(item, name):
+   return item.get(name) if isinstance(item, dict) else None
+
+
+def report_fields(metadata):
+   date_range = _get(metadata, 'date_range')
+   return {
+      'org_name': _get(metadata, 'org_name'),
+      'email': _get(metadata, 'email'),
+      'report_id': _get(metadata, 'report_id'),
+      'date_begin': _integer(_get(date_range, 'begin')),
+      'date_end': _integer(_get(date_range, 'end')),
+   }
+
+
+def policy_fields(policy):
+   return {
+      'policy_domain': _get(policy, 'domain'),
+      'policy_adkim': _get(policy, 'adkim'),
+      'policy_aspf': _get(policy, 'aspf'),
+      'policy_p': _get(policy, 'p'),
+      'policy_sp': _get(policy, 'sp'),
+      'policy_pct': _integer(_get(policy, 'pct')),
+      'policy_fo': _get(policy, 'fo'),
+   }
+
+
+def record_row(record, report, policy):
+   """The row of one record, report and policy are the fields of the report and the published policy."""
+   source = _get(record, 'row')
+   evaluated = _get(source, 'policy_evaluated')
+   identifiers = _get(record, 'identifiers')
+   auth = _get(record, 'auth_results')
+   row = dict(report)
+   row.update(policy)
+   row.update(
+      source_ip=_get(source, 'source_ip'),
+      count=_integer(_get(source, 'count')),
+      disposition=_get(evaluated, 'disposition'),
+      dkim=_get(evaluated, 'dkim'),
+      spf=_get(evaluated, 'spf'),
+      reasons=[{'type': r.get('type'), 'comment': r.get('comment')} for r in _items(_get(evaluated, 'reason'))],
+      header_from=_get(identifiers, 'header_from'),
+      envelope_from=_get(identifiers, 'envelope_from'),
+      envelope_to=_get(identifiers, 'envelope_to'),
+      dkim_results=[{'domain': r.get('domain'), 'selector': r.get('selector'), 'result': r.get('result')}
+                    for r in _items(_get(auth, 'dkim'))],
+      spf_results=[{'domain': r.get('domain'), 'scope': r.get('scope'), 'result': r.get('result')}
+                   for r in _items(_get(auth, 'spf'))],
+   )
+   return row
+
+
+class JsonLines:
+   """Row writer that writes every row as one JSON line to a sink."""
+
+   def __init__(self, sink):
+      self.sink = sink
+
+   def write_row(self, row):
+      self.sink.write(json.dumps(row, separators=(',', ':')).encode('utf-8') + b'\n')
+
+   def close(self):
+      return self.sink.close()
+
+   def abort(self):
+      abort = getattr(self.sink, 'abort', None)
+      if abort:
+         abort()
+
+
+class ReportRows:
+   """Sink that parses the report written to it and hands one row per record to the row writer ``rows``.
+
+   A row writer has ``write_row(row)``, ``close()`` and ``abort()``. The XML
+   is also passed on unchanged to the sink ``raw``, if given. ``close``
+   returns the number of rows, ``records`` counts them as they are written.
+   """
+
+   def __init__(self, rows, raw=None):
+      self.records = 0
+      self._rows = rows
+      self._raw = raw
+      self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+      self._root = None
+      self._depth = 0
+      self._report = report_fields(None)
+      self._policy = policy_fields(None)
+
+   def write(self, data):
+      if self._raw is not None:
+         self._raw.write(data)
+      for offset in range(0, len(data), FEED_SIZE):
+         self._parser.feed(bytes(data[offset:offset + FEED_SIZE]))
+         self._read_events()
+
+   def _events(self):
+      # the parser reports errors when its events are read
+      try:
+         yield from self._parser.read_events()
+      except ElementTree.ParseError as e:
+         raise ReportError(f"Not a DMARC report: {e}") from e
+
+   def _read_events(self):
+      for event, element in self._events():
+         if event == 'start':
+            self._depth += 1
+            if self._root is None:
+               self._root = element
+            continue
+         self._depth -= 1
+         if self._depth != 1:
+            continue
+         name = _local(element.tag)
+         if name == 'record':
+            self._rows.write_row(record_row(_to_dict(element), self._report, self._policy))
+            self.records += 1
+         elif name == 'report_metadata':
+            self._report = report_fields(_to_dict(element))
+         elif name == 'policy_published':
+            self._policy = policy_fields(_to_dict(element))
+         # the elements that have been read are no longer needed
+         self._root.clear()
+
+   def close(self):
+      try:
+         self._parser.close()
+      except ElementTree.ParseError as e:
+         raise ReportError(f"Not a DMARC report: {e}") from e
+      self._read_events()
+      if self._raw is not None:
+         self._raw.close()
+      self._rows.close()
+      return self.records
+
+   def abort(self):
+      self._rows.abort()
+      abort = getattr(self._raw, 'abort', None)
+      if abort:
+         abort()
@@ -0,0 +1,146 @@
+"""Fan-out of the large parts of a message to worker invocations.
+
+With fan_out_mode the function that receives an S3 message is the
+coordinator: it reads the message once, stores the small parts itself, and
+only records the byte range of every part whose encoded body is larger than
+fan_out_min_size, without decoding it. A task per large part is then sent to
+the workers, through SQS or as an asynchronous Lambda invocation, and each
+worker decodes and stores its part from a ranged GET of the source object.
+The workers are the same function, ``lambda_handler`` recognises the tasks.
+
+A FanOut sends its tasks with a dispatcher, anything with a ``send(tasks)``
+method; DISPATCHERS are the ones fan_out_mode selects from.
+"""
+import json
+import logging
+
+logger = logging.getLogger()
+
+# key of a task in an SQS message body or a direct invocation event
+TASK = 'fanOutPart'
+
+# SendMessageBatch takes at most 10 messages
+SQS_BATCH_SIZE = 10
+
+
+class RangeSink:
+   """Holds back the encoded body of a part until it is known to be small.
+
+   Wraps the decoding sink of a part. Up to ``threshold`` encoded bytes are
+   buffered; a part that stays within is decoded and written as usual when it
+   is closed. A larger one is dropped: the sink behind it is aborted,
+   ``on_large()`` is called, and the rest of the body is skipped, so the
+   coordinator never decodes or uploads it.
+   """
+
+   def __init__(self, sink, threshold, on_large):
+      self.large = False
+      self._sink = sink
+      self._threshold = threshold
+      self._on_large = on_large
+      self._buffer = bytearray()
+
+   def write(self, data):
+      if self.large:
+         return
+      self._buffer += data
+      if len(self._buffer) > self._threshold:
+         self.large = True
+         self._buffer = bytearray()
+         self._sink.abort()
+         self._on_large()
+
+   def close(self):
+      if self.large:
+         return 0
+      if self._buffer:
+         self._sink.write(bytes(self._buffer))
+         self._buffer = bytearray()
+      return self._sink.close()
+
+   def abort(self):
+      self._buffer = bytearray()
+      if not self.large:
+         self._sink.abort()
+
+
+class FanOut:
+   """The fan-out of one message stored in S3."""
+
+   def __init__(self, dispatcher, source_bucket, source_key, etag, min_size):
+      self.dispatcher = dispatcher
+      self.source = {'bucket': source_bucket, 'key': source_key, 'etag': etag}
+      self.min_size = min_size
+
+   def range_sink(self, sink, on_large):
+      return RangeSink(sink, self.min_size, on_large)
+
+   def task(self, part, destination_bucket, key):
+      """The task that stores a part found by the coordinator, once its byte range is known."""
+      return {TASK: {
+         'source': self.source,
+         'range': [part.body_offset, part.end],
+         'destination': {'bucket': destination_bucket, 'key': key},
+         'index': part.index,
+         'contentType': part.get_content_type(),
+         'contentDisposition': part.get_content_disposition(),
+         'filename': part.get_filename(),
+         'contentTransferEncoding': part.get('content-transfer-encoding'),
+         'charset': part.get_content_charset(),
+      }}
+
+   def send(self, tasks):
+      if tasks:
+         logger.info(f"Fanning out {len(tasks)} parts of s3://{self.source['bucket']}/{self.source['key']}")
+         self.dispatcher.send(tasks)
+
+
+class SqsDispatcher:
+   """Sends the tasks to an SQS queue the function is subscribed to."""
+
+   def __init__(self, sqs, queue_url):
+      if not queue_url:
+         raise ValueError("fan_out_mode sqs needs fan_out_queue_url")
+      self._sqs = sqs
+      self._queue_url = queue_url
+
+   def send(self, tasks):
+      for start in range(0, len(tasks), SQS_BATCH_SIZE):
+         entries = [{'Id': str(n), 'MessageBody': json.dumps(task, separators=(',', ':'))}
+                    for n, task in enumerate(tasks[start:start + SQS_BATCH_SIZE])]
+         failed = self._sqs.send_message_batch(QueueUrl=self._queue_url, Entries=entries).get('Failed', [])
+         if failed:
+            raise RuntimeError(f"Failed to send {len(failed)} fan-out tasks to {self._queue_url}: {failed[0].get('Message')}")
+
+
+class InvokeDispatcher:
+   """Invokes a function asynchronously once per task."""
+
+   def __init__(self, lambda_client, function_name):
+      if not function_name:
+         raise ValueError("fan_out_mode invoke needs fan_out_function")
+      self._lambda = lambda_client
+      self._function_name = function_name
+
+   def send(self, tasks):
+      for task in tasks:
+         self._lambda.invoke(FunctionName=self._function_name, InvocationType='Event',
+                             Payload=json.dumps(task, separators=(',', ':')).encode('utf-8'))
+
+
+DISPATCHERS = {
+   'sqs': SqsDispatcher,
+   'invoke': InvokeDispatcher,
+}
+
+
+def task_of(event):
+   """The fan-out task carried by a direct invocation or an SQS record, None for other events."""
+   if event.get('eventSource') == 'aws:sqs':
+      try:
+         event = json.loads(event['body'])
+      except ValueError:
+         return None
+   if not isinstance(event, dict):
+      return None
+   return event.get(TASK)
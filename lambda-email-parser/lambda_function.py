@@ -1,144 +1,555 @@
-import os
-import boto3
+import base64
+import codecs
 import email
+import hashlib
 import logging
 import json
-import re
+import time
 import uuid
-s3 = boto3.client("s3")
-workmail_message_flow = boto3.client('workmailmessageflow')
+from concurrent.futures import ThreadPoolExecutor
+import archive_stage
+import mime_stream
+import part_rules
+from object_keys import decode_filename
+from botocore.exceptions import ClientError
+from fan_out import FanOut, task_of
+from metrics import NULL_METRICS, for_message
+from parser_config import get_config, fan_out_dispatcher, metrics_sink, part_rule_set, s3_client, upload_executor, workmail_client
+from s3_writer import BufferReader, ContentAddressedUpload, S3StreamingUpload, SizeRoutedSink, StoredPart, TarBundle, UploadPool, head_object, is_not_found
 logger = logging.getLogger()
 
-def lambda_handler(event, context):
-   logger.info("Processing email event")
-   destination_bucket = os.environ.get('destination_bucket')
-   key_prefix = None
-   if not destination_bucket:
-      logger.error("Environment variable missing: destination_bucket")
-      return
-   
-   # keep track of how many MIME parts are parsed and saved to S3
+# make file name for body, and untitled text or html parts
+# add additional content types that we want to support non-existent filenames
+def default_filename(content_type, content_disposition):
+   if content_type == 'text/plain':
+      if 'attachment' not in content_disposition:
+         return "body.txt"
+      return "untitled.txt"
+   elif content_type == 'text/html':
+      if 'attachment' not in content_disposition:
+         return "body.html"
+      return "untitled.html"
+   return "untitled"
+
+# the headers that are saved, None when headers aren't saved at all
+def select_headers(all_headers):
+   header_filter = get_config().header_filter
+   if header_filter is None:
+      return None
+   return header_filter.select(all_headers)
+
+def save_headers(saved_headers, destination_bucket, key_prefix, pool):
+   if saved_headers is not None:
+      pool.put_object(s3_client(), Bucket = destination_bucket, Key = key_prefix + "/headers.json", Body = json.dumps(saved_headers))
+
+# describe a MIME part for the per-message manifest, key is None for parts that aren't stored
+def manifest_entry(part_idx, part):
+   return {
+      'index': part_idx,
+      'contentType': part.get_content_type(),
+      'charset': part.get_content_charset(),
+      'disposition': part.get_content_disposition(),
+      'filename': decode_filename(part.get_filename()),
+      'key': None,
+      'size': 0,
+      'sha256': None,
+      'storedCharset': None
+   }
+
+def stored_entry(entry, upload, stored_charset):
+   entry.update(key = upload.key, size = upload.size, sha256 = upload.digest, storedCharset = stored_charset)
+   if getattr(upload, 'blob_key', None):
+      entry['blobKey'] = upload.blob_key
+
+# one compact document per message so consumers can find everything that was extracted with a single GET
+def save_manifest(saved_headers, manifest_parts, destination_bucket, key_prefix, pool):
+   manifest = {
+      'bucket': destination_bucket,
+      'prefix': key_prefix,
+      'headers': saved_headers,
+      'parts': manifest_parts
+   }
+   pool.put_object(s3_client(), Bucket = destination_bucket, Key = key_prefix + "/manifest.json", Body = json.dumps(manifest, separators = (',', ':')), ContentType = 'application/json')
+   return pool.wait()
+
+# how text parts with a charset are stored, see charset_mode: returns the errors handler to
+# transcode them to UTF-8 with, or None to store the transfer-decoded bytes as they are
+def transcode_errors(charset):
+   charset_mode = get_config().charset_mode
+   if not charset or charset_mode == 'raw':
+      return None
+   if charset_mode == 'normalize':
+      try:
+         codecs.lookup(charset)
+      except LookupError:
+         logger.warning(f"Unknown charset {charset}, storing the part as is")
+         return None
+      return 'replace'
+   return 'strict'
+
+# the charset of the stored object, recorded in its metadata when the bytes are stored as they are
+def stored_charset(charset, errors):
+   if errors:
+      return 'utf-8'
+   return charset
+
+def charset_metadata(charset, errors):
+   if charset and not errors and charset.isascii():
+      return {'Metadata': {'charset': charset}}
+   return {}
+
+# the sink a part is written to, with dedup_parts the payload is stored once under sha256/<digest>
+# and the part key holds a pointer to it. part_size=None means the content is already in memory.
+# Parts larger than multipart_threshold are uploaded in parallel multipart_part_size parts
+def part_upload(destination_bucket, key, pool, part_size, **put_args):
+   config = get_config()
+   if config.dedup_parts:
+      return ContentAddressedUpload(s3_client(), destination_bucket, key, part_size, pool, config.dedup_min_size, **put_args)
+   return S3StreamingUpload(s3_client(), destination_bucket, key, part_size, pool, hashed = config.write_manifest,
+                            threshold = config.multipart_threshold, concurrency = config.multipart_concurrency, **put_args)
+
+# with small_part_mode=bundle the small parts of a message are packed into <prefix>/parts.tar
+def small_part_bundle(destination_bucket, key_prefix, pool):
+   if get_config().small_part_mode != 'bundle':
+      return None
+   return TarBundle(s3_client(), destination_bucket, key_prefix + "/parts.tar", pool)
+
+# store a part of at most small_part_threshold bytes in the bundle, or inline in the manifest
+def store_small_part(entry, name, content, stored_charset, bundle):
+   entry.update(size = len(content), sha256 = hashlib.sha256(content).hexdigest(), storedCharset = stored_charset)
+   if bundle is not None:
+      # the member name comes from the message, keep it from reaching outside the archive
+      member = name.replace('/', '_').replace('\\', '_')
+      bundle.add(member, content)
+      entry.update(bundle = bundle.key, member = member)
+   else:
+      entry.update(content = base64.b64encode(content).decode('ascii'), contentEncoding = 'base64')
+
+def manifest_required():
+   config = get_config()
+   return config.write_manifest or config.small_part_mode == 'manifest'
+
+# whether the forwarded messages of a message at this depth are exploded, see explode_nested
+def explodes_nested(depth):
+   config = get_config()
+   return config.explode_nested and depth < config.nested_max_depth
+
+# explode the forwarded messages found in a message under <prefix>/nested<n>/, in the same pass.
+# budget holds the bytes left of nested_max_bytes for every nested message of the original message,
+# at all depths, so deeply nested or repeated forwards can't take unbounded memory or time.
+# In streaming mode the copies of the forwarded messages took their bytes from the budget as they were buffered (charged)
+def explode_nested(nested, destination_bucket, depth, budget, progress, metrics=NULL_METRICS, charged=False):
    saved_parts = 0
-   msg = None
-   parts = None
-   workmail_mutate = None
+   failed_parts = 0
+   for entry, nested_prefix, content in nested:
+      if content is not None and not len(content):
+         # nothing was kept, part_rules excluded the forwarded message
+         continue
+      if content is None or (not charged and len(content) > budget['bytes']):
+         logger.warning(f"Not exploding {nested_prefix}, it exceeds what is left of nested_max_bytes")
+         continue
+      if not charged:
+         budget['bytes'] -= len(content)
+      entry['nested'] = nested_prefix
+      saved, failed = explode_message(BufferReader(content), destination_bucket, nested_prefix, depth = depth + 1, budget = budget,
+                                      progress = progress, metrics = metrics)
+      saved_parts += saved
+      failed_parts += failed
+   return saved_parts, failed_parts
 
-   # event is from workmail
-   if event.get('messageId'):
-      message_id = event['messageId']
-      key_prefix = message_id
-      raw_msg = workmail_message_flow.get_raw_message_content(messageId=message_id)
-      msg = email.message_from_bytes(raw_msg['messageContent'].read())
-      if os.environ.get('modify_workmail_message'):
-         workmail_mutate = True
+# with expand_archives, the members of zip, tar and gzip attachments are also stored, under <part key>/<member name>
+def expand_archive(entry, part_key, content_type, filename, content, destination_bucket, pool):
+   config = get_config()
+   if content is not None and not len(content):
+      return
+   if content is None or len(content) > config.archive_max_size:
+      logger.warning(f"Not expanding {part_key}, it is larger than archive_max_size")
+      return
+   try:
+      members = archive_stage.expand(content, content_type, filename,
+                                     lambda name: part_upload(destination_bucket, config.key_builder.member_key(part_key, name), pool,
+                                                              config.multipart_part_size),
+                                     config.archive_limits)
+   except archive_stage.ArchiveError as e:
+      logger.warning(f"Not expanding {part_key}: {e}")
+      return
+   if members is not None:
+      entry['members'] = [{'name': name, 'key': config.key_builder.member_key(part_key, name), 'size': size} for name, size in members]
+
+# whether a part is decoded and stored at all, see store_content_types, store_dispositions and part_rules.
+# None when the part_rules depend on the size of the part and size isn't known (yet)
+def stores_part(content_type, content_disposition, filename=None, size=None):
+   rules = part_rule_set()
+   if rules is None:
+      return True
+   return rules.decide(content_type, content_disposition, filename, size)
 
-   # event is from s3
+# the decoded size of a part told from its encoded body, before decoding it, the same size streaming mode
+# measures. None when it can't be told exactly (quoted-printable, uuencode), the part_rules are asked again once it is decoded
+def estimated_size(part, raw):
+   if isinstance(part, mime_stream.StreamedPart):
+      size = part.end - part.body_offset
+      count = lambda c: raw.count(c.encode('ascii'), part.body_offset, part.end)
    else:
-      records = event.get('Records', [])
-      record  = records[0]
-      # TODO: for record in records:
-      # get the S3 object information
-      s3_info = record['s3']
-      object_info = s3_info['object']
-      if s3_info['bucket']['name'] == destination_bucket:
-         logger.error("To prevent recursive file creation this function will not write back to the same bucket")
-         return {
-            'statusCode': 400,
-            'body': 'To prevent recursive file creation this function will not write back to the same bucket'
-         }
-      
-      # get the email message stored in S3 and parse it using the python email library
-      # TODO: error condition - if the file isn't an email message or doesn't parse correctly
-      fileObj, object_key = [None] * 2
-      object_key = object_info['key']
-      key_prefix = object_key
-      fileObj = s3.get_object(Bucket = s3_info['bucket']['name'], Key = object_key)
-      msg = email.message_from_bytes(fileObj['Body'].read())
-   
-   # save the headers of the message to the bucket
-   headers_to_save = None
-   # By default saving all headers, but use environment vairables to be more specific
-   if os.environ.get('select_headers','ALL'): 
-      headers_to_save = re.split(',\s*', str(os.environ.get('select_headers', 'ALL')))
-      all_headers = msg.items()
-      if "ALL" in headers_to_save:
-         s3.put_object(Bucket = destination_bucket, Key = key_prefix + "/headers.json", Body = json.dumps(all_headers))
-      elif len(headers_to_save) > 0:
-         saved_headers = []
-         i = 0
-         while i < len(all_headers):
-            this_header = all_headers[i]
-            if this_header[0].upper() in (header.upper() for header in headers_to_save):
-               saved_headers.append(this_header)
-            i += 1
-         s3.put_object(Bucket = destination_bucket, Key = key_prefix + "/headers.json", Body = json.dumps(saved_headers))
-      
-   # parse the mime parts out of the message
-   parts = msg.walk()
-   
-   # walk through each MIME part from the email message
-   part_idx = 0
-   for part in parts:
-      part_idx += 1
-      
-      # get information about the MIME part
-      content_type, content_disposition, content, charset, filename = [None] * 5
+      encoded = part.get_payload()
+      if not isinstance(encoded, str):
+         return None
+      size = len(encoded)
+      count = encoded.count
+   encoding = str(part.get('content-transfer-encoding', '')).strip().lower()
+   if encoding == 'base64':
+      # every 4 characters of base64 data are 3 bytes, line breaks and padding aren't data
+      return (size - sum(count(c) for c in ' \t\r\n=')) * 3 // 4
+   if encoding in ('', '7bit', '8bit', 'binary'):
+      return size
+   return None
+
+# in streaming mode the size of a part is only known once it is decoded: when the part_rules depend on it
+# the part is buffered up to the largest size in the rules, and dropped without any upload if it is excluded
+def size_ruled_sink(sink, stores):
+   bound = part_rule_set().size_bound
+
+   def on_small(content):
+      if stores(len(content)):
+         sink.write(content)
+         sink.close()
+
+   return SizeRoutedSink(bound, lambda: sink if stores(bound + 1) else part_rules.DISCARD, on_small)
+
+# the size of a part as it is in the message, before transfer decoding
+def encoded_size(part, content):
+   if isinstance(part, mime_stream.StreamedPart):
+      return part.end - part.body_offset
+   encoded = part.get_payload()
+   return len(encoded) if isinstance(encoded, str) else len(content)
+
+# the part of scan_parts at the walk position of a parsed part, None unless both have the same structure.
+# Comparing the content types and headers of every part within them keeps a forwarded message from being
+# stored with the bytes of another one when the two parsers number the parts differently
+def located_part(located, part_idx, part):
+   if part_idx > len(located):
+      return None
+   found = located[part_idx - 1]
+   if [(inner.get_content_type(), inner.items()) for inner in found.walk()] != [(inner.get_content_type(), inner.items()) for inner in part.walk()]:
+      return None
+   return found
+
+def expands_archive(content_type, filename):
+   return get_config().expand_archives and archive_stage.expander_for(content_type, filename) is not None
+
+def nested_budget(budget):
+   if budget is None:
+      return {'bytes': get_config().nested_max_bytes}
+   return budget
+
+# streaming alternative to email.message_from_bytes + msg.walk(): each MIME part is
+# decoded while the message is read and written straight into an S3 (multipart) upload,
+# so memory is bounded by stream_chunk_size and multipart_part_size instead of the message size.
+# With a fan_out, parts whose encoded body is larger than fan_out_min_size are left to the workers
+def stream_message_parts(body, destination_bucket, key_prefix, pool, depth=0, budget=None, progress=None, metrics=NULL_METRICS,
+                         fan_out=None):
+   config = get_config()
+   chunk_size = config.stream_chunk_size
+   part_size = config.multipart_part_size
+   budget = nested_budget(budget)
+   uploads = []
+   manifest_parts = []
+   nested = []
+   archives = []
+   saved_headers = None
+   bundle = small_part_bundle(destination_bucket, key_prefix, pool)
+   # the parts handed to the fan-out workers, and the part that may be next
+   fanned = []
+   candidate = None
+
+   def on_part(part):
+      nonlocal saved_headers, candidate
+      candidate = None
+      part_idx = part.index
+      if part_idx == 1:
+         saved_headers = select_headers(part.items())
+         save_headers(saved_headers, destination_bucket, key_prefix, pool)
+      manifest_parts.append(manifest_entry(part_idx, part))
+
       content_type = part.get_content_type()
       content_disposition = str(part.get_content_disposition())
-      content = part.get_payload(decode=True)
-      if content_type == 'message/rfc822':
-         content = part.get_payload(decode=False)[0].as_string()
       charset = part.get_content_charset()
-      filename = part.get_filename()
-      logger.error(f"Part: {part_idx}. Content charset: {charset}. Content type: {content_type}. Content disposition: {content_disposition}. Filename: {filename}");
-
-      # make file name for body, and untitled text or html parts
-      # add additional content types that we want to support non-existent filenames
-      if not filename:
-         if content_type == 'text/plain':
-            if 'attachment' not in content_disposition:
-               filename = "body.txt"
-            else:
-               filename = "untitled.txt"
-         elif content_type == 'text/html':
-            if 'attachment' not in content_disposition:
-               filename = "body.html"
-            else:
-               filename = "untitled.html"
+      filename = decode_filename(part.get_filename())
+      logger.debug(f"Part: {part_idx}. Content charset: {charset}. Content type: {content_type}. Content disposition: {content_disposition}. Filename: {filename}");
+
+      # multipart containers and message/* parts other than message/rfc822 have no content of their own
+      if content_type in ["multipart/mixed", "multipart/related", "multipart/alternative"]:
+         return None
+      if part.is_multipart() and content_type != 'message/rfc822':
+         logger.debug(f"Part {part_idx} has no content. Content type: {content_type}. Content disposition: {content_disposition}.");
+         return None
+      stored = stores_part(content_type, content_disposition, filename)
+      if stored is False:
+         logger.debug(f"Part {part_idx} is not stored. Content type: {content_type}. Content disposition: {content_disposition}.")
+         return None
+
+      # the forwarded message is stored as its raw bytes
+      errors = transcode_errors(charset) if content_type != 'message/rfc822' else None
+      entry = manifest_parts[-1]
+      name = config.key_builder.part_name(key_prefix, part_idx, filename or default_filename(content_type, content_disposition))
+      part_charset = stored_charset(charset, errors)
+      if already_stored(key_prefix + "/" + name, progress):
+         upload = StoredPart(key_prefix + "/" + name, config.write_manifest)
+      else:
+         upload = part_upload(destination_bucket, key_prefix + "/" + name, pool, part_size, **charset_metadata(charset, errors))
+      uploads.append((part, upload, entry, part_charset))
+      metrics.describe(key_prefix + "/" + name, contentType = content_type)
+      sink = upload
+      if config.small_part_mode:
+         # the upload is only started once the part outgrows small_part_threshold
+         sink = SizeRoutedSink(config.small_part_threshold, lambda: upload,
+                               lambda content: store_small_part(entry, name, content, part_charset, bundle))
+      sink = metrics.upload_sink(sink, key_prefix + "/" + name)
+      if errors:
+         sink = mime_stream.TranscodingSink(sink, charset, errors)
+      else:
+         if expands_archive(content_type, filename):
+            # keep a copy of the archive to expand once the message is parsed
+            sink = mime_stream.TeeSink(sink, config.archive_max_size)
+            archives.append((entry, key_prefix + "/" + name, content_type, filename, sink))
+         # forwarded messages within a forwarded message are exploded with it, at the next depth
+         if content_type == 'message/rfc822' and explodes_nested(depth) and all(outer.end is not None for outer, _ in nested):
+            # keep a copy of the forwarded message to explode once this one is done. The copies of all
+            # forwarded messages share the budget, so together they never hold more than nested_max_bytes
+            sink = mime_stream.TeeSink(sink, config.nested_max_bytes, budget)
+            nested.append((part, (entry, key_prefix + "/nested" + str(len(nested) + 1), sink)))
+      if stored is None:
+         sink = size_ruled_sink(sink, lambda size: stores_part(content_type, content_disposition, filename, size))
+      if fan_out is not None and not already_stored(key_prefix + "/" + name, progress):
+         candidate = (part, entry, key_prefix + "/" + name)
+      return sink
+
+   def fan_out_sink(sink, decoder):
+      decoding = (metrics.decoding_sink or mime_stream.DecodingSink)(sink, decoder)
+      if candidate is None:
+         return decoding
+      found = candidate
+      return fan_out.range_sink(decoding, lambda: fanned.append(found))
+
+   try:
+      with metrics.parse_timer():
+         mime_stream.MimeStreamParser(on_part, chunk_size, fan_out_sink if fan_out is not None else metrics.decoding_sink).parse(
+            mime_stream.iter_chunks(body, chunk_size))
+      # the byte ranges are known once the message is parsed
+      if fanned:
+         fan_out.send([fan_out.task(part, destination_bucket, key) for part, _, key in fanned])
+   except BaseException:
+      if bundle is not None:
+         bundle.abort()
+      raise
+   if bundle is not None:
+      bundle.close()
+   for _, entry, key in fanned:
+      entry.update(key = key, fanOut = True)
+   for entry, part_key, content_type, filename, tee in archives:
+      expand_archive(entry, part_key, content_type, filename, tee.data, destination_bucket, pool)
+   failed = pool.wait()
+
+   saved_parts = 0
+   for part, upload, entry, charset in uploads:
+      if entry.get('fanOut'):
+         # counted once handed to a worker, the worker stores it
+         saved_parts += 1
+      elif 'content' in entry or 'bundle' in entry:
+         if entry.get('bundle') not in failed:
+            saved_parts += 1
+      elif not upload.size:
+         logger.debug(f"Part {part.index} has no content. Content type: {part.get_content_type()}. Content disposition: {part.get_content_disposition()}.");
+      elif upload.key not in failed:
+         stored_entry(entry, upload, charset)
+         saved_parts += 1
+         if progress is not None:
+            progress.add(upload.key)
+   failed_parts = len(failed)
+   if nested:
+      nested_saved, nested_failed = explode_nested([(entry, nested_prefix, tee.data) for _, (entry, nested_prefix, tee) in nested],
+                                                   destination_bucket, depth, budget, progress, metrics, charged = True)
+      saved_parts += nested_saved
+      failed_parts += nested_failed
+   # the manifest is only written once everything it lists is stored
+   if manifest_required() and not failed_parts:
+      failed_parts = len(save_manifest(saved_headers, manifest_parts, destination_bucket, key_prefix, pool))
+   return saved_parts, failed_parts
+
+def explode_message(body, destination_bucket, key_prefix, workmail_event=None, depth=0, budget=None, progress=None, metrics=NULL_METRICS,
+                    fan_out=None):
+   # keep track of how many MIME parts are parsed and saved to S3
+   saved_parts = 0
+   part_keys = []
+   manifest_parts = []
+   nested = []
+   archives = []
+   nested_parts = set()
+   bundle = None
+   config = get_config()
+   budget = nested_budget(budget)
+   workmail_mutate = workmail_event is not None and config.modify_workmail_message
+   # the uploads are queued on the shared executor, at most two per upload worker are buffered at a time
+   pool = UploadPool(upload_executor(), 2 * config.upload_workers, metrics.upload_observer)
+   try:
+      # modifying the WorkMail message needs the whole message, so it always uses the in-memory path.
+      # The fan-out coordinator only reads each part as far as needed to tell whether it is large
+      if (config.streaming_mode or fan_out is not None) and not workmail_mutate:
+         return stream_message_parts(body, destination_bucket, key_prefix, pool, depth, budget, progress, metrics, fan_out)
+      raw = body.read()
+      with metrics.parse_timer():
+         if config.scan_mode:
+            # scan_mode locates the parts in raw without building the Message tree
+            parts = mime_stream.scan_parts(raw)
+            headers = parts[0].items()
          else:
-            filename = "untitled"
+            msg = email.message_from_bytes(raw)
+            parts = msg.walk()
+            headers = msg.items()
+      # byte ranges of the parts in raw, located the first time a forwarded message is found
+      located = None
+      
+      # save the headers of the message to the bucket
+      saved_headers = select_headers(headers)
+      save_headers(saved_headers, destination_bucket, key_prefix, pool)
+      bundle = small_part_bundle(destination_bucket, key_prefix, pool)
    
-      # TODO: consider overriding or sanitizing the filenames since that is tainted data and might be subject to abuse in object key names
-      # technically, the entire message is tainted data, so it would be the responsibility of downstream parsers to ensure protection from interpreter abuse
+      # walk through each MIME part from the email message
+      part_idx = 0
+      for part in parts:
+         part_idx += 1
+      
+         # get information about the MIME part
+         content_type, content_disposition, content, charset, filename = [None] * 5
+         content_type = part.get_content_type()
+         content_disposition = str(part.get_content_disposition())
+         charset = part.get_content_charset()
+         filename = decode_filename(part.get_filename())
+         logger.debug(f"Part: {part_idx}. Content charset: {charset}. Content type: {content_type}. Content disposition: {content_disposition}. Filename: {filename}");
+         manifest_parts.append(manifest_entry(part_idx, part))
+         stored = stores_part(content_type, content_disposition, filename, estimated_size(part, raw))
+         if stored is False:
+            logger.debug(f"Part {part_idx} is not stored. Content type: {content_type}. Content disposition: {content_disposition}.")
+            continue
 
-      # skip parts that aren't attachment parts
-      if content_type in ["multipart/mixed", "multipart/related", "multipart/alternative"]:
-         continue
+         decode_started = time.perf_counter()
+         if config.scan_mode:
+            if content_type == 'message/rfc822':
+               content = memoryview(raw)[part.body_offset:part.end]
+            elif not part.is_multipart():
+               content = mime_stream.decode_body(raw, part)
+         else:
+            content = part.get_payload(decode=True)
+            if content_type == 'message/rfc822':
+               # the forwarded message is stored as its original bytes, a slice of the raw message
+               # instead of a re-serialisation of the parsed one
+               if located is None:
+                  # scan_parts skips the bodies with bytes.find, the message isn't parsed a second time line by line
+                  located = mime_stream.scan_parts(raw)
+               found = located_part(located, part_idx, part)
+               if found is not None:
+                  content = memoryview(raw)[found.body_offset:found.end]
+               else:
+                  logger.warning(f"Part {part_idx} could not be located in the raw message, storing it re-serialised")
+                  content = part.get_payload(decode=False)[0].as_bytes()
+         if stored is None and content and not stores_part(content_type, content_disposition, filename, len(content)):
+            # the size of the part couldn't be estimated before decoding it
+            logger.debug(f"Part {part_idx} is not stored. Content type: {content_type}. Content disposition: {content_disposition}.")
+            continue
+         # forwarded messages within a forwarded message are exploded with it, at the next depth
+         if content_type == 'message/rfc822' and content and explodes_nested(depth) and id(part) not in nested_parts:
+            nested.append((manifest_parts[-1], key_prefix + "/nested" + str(len(nested) + 1), content))
+            nested_parts.update(id(inner) for inner in part.walk())
+
+         # file names are tainted data, the key builder decodes and sanitises them.
+         # Technically, the entire message is tainted data, so it would be the responsibility of downstream parsers to ensure protection from interpreter abuse
+
+         # skip parts that aren't attachment parts
+         if content_type in ["multipart/mixed", "multipart/related", "multipart/alternative"]:
+            continue
       
-      if content:
+         if content:
          
-         # decode the content based on the character set specified
-         # TODO: add error handling
-         if charset:
-            content = content.decode(charset)
+            # decode the content based on the character set specified, charset_mode decides
+            # whether invalid bytes fail the message, are replaced, or the bytes are kept as they are
+            errors = transcode_errors(charset) if content_type != 'message/rfc822' else None
+            if errors:
+               content = str(content, charset, errors)
+            if isinstance(content, str):
+               content = content.encode('utf-8')
+            put_args = charset_metadata(charset, errors)
          
-         # store the decoded MIME part in S3 with the filename appended to the object key
-         s3.put_object(Bucket = destination_bucket, Key = key_prefix + "/mimepart" + str(part_idx) + "_" + filename, Body = content)
-         saved_parts += 1
+            # store the decoded MIME part in S3 with the filename appended to the object key
+            name = config.key_builder.part_name(key_prefix, part_idx, filename or default_filename(content_type, content_disposition))
+            metrics.add('decode', time.perf_counter() - decode_started, key_prefix + "/" + name)
+            metrics.count(key_prefix + "/" + name, encoded_size(part, content), len(content))
+            metrics.describe(key_prefix + "/" + name, contentType = content_type)
+            if config.small_part_mode and len(content) <= config.small_part_threshold:
+               with metrics.timer('upload', key_prefix + "/" + name):
+                  store_small_part(manifest_parts[-1], name, content, stored_charset(charset, errors), bundle)
+               if bundle is not None:
+                  part_keys.append(bundle.key)
+            elif config.dedup_parts or len(content) > config.multipart_threshold:
+               part_keys.append(key_prefix + "/" + name)
+               if already_stored(part_keys[-1], progress):
+                  upload = StoredPart(part_keys[-1], config.write_manifest)
+               else:
+                  upload = part_upload(destination_bucket, part_keys[-1], pool, None if config.dedup_parts else config.multipart_part_size, **put_args)
+               with metrics.timer('upload', part_keys[-1]):
+                  upload.write(content)
+                  upload.close()
+               stored_entry(manifest_parts[-1], upload, stored_charset(charset, errors))
+            else:
+               part_keys.append(key_prefix + "/" + name)
+               payload = BufferReader(content) if isinstance(content, memoryview) else content
+               if not already_stored(part_keys[-1], progress):
+                  pool.put_object(s3_client(), Bucket = destination_bucket, Key = part_keys[-1], Body = payload, **put_args)
+               manifest_parts[-1].update(key = part_keys[-1], size = len(content), storedCharset = stored_charset(charset, errors))
+               if config.write_manifest:
+                  manifest_parts[-1]['sha256'] = hashlib.sha256(content).hexdigest()
+            if expands_archive(content_type, filename):
+               expand_archive(manifest_parts[-1], key_prefix + "/" + name, content_type, filename, content,
+                              destination_bucket, pool)
+            saved_parts += 1
             
-      else:
-         logger.error(f"Part {part_idx} has no content. Content type: {content_type}. Content disposition: {content_disposition}.");
+         else:
+            logger.debug(f"Part {part_idx} has no content. Content type: {content_type}. Content disposition: {content_disposition}.");
    
+      if bundle is not None:
+         bundle.close()
+   except BaseException:
+      # don't leave uploads running after the invocation ends
+      if bundle is not None:
+         bundle.abort()
+      pool.wait()
+      raise
+
+   # wait for the part uploads so the number of saved parts is known
+   failed = pool.wait()
+   saved_parts -= len([key for key in part_keys if key in failed])
+   if progress is not None:
+      progress.update(key for key in part_keys if key not in failed and (bundle is None or key != bundle.key))
+   failed_parts = len(failed)
+   if nested:
+      nested_saved, nested_failed = explode_nested(nested, destination_bucket, depth, budget, progress, metrics)
+      saved_parts += nested_saved
+      failed_parts += nested_failed
+   # the manifest is only written once everything it lists is stored
+   if manifest_required() and not failed_parts:
+      failed_parts = len(save_manifest(saved_headers, manifest_parts, destination_bucket, key_prefix, pool))
+
    if workmail_mutate:
-      email_subject = event['subject']
+      email_subject = workmail_event['subject']
       modified_object_key = key_prefix + "/" + str(uuid.uuid4())
       new_subject =  f"[PROCESSED] {email_subject}"
-      msg.replace_header('Subject', new_subject)
-      msg.add_header('X-AWS-Mailsploder-Bucket-Prefix', "s3://" + destination_bucket + "/" + key_prefix)
-      msg.add_header('X-AWS-Mailsploder-Parts-Saved', str(saved_parts))
       
-      # Store updated email in S3
-      s3.put_object(Bucket = destination_bucket, Key = modified_object_key, Body = msg.as_bytes())
+      # Store updated email in S3: only the header block is rewritten, the original body bytes follow it untouched
+      store_modified_message(raw, {'Subject': new_subject}, [
+         ('X-AWS-Mailsploder-Bucket-Prefix', "s3://" + destination_bucket + "/" + key_prefix),
+         ('X-AWS-Mailsploder-Parts-Saved', str(saved_parts))
+      ], destination_bucket, modified_object_key, pool)
+      if pool.wait():
+         raise RuntimeError(f"Failed to store the modified message in s3://{destination_bucket}/{modified_object_key}")
 
       # Update the email in WorkMail
       s3_reference = {
@@ -148,10 +559,260 @@ def lambda_handler(event, context):
       content = {
          's3Reference': s3_reference
       }
-      workmail_message_flow.put_raw_message_content(messageId=message_id, content=content)
+      workmail_client().put_raw_message_content(messageId=workmail_event['messageId'], content=content)
         
-   return {
-       'statusCode': 200,
-       'body': 'Number of parts saved to S3 bucket: ' + destination_bucket + ': ' + str(saved_parts)
+   return saved_parts, failed_parts
+
+# with completion_markers, <prefix>/_completed.json records that a message was fully processed, keyed by
+# the ETag of the source object, so a redelivered event is a single HEAD request. When uploads fail,
+# <prefix>/_progress.json lists the parts that were stored so the retry doesn't upload them again
+COMPLETED_MARKER = "/_completed.json"
+PROGRESS_MARKER = "/_progress.json"
+
+def already_stored(key, progress):
+   return progress is not None and key in progress
+
+# the number of parts saved by the attempt that completed the message, or None if it isn't complete
+def completed_parts(destination_bucket, key_prefix, etag):
+   response = head_object(s3_client(), destination_bucket, key_prefix + COMPLETED_MARKER)
+   if response is None:
+      return None
+   metadata = response.get('Metadata', {})
+   if metadata.get('source-etag', '') != (etag or ''):
+      return None
+   return int(metadata.get('saved-parts', 0))
+
+def load_progress(destination_bucket, key_prefix, etag):
+   try:
+      progress = json.loads(s3_client().get_object(Bucket = destination_bucket, Key = key_prefix + PROGRESS_MARKER)['Body'].read())
+   except ClientError as e:
+      if is_not_found(e):
+         return set()
+      raise
+   if progress.get('etag') != etag:
+      return set()
+   return set(progress.get('keys', []))
+
+def save_progress(destination_bucket, key_prefix, etag, saved_parts, failed_parts, progress):
+   s3 = s3_client()
+   if failed_parts:
+      if progress:
+         s3.put_object(Bucket = destination_bucket, Key = key_prefix + PROGRESS_MARKER, ContentType = 'application/json',
+                       Body = json.dumps({'etag': etag, 'keys': sorted(progress)}, separators = (',', ':')))
+      return
+   s3.put_object(Bucket = destination_bucket, Key = key_prefix + COMPLETED_MARKER, ContentType = 'application/json',
+                 Body = json.dumps({'etag': etag, 'savedParts': saved_parts}, separators = (',', ':')),
+                 Metadata = {'source-etag': etag or '', 'saved-parts': str(saved_parts)})
+   if progress:
+      s3.delete_object(Bucket = destination_bucket, Key = key_prefix + PROGRESS_MARKER)
+
+# explode a message unless a completion marker shows it was already processed. fetch_body is only
+# called when the message has to be processed, so a processed message is never downloaded again
+def explode_once(fetch_body, destination_bucket, key_prefix, etag=None, workmail_event=None, fan_out=None):
+   if not get_config().completion_markers:
+      return explode_measured(fetch_body, destination_bucket, key_prefix, workmail_event, fan_out = fan_out)
+   saved_parts = completed_parts(destination_bucket, key_prefix, etag)
+   if saved_parts is not None:
+      logger.info(f"{key_prefix} was already processed, skipping it")
+      return saved_parts, 0
+   progress = load_progress(destination_bucket, key_prefix, etag)
+   if progress:
+      logger.info(f"Resuming {key_prefix}, {len(progress)} parts were stored by an earlier attempt")
+   saved_parts, failed_parts = explode_measured(fetch_body, destination_bucket, key_prefix, workmail_event, progress, fan_out)
+   save_progress(destination_bucket, key_prefix, etag, saved_parts, failed_parts, progress)
+   return saved_parts, failed_parts
+
+# explode a message, timing each stage and counting the bytes read and stored per part when a
+# metrics_sink is configured. The record is emitted when the message is done, also when it failed
+def explode_measured(fetch_body, destination_bucket, key_prefix, workmail_event=None, progress=None, fan_out=None):
+   config = get_config()
+   streaming = (config.streaming_mode or fan_out is not None) and not (workmail_event is not None and config.modify_workmail_message)
+   mode = 'streaming' if streaming else 'scan' if config.scan_mode else 'in_memory'
+   metrics = for_message(key_prefix, metrics_sink(), mode)
+   try:
+      with metrics.timer('fetch'):
+         body = metrics.reader(fetch_body())
+      return explode_message(body, destination_bucket, key_prefix, workmail_event, progress = progress, metrics = metrics, fan_out = fan_out)
+   finally:
+      metrics.emit()
+
+# splice a rewritten header block in front of the original body and stream it to S3, so the cost
+# depends on the size of the headers instead of re-generating the whole MIME tree with msg.as_bytes()
+def store_modified_message(raw, replace_headers, add_headers, destination_bucket, key, pool):
+   config = get_config()
+   header_end = mime_stream.header_block_end(raw)
+   body = memoryview(raw)[header_end:]
+   upload = S3StreamingUpload(s3_client(), destination_bucket, key, config.multipart_part_size, pool,
+                              threshold = config.multipart_threshold, concurrency = config.multipart_concurrency)
+   upload.write(mime_stream.rewrite_headers(memoryview(raw)[:header_end], replace_headers, add_headers))
+   for offset in range(0, len(body), config.multipart_part_size):
+      upload.write(body[offset:offset + config.multipart_part_size])
+   upload.close()
+
+def message_result(destination_bucket, saved_parts, failed_parts):
+   result = {
+      'statusCode': 500 if failed_parts else 200,
+      'body': 'Number of parts saved to S3 bucket: ' + destination_bucket + ': ' + str(saved_parts),
+      'savedParts': saved_parts,
+      'failedParts': failed_parts
    }
+   if failed_parts:
+      result['body'] += '. Number of uploads failed: ' + str(failed_parts)
+   return result
+
+# S3 event notifications delivered through SQS carry the S3 event in the message body
+def s3_records(record):
+   if record.get('eventSource') == 'aws:sqs':
+      return json.loads(record['body']).get('Records', [])
+   return [record]
+
+def record_identifier(record):
+   if record.get('eventSource') == 'aws:sqs':
+      return record['messageId']
+   return "s3://" + record['s3']['bucket']['name'] + "/" + record['s3']['object']['key']
+
+def process_s3_record(record, destination_bucket):
+   # get the S3 object information
+   s3_info = record['s3']
+   object_info = s3_info['object']
+   if s3_info['bucket']['name'] == destination_bucket:
+      logger.error("To prevent recursive file creation this function will not write back to the same bucket")
+      return {
+         'statusCode': 400,
+         'body': 'To prevent recursive file creation this function will not write back to the same bucket'
+      }
+   
+   # get the email message stored in S3 and parse it using the python email library
+   # TODO: error condition - if the file isn't an email message or doesn't parse correctly
+   object_key = object_info['key']
+   key_prefix = get_config().key_builder.message_prefix(object_key)
+   fetch_body = lambda: s3_client().get_object(Bucket = s3_info['bucket']['name'], Key = object_key)['Body']
+   fan_out = None
+   if fan_out_dispatcher() is not None:
+      fan_out = FanOut(fan_out_dispatcher(), s3_info['bucket']['name'], object_key, object_info.get('eTag'), get_config().fan_out_min_size)
+   saved_parts, failed_parts = explode_once(fetch_body, destination_bucket, key_prefix, object_info.get('eTag'), fan_out = fan_out)
+   return message_result(destination_bucket, saved_parts, failed_parts)
+
+# fan-out worker: decode one large part from its byte range in the source message and store it
+def process_part_task(task):
+   config = get_config()
+   source = task['source']
+   destination = task['destination']
+   start, end = task['range']
+   charset = task.get('charset')
+   content_type = task.get('contentType')
+   content_disposition = str(task.get('contentDisposition'))
+   filename = decode_filename(task.get('filename'))
+   errors = transcode_errors(charset)
+   pool = UploadPool(upload_executor(), 2 * config.upload_workers)
+   upload = part_upload(destination['bucket'], destination['key'], pool, config.multipart_part_size, **charset_metadata(charset, errors))
+   sink = mime_stream.TranscodingSink(upload, charset, errors) if errors else upload
+   excluded = False
+   if stores_part(content_type, content_disposition, filename) is None:
+      # the coordinator hands the part over before decoding it, the part_rules that depend on its size are applied here
+      def stores(size):
+         nonlocal excluded
+         excluded = not stores_part(content_type, content_disposition, filename, size)
+         return not excluded
+      sink = size_ruled_sink(sink, stores)
+   sink = mime_stream.DecodingSink(sink, mime_stream.transfer_decoder(task.get('contentTransferEncoding')))
+   try:
+      if end > start:
+         # the task fails instead of storing a slice of another version of the message
+         condition = {'IfMatch': source['etag']} if source.get('etag') else {}
+         body = s3_client().get_object(Bucket = source['bucket'], Key = source['key'], Range = f"bytes={start}-{end - 1}", **condition)['Body']
+         for chunk in mime_stream.iter_chunks(body, config.stream_chunk_size):
+            sink.write(chunk)
+      sink.close()
+   except BaseException:
+      sink.abort()
+      pool.wait()
+      raise
+   failed = pool.wait()
+   if excluded:
+      logger.debug(f"Part {task.get('index')} is not stored. Content type: {content_type}. Content disposition: {content_disposition}.")
+   return message_result(destination['bucket'], 0 if failed or excluded else 1, len(failed))
+
+# process one record of a batch, an SQS record may wrap several S3 notifications
+def process_batch_record(record, destination_bucket):
+   result = {'itemIdentifier': None, 'statusCode': 200, 'savedParts': 0, 'failedParts': 0}
+   try:
+      result['itemIdentifier'] = record_identifier(record)
+      task = task_of(record)
+      if task is None and record.get('eventSource') != 'aws:sqs' and 's3' not in record:
+         raise ValueError(f"Unsupported record from {record.get('eventSource') or 'an unknown source'}")
+      for s3_record in s3_records(record) if task is None else []:
+         # skip the s3:TestEvent that S3 sends when a notification is configured
+         if 's3' not in s3_record:
+            continue
+         s3_result = process_s3_record(s3_record, destination_bucket)
+         result['statusCode'] = max(result['statusCode'], s3_result['statusCode'])
+         result['savedParts'] += s3_result.get('savedParts', 0)
+         result['failedParts'] += s3_result.get('failedParts', 0)
+      if task is not None:
+         task_result = process_part_task(task)
+         result.update(statusCode = task_result['statusCode'], savedParts = task_result['savedParts'], failedParts = task_result['failedParts'])
+   except Exception as e:
+      if result['itemIdentifier'] is None:
+         # a record of another event source fails on its own, under the best identifier it has
+         result['itemIdentifier'] = record.get('messageId') or record.get('eventID') or 'unknown'
+      logger.exception(f"Failed to process record {result['itemIdentifier']}")
+      result['statusCode'] = 500
+      result['error'] = str(e)
+   return result
+
+def lambda_handler(event, context):
+   logger.info("Processing email event")
+   config = get_config()
+   destination_bucket = config.destination_bucket
+   if not destination_bucket:
+      logger.error("Environment variable missing: destination_bucket")
+      return
+
+   # event is from workmail
+   if event.get('messageId'):
+      message_id = event['messageId']
+      fetch_body = lambda: workmail_client().get_raw_message_content(messageId=message_id)['messageContent']
+      key_prefix = get_config().key_builder.message_prefix(message_id)
+      saved_parts, failed_parts = explode_once(fetch_body, destination_bucket, key_prefix, workmail_event = event)
+      result = message_result(destination_bucket, saved_parts, failed_parts)
+      if failed_parts:
+         raise RuntimeError(result['body'])
+      return {'statusCode': result['statusCode'], 'body': result['body']}
+
+   # event is a fan-out task invoked by a coordinator
+   task = task_of(event)
+   if task is not None:
+      result = process_part_task(task)
+      if result['failedParts']:
+         raise RuntimeError(result['body'])
+      return {'statusCode': result['statusCode'], 'body': result['body']}
+
+   # event is from s3, directly or through SQS
+   records = event.get('Records', [])
+   if len(records) == 1 and 's3' in records[0]:
+      result = process_s3_record(records[0], destination_bucket)
+      if result['statusCode'] >= 500:
+         raise RuntimeError(result['body'])
+      return {'statusCode': result['statusCode'], 'body': result['body']}
+
+   # process the batch with a bounded worker pool, one result per record.
+   # The client is created up front, client creation isn't thread safe
+   s3_client()
+   workers = max(1, min(config.batch_workers, len(records)))
+   with ThreadPoolExecutor(max_workers = workers) as executor:
+      results = list(executor.map(lambda record: process_batch_record(record, destination_bucket), records))
 
+   saved_parts = sum(result['savedParts'] for result in results)
+   failures = [result['itemIdentifier'] for result in results if result['statusCode'] >= 500]
+   if failures and not any(record.get('eventSource') == 'aws:sqs' for record in records):
+      # let Lambda retry the invocation, there is no partial batch response for S3 notifications
+      raise RuntimeError(f"{len(failures)} of {len(records)} records failed: {', '.join(failures)}")
+
+   return {
+      'statusCode': 500 if failures else 200,
+      'body': 'Number of parts saved to S3 bucket: ' + destination_bucket + ': ' + str(saved_parts),
+      'results': results,
+      # SQS partial batch response, only the failed messages are retried
+      'batchItemFailures': [{'itemIdentifier': failure} for failure in failures]
+   }
@@ -1,107 +1,156 @@
-import os
-import boto3
 import email
 import json
 import logging
-import re
 import uuid
+from xml.parsers.expat import ExpatError
 import xmltodict
-import gzip
-from io import BytesIO
-import io
+import archive_stage
+import dmarc_parquet
+import dmarc_report
+from object_keys import decode_filename
+from lambda_function import message_result, record_identifier, s3_records
+from parser_config import get_config, s3_client, upload_executor, workmail_client
+from s3_writer import S3StreamingUpload, UploadPool
 
 
-s3 = boto3.client("s3")
-workmail_message_flow = boto3.client('workmailmessageflow')
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def unzip_gz_content(gz_content):
-  with gzip.open(io.BytesIO(gz_content), "rb") as f:
-    return f.read()
-    
+# the content types reports are sent with. Senders label gzip and zip compressed reports inconsistently,
+# often as application/octet-stream, so the container of a report is told from its first bytes, not its label
+REPORT_CONTENT_TYPES = ('application/gzip', 'application/x-gzip', 'application/zip', 'application/x-zip',
+                        'application/x-zip-compressed', 'application/octet-stream', 'text/xml', 'application/xml')
+REPORT_SUFFIXES = ('.xml', '.gz', '.zip')
+
+# the expanders of the archive expansion stage for the report containers
+REPORT_EXPANDERS = {'application/gzip': archive_stage.GzipExpander(), 'application/zip': archive_stage.ZipExpander()}
+
+# the container of a part that may be a report: application/gzip, application/zip or text/xml,
+# None if the part isn't a report
+def report_container(content_type, filename, data):
+   if content_type not in REPORT_CONTENT_TYPES and not (filename and filename.lower().endswith(REPORT_SUFFIXES)):
+      return None
+   container = archive_stage.sniff(data)
+   if container in REPORT_EXPANDERS:
+      return container
+   if dmarc_report.is_xml(data):
+      return 'text/xml'
+   logger.warning(f"Not a DMARC report: {filename or content_type}")
+   return None
+
+# streams every report of a gzip or zip container, decompressed, into the sink open_report(name) returns,
+# within the dmarc_report_* limits: XML reports compress far better than the archives the archive_* limits are for
+def expand_reports(content, container, filename, open_report):
+   archive_stage.expand(content, container, filename, open_report, get_config().dmarc_archive_limits,
+                        expanders = [REPORT_EXPANDERS[container]])
+
+# with dmarc_output=jsonl or parquet the report is parsed while it is stored, and every record is written
+# to dmarc_report_bucket as soon as it is read, so neither the report nor its rows are held in memory.
+# The keys of the objects are appended to keys as they are opened
+def report_rows(pool, destination_bucket, xml_key, keys):
+   config = get_config()
+   upload = lambda bucket, key: S3StreamingUpload(s3_client(), bucket, key, config.multipart_part_size, pool,
+                                                  threshold = config.multipart_threshold)
+   keys.append(xml_key)
+   xml = upload(destination_bucket, xml_key)
+   if config.dmarc_output == 'parquet':
+      # the partition of the file is only known once the report metadata is read
+      def open_rows(row):
+         keys.append(dmarc_parquet.object_key(config.dmarc_report_bucket_folder, row, xml_key))
+         return upload(config.dmarc_report_bucket, keys[-1])
+      return dmarc_report.ReportRows(dmarc_parquet.ParquetRows(open_rows), xml)
+   keys.append(config.dmarc_report_bucket_folder + "/" + rows_key(xml_key))
+   return dmarc_report.ReportRows(dmarc_report.JsonLines(upload(config.dmarc_report_bucket, keys[-1])), xml)
+
+# a gzip compressed report is stored next to the part without its .gz suffix. Reports are recognised by
+# their content, so a part without the suffix gets .xml appended instead, not to overwrite the part
+def gunzipped_key(part_key):
+   return part_key[:-len('.gz')] if part_key.lower().endswith('.gz') else part_key + '.xml'
+
+# a copy of a plain XML report is stored next to the part without its .xml suffix, or with .xml appended
+# when the part name doesn't end with .xml, so a report recognised by its content doesn't overwrite the part
+def plain_report_key(part_key):
+   return part_key[:-len('.xml')] if part_key.lower().endswith('.xml') else part_key + '.xml'
+
+def json_key(xml_key):
+   return (xml_key[:-len('.xml')] if xml_key.endswith('.xml') else xml_key) + '.json'
+
+def rows_key(xml_key):
+   return (xml_key[:-len('.xml')] if xml_key.endswith('.xml') else xml_key) + '.jsonl'
+
+def write_report(xml_content, report):
+   try:
+      for offset in range(0, len(xml_content), archive_stage.READ_SIZE):
+         report.write(memoryview(xml_content)[offset:offset + archive_stage.READ_SIZE])
+   except BaseException:
+      report.abort()
+      raise
+   return report.close()
+
+# with dmarc_output=json the whole report is stored, then converted in memory
+def write_json_report(pool, destination_bucket, xml_key, xml_content, keys):
+   config = get_config()
+   keys.append(xml_key)
+   pool.put_object(s3_client(), Bucket = destination_bucket, Key = xml_key, Body = xml_content)
+   json_content = xml_to_json(xml_content)
+   keys.append(config.dmarc_report_bucket_folder + "/" + json_key(xml_key))
+   pool.put_object(s3_client(), Bucket = config.dmarc_report_bucket, Key = keys[-1], Body = json_content)
+
+# decompresses and converts the reports of a part, the keys of the objects are appended to keys
+def write_reports(pool, destination_bucket, part_key, container, report_filename, data, keys):
+   config = get_config()
+   if container in REPORT_EXPANDERS:
+      # a gzip compressed report is stored next to the part without .gz, the reports of a zip archive under the part
+      if container == 'application/gzip':
+         report_key = lambda name: gunzipped_key(part_key)
+      else:
+         report_key = lambda name: config.key_builder.member_key(part_key, name)
+      if config.dmarc_output != 'json':
+         expand_reports(data, container, report_filename,
+                        lambda name: report_rows(pool, destination_bucket, report_key(name), keys))
+      else:
+         reports = {}
+         expand_reports(data, container, report_filename,
+                        lambda name: reports.setdefault(report_key(name), archive_stage.BytesSink()))
+         for unzipped_key, report in reports.items():
+            write_json_report(pool, destination_bucket, unzipped_key, bytes(report.data), keys)
+
+   if container == 'text/xml':
+      xml_key = plain_report_key(part_key)
+      if config.dmarc_output != 'json':
+         write_report(data, report_rows(pool, destination_bucket, xml_key, keys))
+      else:
+         write_json_report(pool, destination_bucket, xml_key, data, keys)
+
 def xml_to_json(xml_string):
-   data_dict = xmltodict.parse(xml_string)
+   # the same document as xmltodict.parse, built with less work per element
+   data_dict = xmltodict.parse_fast(xml_string)
    # json_data = json.dumps(data_dict, indent=4) Athena only handled single link JSON
    json_data = json.dumps(data_dict, separators=(',', ':'))
    return json_data
     
-def lambda_handler(event, context):
-   logger.info("Processing email event")
-   destination_bucket = os.environ.get('destination_bucket')
-   dmarc_report_bucket = os.environ.get('dmarc_report_bucket')
-   dmarc_report_bucket_folder = os.environ.get('dmarc_report_bucket_folder')
-   source_bucket = os.environ.get('source_bucket')
-   key_prefix = None
-   if not destination_bucket:
-      print("Environment variable missing: destination_bucket")
-      return
-   
-   try:   
-      # keep track of how many MIME parts are parsed and saved to S3
-      saved_parts = 0
-      msg = None
-      parts = None
-      workmail_mutate = None
-
-      # event is from workmail
-      if event.get('messageId'):
-         message_id = event['messageId']
-         key_prefix = message_id
-         raw_msg = workmail_message_flow.get_raw_message_content(messageId=message_id)
-         msg = email.message_from_bytes(raw_msg['messageContent'].read())
-         if os.environ.get('modify_workmail_message'):
-            workmail_mutate = True
-
-      # event is from s3
-      else:
-         records = event.get('Records', [])
-         record  = records[0]
-         # TODO: for record in records:
-         # get the S3 object information
-         s3_info = record['s3']
-         object_info = s3_info['object']
-         if s3_info['bucket']['name'] == destination_bucket:
-            print("To prevent recursive file creation this function will not write back to the same bucket")
-            return {
-               'statusCode': 400,
-               'body': 'To prevent recursive file creation this function will not write back to the same bucket'
-            }
-         
-         # get the email message stored in S3 and parse it using the python email library
-         # TODO: error condition - if the file isn't an email message or doesn't parse correctly
-         fileObj, object_key = [None] * 2
-         object_key = object_info['key']
-         key_prefix = object_key
-         fileObj = s3.get_object(Bucket = s3_info['bucket']['name'], Key = object_key)
-         msg = email.message_from_bytes(fileObj['Body'].read())
-      
+# stores the headers and parts of a report email, and converts the reports among them.
+# Returns the number of parts saved and the number of uploads that failed
+def explode_message(msg, destination_bucket, key_prefix):
+   config = get_config()
+   s3 = s3_client()
+   # the objects of a message are written concurrently, the reports are converted while they are stored
+   pool = UploadPool(upload_executor(), 2 * config.upload_workers)
+   # keep track of how many MIME parts are parsed and saved to S3
+   saved_parts = 0
+   part_keys = []
+   try:
       # save the headers of the message to the bucket
-      headers_to_save = None
       # By default saving all headers, but use environment vairables to be more specific
-      if os.environ.get('select_headers','ALL'): 
-         headers_to_save = re.split(',\s*', str(os.environ.get('select_headers', 'ALL')))
-         all_headers = msg.items()
-         if "ALL" in headers_to_save:
-            s3.put_object(Bucket = destination_bucket, Key = key_prefix + "/headers.json", Body = json.dumps(all_headers))
-         elif len(headers_to_save) > 0:
-            saved_headers = []
-            i = 0
-            while i < len(all_headers):
-               this_header = all_headers[i]
-               if this_header[0].upper() in (header.upper() for header in headers_to_save):
-                  saved_headers.append(this_header)
-               i += 1
-            s3.put_object(Bucket = destination_bucket, Key = key_prefix + "/headers.json", Body = json.dumps(saved_headers))
-         
-      # parse the mime parts out of the message
-      parts = msg.walk()
-      
+      if config.header_filter is not None:
+         saved_headers = config.header_filter.select(msg.items())
+         pool.put_object(s3, Bucket = destination_bucket, Key = key_prefix + "/headers.json", Body = json.dumps(saved_headers))
+
       # walk through each MIME part from the email message
       part_idx = 0
-      for part in parts:
+      for part in msg.walk():
          part_idx += 1
-         
+
          # get information about the MIME part
          content_type, content_disposition, content, charset, filename = [None] * 5
          content_type = part.get_content_type()
@@ -110,8 +159,9 @@ def lambda_handler(event, context):
          if content_type == 'message/rfc822':
             content = part.get_payload(decode=False)[0].as_string()
          charset = part.get_content_charset()
-         filename = part.get_filename()
-         print(f"Part: {part_idx}. Content charset: {charset}. Content type: {content_type}. Content disposition: {content_disposition}. Filename: {filename}");
+         filename = decode_filename(part.get_filename())
+         report_filename = filename
+         logger.debug(f"Part: {part_idx}. Content charset: {charset}. Content type: {content_type}. Content disposition: {content_disposition}. Filename: {filename}")
 
          # make file name for body, and untitled text or html parts
          # add additional content types that we want to support non-existent filenames
@@ -128,73 +178,160 @@ def lambda_handler(event, context):
                   filename = "untitled.html"
             else:
                filename = "untitled"
-      
-         # TODO: consider overriding or sanitizing the filenames since that is tainted data and might be subject to abuse in object key names
-         # technically, the entire message is tainted data, so it would be the responsibility of downstream parsers to ensure protection from interpreter abuse
+
+         # file names are tainted data, the key builder decodes and sanitises them.
+         # Technically, the entire message is tainted data, so it would be the responsibility of downstream parsers to ensure protection from interpreter abuse
+         part_key = key_prefix + "/" + config.key_builder.part_name(key_prefix, part_idx, filename)
 
          # skip parts that aren't attachment parts
          if content_type in ["multipart/mixed", "multipart/related", "multipart/alternative"]:
             continue
-         
+
          if content:
-            
+
             # decode the content based on the character set specified
             # TODO: add error handling
             if charset:
                content = content.decode(charset)
-            
-            # store the decoded MIME part in S3 with the filename appended to the object key
-            s3.put_object(Bucket = destination_bucket, Key = key_prefix + "/mimepart" + str(part_idx) + "_" + filename, Body = content)
-
-            
-            if content_type in ["application/gzip", "application/x-gzip"]:
-               gz_content = s3.get_object(Bucket=destination_bucket, Key=key_prefix + "/mimepart" + str(part_idx) + "_" + filename)["Body"].read()
-               unzipped_content = unzip_gz_content(gz_content)
-               gz_key = key_prefix + "/mimepart" + str(part_idx) + "_" + filename
-               unzipped_key = gz_key.replace('.gz','')
-               s3.put_object(Bucket=destination_bucket, Key=unzipped_key, Body=unzipped_content)
-               json_content = xml_to_json(unzipped_content)
-               unzipped_json_key = unzipped_key.replace('.xml','.json')
-               s3.put_object(Bucket=dmarc_report_bucket, Key = dmarc_report_bucket_folder + "/" + unzipped_json_key, Body=json_content)
-            
-            if content_type in ["text/xml"]:
-               xml_content = s3.get_object(Bucket=destination_bucket, Key=key_prefix + "/mimepart" + str(part_idx) + "_" + filename)["Body"].read()
-               xml_key = key_prefix + "/mimepart" + str(part_idx) + "_" + filename
-               xml_key = xml_key.replace('.xml','')
-               s3.put_object(Bucket=destination_bucket, Key=xml_key, Body=xml_content)
-               json_content = xml_to_json(xml_content)
-               unzipped_json_key = xml_key.replace('.json','')
-               s3.put_object(Bucket=dmarc_report_bucket, Key = dmarc_report_bucket_folder + "/" + unzipped_json_key, Body=json_content)
-            
+
+            # store the decoded MIME part in S3 with the filename appended to the object key.
+            # The report is converted from the part in memory while it is written, not read back from S3
+            keys = [part_key]
+            pool.put_object(s3, Bucket = destination_bucket, Key = part_key, Body = content)
+
+            # the same bytes the put_object above stores
+            data = content.encode('utf-8') if isinstance(content, str) else content
+            container = report_container(content_type, report_filename, data)
+
+            if container is not None:
+               try:
+                  write_reports(pool, destination_bucket, part_key, container, report_filename, data, keys)
+               except (archive_stage.ArchiveError, dmarc_report.ReportError, ExpatError) as e:
+                  # the part is stored all the same, and the next parts are still processed
+                  logger.warning(f"Part {part_idx} was stored but its report could not be converted: {e}")
+
+            part_keys.append(keys)
             saved_parts += 1
-               
+
          else:
-            print(f"Part {part_idx} has no content. Content type: {content_type}. Content disposition: {content_disposition}.");
-      
-      if workmail_mutate:
-         email_subject = event['subject']
-         modified_object_key = key_prefix + "/" + str(uuid.uuid4())
-         new_subject =  f"[PROCESSED] {email_subject}"
-         msg.replace_header('Subject', new_subject)
-         msg.add_header('X-AWS-Mailsploder-Bucket-Prefix', "s3://" + destination_bucket + "/" + key_prefix)
-         msg.add_header('X-AWS-Mailsploder-Parts-Saved', str(saved_parts))
-         
-         # Store updated email in S3
-         s3.put_object(Bucket = destination_bucket, Key = modified_object_key, Body = msg.as_bytes())
-
-         # Update the email in WorkMail
-         s3_reference = {
-            'bucket': destination_bucket,
-            'key': modified_object_key
-         }
-         content = {
-            's3Reference': s3_reference
-         }
-         workmail_message_flow.put_raw_message_content(messageId=message_id, content=content)
+            logger.debug(f"Part {part_idx} has no content. Content type: {content_type}. Content disposition: {content_disposition}.")
+   except BaseException:
+      pool.wait()
+      raise
+
+   # a part counts as saved once all of its objects are
+   failed = pool.wait()
+   saved_parts -= len([keys for keys in part_keys if any(key in failed for key in keys)])
+   return saved_parts, len(failed)
+
+# mark the WorkMail message as processed, with a pointer to its parts
+def update_workmail_message(event, msg, destination_bucket, key_prefix, saved_parts):
+   email_subject = event['subject']
+   modified_object_key = key_prefix + "/" + str(uuid.uuid4())
+   new_subject =  f"[PROCESSED] {email_subject}"
+   msg.replace_header('Subject', new_subject)
+   msg.add_header('X-AWS-Mailsploder-Bucket-Prefix', "s3://" + destination_bucket + "/" + key_prefix)
+   msg.add_header('X-AWS-Mailsploder-Parts-Saved', str(saved_parts))
+
+   # Store updated email in S3
+   s3_client().put_object(Bucket = destination_bucket, Key = modified_object_key, Body = msg.as_bytes())
+
+   # Update the email in WorkMail
+   s3_reference = {
+      'bucket': destination_bucket,
+      'key': modified_object_key
+   }
+   content = {
+      's3Reference': s3_reference
+   }
+   workmail_client().put_raw_message_content(messageId=event['messageId'], content=content)
+
+def process_s3_record(record, destination_bucket):
+   # get the S3 object information
+   s3_info = record['s3']
+   object_info = s3_info['object']
+   if s3_info['bucket']['name'] == destination_bucket:
+      logger.error("To prevent recursive file creation this function will not write back to the same bucket")
+      return {
+         'statusCode': 400,
+         'body': 'To prevent recursive file creation this function will not write back to the same bucket'
+      }
+
+   # get the email message stored in S3 and parse it using the python email library
+   object_key = object_info['key']
+   key_prefix = get_config().key_builder.message_prefix(object_key)
+   fileObj = s3_client().get_object(Bucket = s3_info['bucket']['name'], Key = object_key)
+   msg = email.message_from_bytes(fileObj['Body'].read())
+   saved_parts, failed_parts = explode_message(msg, destination_bucket, key_prefix)
+   return message_result(destination_bucket, saved_parts, failed_parts)
+
+# process one record of a batch, an SQS record may wrap several S3 notifications
+def process_batch_record(record, destination_bucket):
+   result = {'itemIdentifier': None, 'statusCode': 200, 'savedParts': 0, 'failedParts': 0}
+   try:
+      result['itemIdentifier'] = record_identifier(record)
+      if record.get('eventSource') != 'aws:sqs' and 's3' not in record:
+         raise ValueError(f"Unsupported record from {record.get('eventSource') or 'an unknown source'}")
+      for s3_record in s3_records(record):
+         # skip the s3:TestEvent that S3 sends when a notification is configured
+         if 's3' not in s3_record:
+            continue
+         s3_result = process_s3_record(s3_record, destination_bucket)
+         result['statusCode'] = max(result['statusCode'], s3_result['statusCode'])
+         result['savedParts'] += s3_result.get('savedParts', 0)
+         result['failedParts'] += s3_result.get('failedParts', 0)
    except Exception as e:
-      print("Error trapped:", e)
-        
+      if result['itemIdentifier'] is None:
+         # a record of another event source fails on its own, under the best identifier it has
+         result['itemIdentifier'] = record.get('messageId') or record.get('eventID') or 'unknown'
+      logger.exception(f"Failed to process record {result['itemIdentifier']}")
+      result['statusCode'] = 500
+      result['error'] = str(e)
+   return result
+
+def lambda_handler(event, context):
+   logger.info("Processing email event")
+   config = get_config()
+   destination_bucket = config.destination_bucket
+   if not destination_bucket:
+      logger.error("Environment variable missing: destination_bucket")
+      return
+
+   # event is from workmail
+   if event.get('messageId'):
+      message_id = event['messageId']
+      key_prefix = config.key_builder.message_prefix(message_id)
+      raw_msg = workmail_client().get_raw_message_content(messageId=message_id)
+      msg = email.message_from_bytes(raw_msg['messageContent'].read())
+      saved_parts, failed_parts = explode_message(msg, destination_bucket, key_prefix)
+      result = message_result(destination_bucket, saved_parts, failed_parts)
+      if failed_parts:
+         raise RuntimeError(result['body'])
+      if config.modify_workmail_message:
+         update_workmail_message(event, msg, destination_bucket, key_prefix, saved_parts)
+      return {'statusCode': result['statusCode'], 'body': result['body']}
+
+   # event is from s3, directly or through SQS
+   records = event.get('Records', [])
+   if len(records) == 1 and 's3' in records[0]:
+      result = process_s3_record(records[0], destination_bucket)
+      if result['statusCode'] >= 500:
+         raise RuntimeError(result['body'])
+      return {'statusCode': result['statusCode'], 'body': result['body']}
+
+   # the reports are converted in memory, so the records are processed one at a time
+   results = [process_batch_record(record, destination_bucket) for record in records]
+
+   saved_parts = sum(result['savedParts'] for result in results)
+   failures = [result['itemIdentifier'] for result in results if result['statusCode'] >= 500]
+   if failures and not any(record.get('eventSource') == 'aws:sqs' for record in records):
+      # let Lambda retry the invocation, there is no partial batch response for S3 notifications
+      raise RuntimeError(f"{len(failures)} of {len(records)} records failed: {', '.join(failures)}")
+
    return {
-       'statusCode': 200,
-       'body': 'Number of parts saved to S3 bucket: ' + destination_bucket + ': ' + str(saved_parts)
-   }
\ No newline at end of file
+      'statusCode': 500 if failures else 200,
+      'body': 'Number of parts saved to S3 bucket: ' + destination_bucket + ': ' + str(saved_parts),
+      'results': results,
+      # SQS partial batch response, only the failed messages are retried
+      'batchItemFailures': [{'itemIdentifier': failure} for failure in failures]
+   }
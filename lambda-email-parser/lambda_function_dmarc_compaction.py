@@ -0,0 +1,41 @@
+import datetime
+import logging
+import posixpath
+
+import dmarc_parquet
+from parser_config import get_config, s3_client
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# the report date to compact, the "date" of the event (YYYY-MM-DD). By default the day before yesterday:
+# the reports of a day are sent during the next one, so its partitions don't grow any more by then
+def report_date(event):
+   if event.get('date'):
+      return datetime.date.fromisoformat(event['date']).isoformat()
+   return (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=2)).isoformat()
+
+# the org_name partitions of a report date, <folder>/report_date=<day>/org_name=<org>/
+def partitions(s3, bucket, folder, day):
+   prefix = f"{folder}/report_date={day}/"
+   return sorted({posixpath.dirname(key) + '/' for key, _ in dmarc_parquet.list_objects(s3, bucket, prefix)
+                  if posixpath.dirname(key) + '/' != prefix})
+
+# scheduled with an EventBridge rule, merges the per-report Parquet files of dmarc_output=parquet
+def lambda_handler(event, context):
+   config = get_config()
+   if not config.dmarc_report_bucket:
+      print("Environment variable missing: dmarc_report_bucket")
+      return
+   day = report_date(event or {})
+   merged_files = written_files = 0
+   for prefix in partitions(s3_client(), config.dmarc_report_bucket, config.dmarc_report_bucket_folder, day):
+      merged, written = dmarc_parquet.compact(s3_client(), config.dmarc_report_bucket, prefix, config.dmarc_compaction_target_size)
+      merged_files += merged
+      written_files += written
+   logger.info(f"Compacted {merged_files} files of {day} into {written_files}")
+   return {
+      'statusCode': 200,
+      'body': f"Compacted {merged_files} files of {day} into {written_files}"
+   }
@@ -0,0 +1,290 @@
+"""Per-message and per-part timings and byte counts for the email parser.
+
+A MessageMetrics collects the time spent in each stage of processing a
+message (fetch, parse, decode, upload) and the bytes read and stored, overall
+and per part. When the message is done it is handed to a sink. The default is
+no sink at all: ``for_message`` then returns NULL_METRICS, whose methods do
+nothing, so the parser pays nothing for the instrumentation.
+
+Sinks are pluggable: anything with an ``emit(record)`` method can be added to
+SINKS and selected with the metrics_sink environment variable. ``emf`` prints
+CloudWatch Embedded Metric Format documents, which CloudWatch Logs turns into
+metrics without any API calls from the function.
+"""
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from mime_stream import DecodingSink
+
+STAGES = ('fetch', 'parse', 'decode', 'upload')
+
+
+class MessageMetrics:
+   """Timings and byte counts of one message, parts are identified by their object key."""
+
+   def __init__(self, message, sink, mode):
+      self.message = message
+      self.mode = mode
+      self.seconds = dict.fromkeys(STAGES, 0.0)
+      self.bytes_in = 0
+      self.bytes_out = 0
+      self.parts = {}
+      self._sink = sink
+      self._lock = threading.Lock()
+      # time spent uploading from the parsing thread, see TimedSink
+      self._inline_upload = 0.0
+      self._current_key = None
+
+   def add(self, stage, seconds, key=None):
+      with self._lock:
+         self.seconds[stage] += seconds
+         if key is not None:
+            part = self._part(key)
+            part[stage + 'Ms'] = part.get(stage + 'Ms', 0.0) + seconds * 1000
+
+   def count(self, key, bytes_in=0, bytes_out=0):
+      with self._lock:
+         part = self._part(key)
+         part['bytesIn'] = part.get('bytesIn', 0) + bytes_in
+         part['bytesOut'] = part.get('bytesOut', 0) + bytes_out
+         self.bytes_out += bytes_out
+
+   def describe(self, key, **fields):
+      with self._lock:
+         self._part(key).update(fields)
+
+   @contextmanager
+   def timer(self, stage, key=None):
+      start = time.perf_counter()
+      try:
+         yield
+      finally:
+         self.add(stage, time.perf_counter() - start, key)
+
+   @contextmanager
+   def parse_timer(self):
+      """Time parsing, without the fetch, decode and upload time spent while the message is parsed."""
+      start = time.perf_counter()
+      before = self._other_stages()
+      try:
+         yield
+      finally:
+         seconds = time.perf_counter() - start - (self._other_stages() - before)
+         self.add('parse', max(seconds, 0.0))
+
+   def upload_observer(self, key, seconds):
+      """UploadPool observer, records background writes."""
+      self.add('upload', seconds, key)
+
+   def reader(self, body):
+      """Wrap a message body so reading it is timed as fetch and counted as bytes in."""
+      return _TimedReader(body, self)
+
+   def upload_sink(self, sink, key):
+      """Wrap the upload a part is written to, so writing to it is timed as upload."""
+      self._current_key = key
+      return TimedSink(self, sink, key)
+
+   def decoding_sink(self, sink, decoder):
+      """MimeStreamParser decoding sink factory that times transfer decoding."""
+      return _DecodeTimer(self, DecodingSink(sink, decoder), self._current_key)
+
+   def emit(self):
+      self._sink.emit(self.record())
+
+   def record(self):
+      return {
+         'message': self.message,
+         'mode': self.mode,
+         'ms': {stage: round(seconds * 1000, 3) for stage, seconds in self.seconds.items()},
+         'bytesIn': self.bytes_in,
+         'bytesOut': self.bytes_out,
+         'parts': [{'key': key, **{name: round(value, 3) if isinstance(value, float) else value for name, value in part.items()}}
+                   for key, part in self.parts.items()],
+      }
+
+   def _other_stages(self):
+      return self.seconds['fetch'] + self.seconds['decode'] + self._inline_upload
+
+   def _part(self, key):
+      part = self.parts.get(key)
+      if part is None:
+         part = self.parts[key] = {}
+      return part
+
+
+class _NullMetrics:
+   """Stands in for MessageMetrics when no sink is configured."""
+   message = None
+
+   def add(self, stage, seconds, key=None):
+      pass
+
+   def count(self, key, bytes_in=0, bytes_out=0):
+      pass
+
+   def describe(self, key, **fields):
+      pass
+
+   @contextmanager
+   def timer(self, stage, key=None):
+      yield
+
+   @contextmanager
+   def parse_timer(self):
+      yield
+
+   upload_observer = None
+   decoding_sink = None
+
+   def reader(self, body):
+      return body
+
+   def upload_sink(self, sink, key):
+      return sink
+
+   def emit(self):
+      pass
+
+
+NULL_METRICS = _NullMetrics()
+
+
+class _TimedReader:
+   def __init__(self, body, metrics):
+      self._body = body
+      self._metrics = metrics
+
+   def read(self, *args):
+      start = time.perf_counter()
+      data = self._body.read(*args)
+      self._metrics.add('fetch', time.perf_counter() - start)
+      self._metrics.bytes_in += len(data)
+      return data
+
+
+class TimedSink:
+   """Sink wrapper that times writes as upload and counts the bytes stored for a part."""
+
+   def __init__(self, metrics, sink, key):
+      self.sink = sink
+      self._metrics = metrics
+      self._key = key
+
+   def write(self, data):
+      start = time.perf_counter()
+      self.sink.write(data)
+      self._elapsed(start)
+      self._metrics.count(self._key, bytes_out = len(data))
+
+   def close(self):
+      start = time.perf_counter()
+      try:
+         return self.sink.close()
+      finally:
+         self._elapsed(start)
+
+   def abort(self):
+      abort = getattr(self.sink, 'abort', None)
+      if abort:
+         abort()
+
+   def _elapsed(self, start):
+      seconds = time.perf_counter() - start
+      self._metrics._inline_upload += seconds
+      self._metrics.add('upload', seconds, self._key)
+
+
+class _DecodeTimer:
+   """Times a DecodingSink as decode, without the upload time of the sinks behind it."""
+
+   def __init__(self, metrics, sink, key):
+      self.sink = sink
+      self._metrics = metrics
+      self._key = key
+
+   def write(self, data):
+      self._metrics.count(self._key, bytes_in = len(data))
+      self._timed(self.sink.write, data)
+
+   def close(self):
+      return self._timed(self.sink.close)
+
+   def abort(self):
+      self.sink.abort()
+
+   def _timed(self, fn, *args):
+      start = time.perf_counter()
+      uploading = self._metrics._inline_upload
+      try:
+         return fn(*args)
+      finally:
+         seconds = time.perf_counter() - start - (self._metrics._inline_upload - uploading)
+         self._metrics.add('decode', max(seconds, 0.0), self._key)
+
+
+class EmfSink:
+   """Prints one CloudWatch Embedded Metric Format document per message to stdout.
+
+   The stage timings, byte counts and number of parts are metrics, with the
+   parser mode as dimension; the per-part details are kept as log properties
+   so they can be queried with CloudWatch Logs Insights.
+   """
+
+   def __init__(self, namespace='EmailParser', write=print):
+      self.namespace = namespace
+      self._write = write
+
+   def emit(self, record):
+      metrics = [{'Name': stage.capitalize() + 'Time', 'Unit': 'Milliseconds'} for stage in STAGES]
+      metrics += [{'Name': 'BytesIn', 'Unit': 'Bytes'}, {'Name': 'BytesOut', 'Unit': 'Bytes'}, {'Name': 'Parts', 'Unit': 'Count'}]
+      document = {
+         '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': self.namespace, 'Dimensions': [['Mode']], 'Metrics': metrics}],
+         },
+         'Mode': record['mode'],
+         'Message': record['message'],
+         'BytesIn': record['bytesIn'],
+         'BytesOut': record['bytesOut'],
+         'Parts': len(record['parts']),
+         'PartDetails': record['parts'],
+      }
+      for stage in STAGES:
+         document[stage.capitalize() + 'Time'] = record['ms'][stage]
+      self._write(json.dumps(document, separators=(',', ':')))
+
+
+class LogSink:
+   """Logs the record as JSON at INFO level."""
+
+   def __init__(self, namespace=None):
+      self._logger = logging.getLogger()
+
+   def emit(self, record):
+      self._logger.info(json.dumps(record, separators=(',', ':')))
+
+
+SINKS = {
+   'emf': EmfSink,
+   'log': LogSink,
+}
+
+
+def create_sink(name, namespace):
+   """Create the sink selected by metrics_sink, None for no metrics."""
+   if not name:
+      return None
+   if name not in SINKS:
+      raise ValueError(f"metrics_sink must be one of {', '.join(SINKS)}, not {name}")
+   return SINKS[name](namespace)
+
+
+def for_message(message, sink, mode):
+   """Start collecting the metrics of a message, NULL_METRICS when there is no sink."""
+   if sink is None:
+      return NULL_METRICS
+   return MessageMetrics(message, sink, mode)
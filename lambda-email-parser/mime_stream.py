@@ -0,0 +1,807 @@
+"""Incremental MIME parsing for the email parser Lambda functions.
+
+The python email library needs the whole message in memory and then decodes
+every part into another full copy. This module walks a message one line at a
+time instead: part headers are parsed with the standard library, but part
+bodies are transfer-decoded and handed to a sink (for example an S3 multipart
+upload) as they are read, so memory stays bounded by the chunk size.
+
+Parts are numbered in the same order as ``email.message.Message.walk()`` so the
+object keys written in streaming mode match the in-memory path.
+"""
+import binascii
+import codecs
+import re
+from email.header import Header
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# same header line test the python email feedparser uses
+_HEADER_RE = re.compile(rb'^(From |[\041-\071\073-\176]*:|[\t ])')
+_BASE64_JUNK_RE = re.compile(rb'[^A-Za-z0-9+/=]')
+
+
+def iter_chunks(body, chunk_size=DEFAULT_CHUNK_SIZE):
+   """Read a file-like object (S3 StreamingBody, WorkMail messageContent) in chunks.
+
+   :param body: object with a read(amt) method
+   :param chunk_size: maximum number of bytes per chunk
+   :return: generator of bytes
+   """
+   while True:
+      chunk = body.read(chunk_size)
+      if not chunk:
+         return
+      yield chunk
+
+
+def locate_parts(raw, max_line=DEFAULT_CHUNK_SIZE):
+   """Find the byte ranges of the MIME parts of a message held in memory, without decoding any of them.
+
+   :param raw: the raw message
+   :param max_line: maximum line length, see MimeStreamParser
+   :return: list of StreamedPart in walk order, with offsets into raw
+   """
+   return MimeStreamParser(lambda part: None, max_line).parse((raw,))
+
+
+def scan_parts(raw):
+   """Find the MIME parts of a message held in memory by jumping from boundary to boundary.
+
+   Only the header blocks are read a line at a time, bodies are skipped with
+   ``bytes.find`` for the next delimiter line of the enclosing multipart, and
+   no ``email.message.Message`` tree or payload is built. Parts are in
+   ``Message.walk()`` order, with the same offsets as ``locate_parts``.
+
+   :param raw: the raw message, bytes
+   :return: list of StreamedPart in walk order, with offsets into raw
+   """
+   return _Scanner(raw).scan()
+
+
+def decode_body(raw, part):
+   """Transfer-decode the body of a part found by scan_parts or locate_parts.
+
+   :param raw: the raw message the part was found in
+   :param part: StreamedPart
+   :return: the decoded content, a memoryview of raw for 7bit, 8bit and binary parts
+   """
+   decoder = transfer_decoder(part.get('content-transfer-encoding'))
+   body = memoryview(raw)[part.body_offset:part.end]
+   if isinstance(decoder, _IdentityDecoder):
+      return body
+   if isinstance(decoder, _Base64Decoder):
+      # the whole body is at hand, a2b_base64 skips the line breaks itself
+      try:
+         return binascii.a2b_base64(body)
+      except binascii.Error:
+         pass
+   return decoder.decode(body) + decoder.flush()
+
+
+def header_block_end(raw):
+   """Find where the top-level header block of a raw message ends, without parsing the rest of it.
+
+   :param raw: the raw message, a bytes-like object
+   :return: offset of the blank line that separates the headers from the body,
+            or the message length if there is no body
+   """
+   offset = 0
+   length = len(raw)
+   while offset < length:
+      newline = raw.find(b'\n', offset)
+      end = length if newline == -1 else newline + 1
+      line = bytes(raw[offset:end])
+      if not _HEADER_RE.match(line) or line.strip(b'\r\n') == b'':
+         return offset
+      offset = end
+   return length
+
+
+def rewrite_headers(header_block, replace=None, add=None):
+   """Replace and add headers in a raw header block, keeping every other line byte for byte.
+
+   The first header of each name in ``replace`` gets the new value, and is
+   added if the message doesn't have it; ``add`` headers are appended. New
+   values are folded and RFC 2047 encoded when they aren't ASCII.
+
+   :param header_block: raw top-level headers, see header_block_end
+   :param replace: mapping of header name to the new value
+   :param add: list of (name, value) headers to append
+   :return: the new header block as bytes
+   """
+   header_block = bytes(header_block)
+   linesep = '\r\n' if b'\r\n' in header_block else '\n'
+   replace = {name.lower(): (name, value) for name, value in (replace or {}).items()}
+   lines = []
+   skipping = False
+   for line in re.findall(rb'[^\n]*\n|[^\n]+$', header_block):
+      if line[:1] in (b' ', b'\t'):
+         # continuation line of the previous header
+         if not skipping:
+            lines.append(line)
+         continue
+      name = line.split(b':', 1)[0].strip().decode('ascii', 'replace').lower()
+      skipping = name in replace
+      if skipping:
+         lines.append(_header_line(*replace.pop(name), linesep))
+      else:
+         lines.append(line)
+   if lines and not lines[-1].endswith(b'\n'):
+      lines[-1] += linesep.encode('ascii')
+   for name, value in list(replace.values()) + list(add or []):
+      lines.append(_header_line(name, value, linesep))
+   return b''.join(lines)
+
+
+def _header_line(name, value, linesep):
+   value = str(value)
+   header = Header(value, None if value.isascii() else 'utf-8', header_name=name)
+   return f"{name}: {header.encode(linesep=linesep)}{linesep}".encode('ascii')
+
+
+class _Line:
+   __slots__ = ('content', 'eol', 'start', 'bol', 'level', 'close')
+
+   def __init__(self, content, eol, start, bol):
+      self.content = content
+      self.eol = eol
+      self.start = start
+      # False when this is the continuation of a line longer than the chunk size
+      self.bol = bol
+      # index of the multipart boundary this line matches, if any
+      self.level = None
+      self.close = False
+
+
+class _LineReader:
+   def __init__(self, chunks, max_line):
+      self._chunks = iter(chunks)
+      self._max_line = max(max_line, 1024)
+      self._buffer = b''
+      self._pos = 0
+      self._offset = 0
+      self._bol = True
+
+   def readline(self):
+      while True:
+         newline = self._buffer.find(b'\n', self._pos)
+         if newline != -1 and newline - self._pos < self._max_line:
+            end = newline + 1
+            break
+         if len(self._buffer) - self._pos >= self._max_line:
+            end = self._pos + self._max_line
+            # never split a CRLF pair across two pieces
+            if self._buffer[end - 1:end] == b'\r':
+               end -= 1
+            break
+         chunk = next(self._chunks, None)
+         if chunk is None:
+            if self._pos >= len(self._buffer):
+               return None
+            end = len(self._buffer)
+            break
+         self._buffer = self._buffer[self._pos:] + bytes(chunk)
+         self._pos = 0
+      data = self._buffer[self._pos:end]
+      self._pos = end
+      if data.endswith(b'\r\n'):
+         line = _Line(data[:-2], b'\r\n', self._offset, self._bol)
+      elif data.endswith(b'\n'):
+         line = _Line(data[:-1], b'\n', self._offset, self._bol)
+      else:
+         line = _Line(data, b'', self._offset, self._bol)
+      self._offset += len(data)
+      self._bol = bool(line.eol)
+      return line
+
+
+class _Base64Decoder:
+   def __init__(self):
+      self._pending = b''
+
+   def decode(self, data):
+      data = self._pending + _BASE64_JUNK_RE.sub(b'', data)
+      usable = len(data) - len(data) % 4
+      self._pending = data[usable:]
+      return binascii.a2b_base64(data[:usable]) if usable else b''
+
+   def flush(self):
+      data, self._pending = self._pending.rstrip(b'='), b''
+      if len(data) < 2:
+         return b''
+      return binascii.a2b_base64(data + b'=' * (-len(data) % 4))
+
+
+class _QuotedPrintableDecoder:
+   def __init__(self, max_pending=DEFAULT_CHUNK_SIZE):
+      self._pending = b''
+      self._max_pending = max_pending
+
+   def decode(self, data):
+      data = self._pending + data
+      # soft line breaks and =XX escapes never span a newline, so decode whole lines
+      cut = data.rfind(b'\n') + 1
+      if not cut and len(data) > self._max_pending:
+         cut = len(data) - 2
+      self._pending = data[cut:]
+      return binascii.a2b_qp(data[:cut]) if cut else b''
+
+   def flush(self):
+      data, self._pending = self._pending, b''
+      return binascii.a2b_qp(data) if data else b''
+
+
+class _UuDecoder:
+   def __init__(self):
+      self._pending = b''
+      self._done = False
+
+   def decode(self, data):
+      lines = (self._pending + data).split(b'\n')
+      self._pending = lines.pop()
+      return b''.join(self._decode_line(line) for line in lines)
+
+   def flush(self):
+      data, self._pending = self._pending, b''
+      return self._decode_line(data) if data else b''
+
+   def _decode_line(self, line):
+      line = line.rstrip(b'\r')
+      if self._done or not line.strip() or line.startswith(b'begin '):
+         return b''
+      if line.strip() == b'end':
+         self._done = True
+         return b''
+      try:
+         return binascii.a2b_uu(line)
+      except binascii.Error:
+         # same workaround the email library uses for broken encoders
+         nbytes = (((line[0] - 32) & 63) * 4 + 5) // 3
+         return binascii.a2b_uu(line[:nbytes])
+
+
+class _IdentityDecoder:
+   def decode(self, data):
+      return data
+
+   def flush(self):
+      return b''
+
+
+def transfer_decoder(cte):
+   """Return an incremental decoder for a Content-Transfer-Encoding value.
+
+   :param cte: header value, e.g. 'base64' or 'quoted-printable'
+   :return: object with decode(bytes) -> bytes and flush() -> bytes methods
+   """
+   cte = str(cte or '').strip().lower()
+   if cte == 'base64':
+      return _Base64Decoder()
+   if cte == 'quoted-printable':
+      return _QuotedPrintableDecoder()
+   if cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+      return _UuDecoder()
+   return _IdentityDecoder()
+
+
+class DecodingSink:
+   """Sink wrapper that applies a transfer decoder before writing to the wrapped sink."""
+
+   def __init__(self, sink, decoder):
+      self.sink = sink
+      self._decoder = decoder
+
+   def write(self, data):
+      decoded = self._decoder.decode(data)
+      if decoded:
+         self.sink.write(decoded)
+
+   def close(self):
+      decoded = self._decoder.flush()
+      if decoded:
+         self.sink.write(decoded)
+      return self.sink.close()
+
+   def abort(self):
+      abort = getattr(self.sink, 'abort', None)
+      if abort:
+         abort()
+
+
+class TranscodingSink:
+   """Sink wrapper that decodes text in the part charset and writes it as UTF-8.
+
+   This is the streaming equivalent of ``content.decode(charset)`` followed by
+   handing the ``str`` to ``put_object``.
+   """
+
+   def __init__(self, sink, charset, errors='strict'):
+      self.sink = sink
+      self._decoder = codecs.getincrementaldecoder(charset)(errors)
+
+   def write(self, data):
+      text = self._decoder.decode(data)
+      if text:
+         self.sink.write(text.encode('utf-8'))
+
+   def close(self):
+      text = self._decoder.decode(b'', final=True)
+      if text:
+         self.sink.write(text.encode('utf-8'))
+      return self.sink.close()
+
+   def abort(self):
+      abort = getattr(self.sink, 'abort', None)
+      if abort:
+         abort()
+
+
+class TeeSink:
+   """Sink wrapper that also keeps a copy of the data, up to ``limit`` bytes.
+
+   With a ``budget``, a dict whose ``'bytes'`` several sinks share, every
+   byte of the copy is taken from the budget as it is written, and the copy
+   is also dropped once the budget runs out, so all the copies together stay
+   within it. A dropped copy gives its bytes back.
+
+   ``data`` holds the copy after close, or None if the part was larger than ``limit`` or the budget.
+   """
+
+   def __init__(self, sink, limit, budget=None):
+      self.sink = sink
+      self.data = bytearray()
+      self._limit = limit
+      self._budget = budget
+
+   def write(self, data):
+      if self.data is not None:
+         if len(self.data) + len(data) > self._limit or (self._budget is not None and len(data) > self._budget['bytes']):
+            self._drop()
+         else:
+            self.data += data
+            if self._budget is not None:
+               self._budget['bytes'] -= len(data)
+      self.sink.write(data)
+
+   def _drop(self):
+      if self._budget is not None and self.data:
+         self._budget['bytes'] += len(self.data)
+      self.data = None
+
+   def close(self):
+      return self.sink.close()
+
+   def abort(self):
+      self._drop()
+      abort = getattr(self.sink, 'abort', None)
+      if abort:
+         abort()
+
+
+class StreamedPart:
+   """A MIME part found by MimeStreamParser.
+
+   Offers the same accessors as ``email.message.Message`` that the parser
+   functions use, backed by a header-only message. Byte offsets are relative
+   to the start of the raw message; ``end`` is filled in once the body has
+   been read.
+   """
+
+   def __init__(self, index, headers, depth, offset, body_offset):
+      self.index = index
+      self.headers = headers
+      self.depth = depth
+      self.offset = offset
+      self.body_offset = body_offset
+      self.end = None
+      self.children = []
+
+   def get_content_type(self):
+      return self.headers.get_content_type()
+
+   def get_content_maintype(self):
+      return self.headers.get_content_maintype()
+
+   def get_content_disposition(self):
+      return self.headers.get_content_disposition()
+
+   def get_content_charset(self):
+      return self.headers.get_content_charset()
+
+   def get_filename(self):
+      return self.headers.get_filename()
+
+   def get_boundary(self):
+      return self.headers.get_boundary()
+
+   def get(self, name, failobj=None):
+      return self.headers.get(name, failobj)
+
+   def items(self):
+      return self.headers.items()
+
+   def walk(self):
+      """This part and every part within it, like ``Message.walk()``."""
+      yield self
+      for child in self.children:
+         yield from child.walk()
+
+   def is_multipart(self):
+      if self.get_content_maintype() == 'multipart':
+         return self.get_boundary() is not None
+      # message/delivery-status parts hold a part for each of their header blocks, as with feedparser
+      return self.get_content_maintype() == 'message'
+
+
+class _Capture:
+   __slots__ = ('sink', 'pending_eol')
+
+   def __init__(self, sink):
+      self.sink = sink
+      self.pending_eol = b''
+
+
+class MimeStreamParser:
+   """Walk a MIME message from an iterable of byte chunks.
+
+   ``on_part(part)`` is called for every part in ``Message.walk()`` order with a
+   StreamedPart. It may return a sink (an object with ``write``/``close`` and
+   optionally ``abort``) to receive the part content: leaf parts are transfer
+   decoded, ``message/rfc822`` parts receive the raw bytes of the nested
+   message, and the return value is ignored for multipart containers. Like
+   feedparser, each block of header lines of a ``message/delivery-status``
+   part is a text/plain part of its own, which receives the raw body bytes.
+   ``decoding_sink(sink, decoder)`` creates the transfer decoding wrapper of a
+   leaf part right after ``on_part`` returned its sink, DecodingSink by default.
+   """
+
+   def __init__(self, on_part, max_line=DEFAULT_CHUNK_SIZE, decoding_sink=None):
+      self._on_part = on_part
+      self._max_line = max_line
+      self._decoding_sink = decoding_sink or DecodingSink
+      self._header_parser = BytesHeaderParser(policy=compat32)
+
+   def parse(self, chunks):
+      """Parse the whole message; sinks are aborted if anything fails.
+
+      :param chunks: iterable of bytes, e.g. iter_chunks(s3_body)
+      :return: list of every StreamedPart, in walk order
+      """
+      self._reader = _LineReader(chunks, self._max_line)
+      self._boundaries = []
+      self._captures = []
+      self._pushback = None
+      self._pending = None
+      self._content_end = 0
+      self._line_end = 0
+      self._parts = []
+      self._parent = None
+      try:
+         self._parse_entity('text/plain')
+      except BaseException:
+         for capture in reversed(self._captures):
+            abort = getattr(capture.sink, 'abort', None)
+            if abort:
+               abort()
+         raise
+      return self._parts
+
+   def _read(self):
+      if self._pushback is not None:
+         line, self._pushback = self._pushback, None
+         return line
+      line = self._reader.readline()
+      if line is None or not line.bol or not line.content.startswith(b'--'):
+         return line
+      for level in range(len(self._boundaries) - 1, -1, -1):
+         separator = self._boundaries[level]
+         if not line.content.startswith(separator):
+            continue
+         rest = line.content[len(separator):]
+         close = rest.startswith(b'--')
+         if close:
+            rest = rest[2:]
+         if not rest.strip(b' \t'):
+            line.level = level
+            line.close = close
+            break
+      return line
+
+   def _feed(self, line):
+      for capture in self._captures:
+         capture.sink.write(capture.pending_eol + line.content)
+         capture.pending_eol = line.eol
+      self._content_end = line.start + len(line.content)
+      self._line_end = self._content_end + len(line.eol)
+
+   def _read_body(self, block=False):
+      # consume lines up to the next boundary of any enclosing multipart, or EOF
+      while True:
+         line = self._read()
+         if line is None:
+            return
+         if line.level is not None:
+            self._pending = line
+            return
+         if block and line.bol and not line.content:
+            self._pushback = line
+            return
+         self._feed(line)
+
+   def _end_offset(self, body_offset):
+      if self._line_end <= body_offset:
+         return body_offset
+      # the line break before a boundary belongs to the boundary
+      return self._content_end if self._pending is not None else self._line_end
+
+   def _parse_entity(self, default_type, block=False):
+      # a block of a message/delivery-status part ends at the next blank line, which isn't part of it
+      offset = None
+      header_lines = []
+      body_offset = None
+      while True:
+         line = self._read()
+         if line is None:
+            break
+         if offset is None:
+            offset = line.start
+         if line.level is not None:
+            self._pending = line
+            body_offset = line.start
+            break
+         if not line.bol and header_lines:
+            header_lines[-1] += line.content + line.eol
+            self._feed(line)
+            continue
+         if not line.content:
+            if block:
+               self._pushback = line
+               body_offset = line.start
+               break
+            self._feed(line)
+            break
+         if not _HEADER_RE.match(line.content):
+            # missing blank line: the body starts here
+            self._pushback = line
+            body_offset = line.start
+            break
+         header_lines.append(line.content + line.eol)
+         self._feed(line)
+      if offset is None:
+         offset = self._line_end
+      if body_offset is None:
+         body_offset = self._line_end
+
+      headers = self._header_parser.parsebytes(b''.join(header_lines))
+      headers.set_default_type(default_type)
+      part = StreamedPart(len(self._parts) + 1, headers, len(self._boundaries), offset, body_offset)
+      self._parts.append(part)
+      if self._parent is not None:
+         self._parent.children.append(part)
+      sink = self._on_part(part)
+
+      parent, self._parent = self._parent, part
+      try:
+         if self._pending is not None:
+            # the part ended inside its header block
+            if sink is not None:
+               sink.close()
+         elif block:
+            self._parse_leaf(part, sink, block)
+         elif part.get_content_maintype() == 'multipart' and part.get_boundary() is not None:
+            self._parse_multipart(part)
+         elif part.get_content_type() == 'message/delivery-status':
+            self._parse_nested_message(part, sink, self._parse_blocks)
+         elif part.is_multipart():
+            self._parse_nested_message(part, sink)
+         else:
+            self._parse_leaf(part, sink)
+      finally:
+         self._parent = parent
+      part.end = self._end_offset(body_offset)
+      return part
+
+   def _parse_multipart(self, part):
+      child_type = 'message/rfc822' if part.get_content_type() == 'multipart/digest' else 'text/plain'
+      self._boundaries.append(b'--' + part.get_boundary().encode('ascii', 'surrogateescape'))
+      level = len(self._boundaries) - 1
+      # preamble
+      self._read_body()
+      while self._pending is not None and self._pending.level == level:
+         line, self._pending = self._pending, None
+         if line.close:
+            self._boundaries.pop()
+            self._feed(line)
+            # epilogue
+            self._read_body()
+            return
+         self._feed(line)
+         self._parse_entity(child_type)
+      self._boundaries.pop()
+
+   def _capture(self, sink, read):
+      capture = _Capture(sink)
+      self._captures.append(capture)
+      try:
+         read()
+      finally:
+         self._captures.pop()
+      if self._pending is None:
+         # reached the end of the message, keep the final line break
+         sink.write(capture.pending_eol)
+      return sink.close()
+
+   def _body_line(self):
+      # the next line of the body, None at a boundary or EOF
+      if self._pending is not None:
+         return None
+      line = self._read()
+      if line is not None and line.level is not None:
+         self._pending = line
+         return None
+      return line
+
+   def _parse_blocks(self):
+      # every block of header lines is a part, and a blank line ends a block. Like feedparser,
+      # the blank line is part of neither block and a second blank line is an empty block
+      while True:
+         self._parse_entity('text/plain', block=True)
+         blank = self._body_line()
+         if blank is None:
+            return
+         self._feed(blank)
+         line = self._body_line()
+         if line is None:
+            return
+         self._pushback = line
+
+   def _parse_nested_message(self, part, sink, read=None):
+      read = read or (lambda: self._parse_entity('text/plain'))
+      if sink is None:
+         read()
+      else:
+         self._capture(sink, read)
+
+   def _parse_leaf(self, part, sink, block=False):
+      read = lambda: self._read_body(block)
+      if sink is None:
+         read()
+      else:
+         self._capture(self._decoding_sink(sink, transfer_decoder(part.get('content-transfer-encoding'))), read)
+
+
+class _Scanner:
+   """See scan_parts."""
+
+   def __init__(self, raw):
+      self._raw = raw
+      self._parts = []
+      self._header_parser = BytesHeaderParser(policy=compat32)
+
+   def scan(self):
+      self._entity(0, len(self._raw), 'text/plain', 0, None)
+      return self._parts
+
+   def _entity(self, start, end, default_type, depth, parent):
+      header_end, body_offset = self._header_block(start, end)
+      headers = self._header_parser.parsebytes(self._raw[start:header_end])
+      headers.set_default_type(default_type)
+      part = StreamedPart(len(self._parts) + 1, headers, depth, start, body_offset)
+      part.end = end
+      self._parts.append(part)
+      if parent is not None:
+         parent.children.append(part)
+      if part.get_content_maintype() == 'multipart' and part.get_boundary() is not None:
+         self._multipart(part, depth)
+      elif part.get_content_type() == 'message/delivery-status':
+         self._blocks(part, depth)
+      elif part.is_multipart():
+         self._entity(body_offset, end, 'text/plain', depth, part)
+
+   def _blocks(self, part, depth):
+      # every block of header lines is a part, and a blank line ends a block. Like feedparser, the blank line
+      # is part of neither block and a second blank line is an empty block. feedparser reads the line break
+      # before a delimiter as a line of the body, so a body that ends with a blank line has an empty block too
+      raw = self._raw
+      end = part.end + len(self._line_break(part.end))
+      start = part.body_offset
+      while True:
+         header_end, body_offset = self._header_block(start, end)
+         if body_offset > header_end:
+            blank, after = header_end, body_offset
+            body_offset = header_end
+         else:
+            # missing blank line: the body runs to the next one
+            blank, after = self._blank_line(body_offset, end)
+         headers = self._header_parser.parsebytes(raw[start:header_end])
+         block = StreamedPart(len(self._parts) + 1, headers, depth, min(start, part.end), min(body_offset, part.end))
+         block.end = min(blank, part.end)
+         self._parts.append(block)
+         part.children.append(block)
+         if after >= end:
+            return
+         start = after
+
+   def _header_block(self, start, end):
+      # returns where the header lines end and where the body starts
+      raw = self._raw
+      offset = start
+      while offset < end:
+         newline = raw.find(b'\n', offset, end)
+         line_end = end if newline == -1 else newline + 1
+         line = raw[offset:line_end]
+         if line == b'\n' or line == b'\r\n':
+            return offset, line_end
+         if not _HEADER_RE.match(line):
+            # missing blank line: the body starts here
+            return offset, offset
+         offset = line_end
+      return end, end
+
+   def _blank_line(self, start, end):
+      # the offsets of the next blank line, or end
+      raw = self._raw
+      offset = start
+      while offset < end:
+         newline = raw.find(b'\n', offset, end)
+         line_end = end if newline == -1 else newline + 1
+         if raw[offset:line_end] in (b'\n', b'\r\n'):
+            return offset, line_end
+         offset = line_end
+      return end, end
+
+   def _line_break(self, offset):
+      if self._raw[offset:offset + 2] == b'\r\n':
+         return b'\r\n'
+      return self._raw[offset:offset + 1] if self._raw[offset:offset + 1] == b'\n' else b''
+
+   def _multipart(self, part, depth):
+      child_type = 'message/rfc822' if part.get_content_type() == 'multipart/digest' else 'text/plain'
+      delimiter = b'--' + part.get_boundary().encode('ascii', 'surrogateescape')
+      child_start = None
+      position = part.body_offset
+      while True:
+         found = self._delimiter(delimiter, position, part.end)
+         if found is None:
+            # no close delimiter, the last part runs to the end of its parent
+            if child_start is not None:
+               self._entity(child_start, part.end, child_type, depth + 1, part)
+            return
+         line_start, line_end, close = found
+         if child_start is not None:
+            # the line break before a delimiter belongs to the delimiter
+            self._entity(child_start, max(self._before_line_break(line_start), child_start), child_type, depth + 1, part)
+         if close:
+            return
+         child_start = position = line_end
+
+   def _delimiter(self, delimiter, position, end):
+      # the next line that is the delimiter, or the close delimiter, of a multipart
+      raw = self._raw
+      while True:
+         found = raw.find(delimiter, position, end)
+         if found == -1:
+            return None
+         position = found + len(delimiter)
+         if found and raw[found - 1] != 0x0a:
+            continue
+         newline = raw.find(b'\n', position, end)
+         line_end = end if newline == -1 else newline + 1
+         rest = raw[position:line_end if newline == -1 else newline]
+         if rest.endswith(b'\r'):
+            rest = rest[:-1]
+         close = rest.startswith(b'--')
+         if close:
+            rest = rest[2:]
+         if not rest.strip(b' \t'):
+            return found, line_end, close
+
+   def _before_line_break(self, offset):
+      if self._raw[offset - 2:offset] == b'\r\n':
+         return offset - 2
+      if self._raw[offset - 1:offset] == b'\n':
+         return offset - 1
+      return offset
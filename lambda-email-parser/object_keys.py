@@ -0,0 +1,112 @@
+"""Object keys of the stored parts.
+
+File names come from the message and can't be trusted. They may be encoded
+(RFC 2231 parameters, or RFC 2047 encoded words that many clients put in
+quoted parameters), contain path separators, control characters or the
+characters S3 recommends avoiding in keys, and be long enough to push a key
+past the 1024 byte limit of S3. KeyBuilder decodes them and turns them into a
+single, safe key component:
+
+- the name is normalised to NFC, and control, format and unassigned
+  characters, ``/``, ``\\`` and the characters to avoid are replaced with ``_``
+- runs of whitespace become one space, leading and trailing spaces and dots
+  are dropped
+- a name longer than ``max_filename_bytes`` UTF-8 bytes, or than what is left
+  of the key limit, is shortened and gets a hash of the full name before its
+  extension, so two long names with the same beginning still get two keys
+
+With ``partition_chars`` the key prefix of every message starts with that many
+hex characters of a hash of the message key, e.g. ``3f/mail/1/...``. S3 scales
+request rates per prefix, so a burst of messages under one prefix spreads over
+that many prefixes instead of throttling with 503 SlowDown.
+"""
+import email.errors
+import email.header
+import hashlib
+import posixpath
+import re
+import unicodedata
+
+# the longest object key S3 accepts, in UTF-8 bytes
+MAX_KEY_BYTES = 1024
+
+# hex characters of the hash appended to shortened names
+HASH_CHARS = 8
+
+# extensions longer than this aren't kept apart when a name is shortened
+_MAX_EXTENSION_BYTES = 16
+
+# path separators and the characters S3 recommends avoiding in keys
+_UNSAFE = re.compile(r'[\\/{}^%`\[\]"<>~#|]')
+_SPACES = re.compile(r'\s+')
+
+
+def decode_filename(filename):
+   """The file name with RFC 2047 encoded words decoded.
+
+   ``Message.get_filename`` already decodes RFC 2231 parameters, encoded words
+   aren't allowed in parameters but are common. Names that don't decode are
+   returned as they are.
+   """
+   if filename and '=?' in filename:
+      try:
+         return str(email.header.make_header(email.header.decode_header(filename)))
+      except (email.errors.HeaderParseError, LookupError, UnicodeError):
+         pass
+   return filename
+
+
+def sanitise(name):
+   """The name as a single key component of safe characters, '' when none are left."""
+   name = _SPACES.sub(' ', unicodedata.normalize('NFC', name))
+   # control, format, surrogate (undecodable bytes), private use and unassigned characters
+   name = ''.join('_' if unicodedata.category(c).startswith('C') else c for c in name)
+   return _UNSAFE.sub('_', name).strip(' .')
+
+
+def shorten(name, max_bytes):
+   """The name in at most max_bytes UTF-8 bytes; a shortened name ends with a hash of the full name, then its extension."""
+   encoded = name.encode('utf-8')
+   if len(encoded) <= max_bytes:
+      return name
+   digest = hashlib.sha256(encoded).hexdigest()[:HASH_CHARS]
+   stem, extension = posixpath.splitext(name)
+   if len(extension.encode('utf-8')) > _MAX_EXTENSION_BYTES:
+      stem, extension = name, ''
+   room = max_bytes - len(extension.encode('utf-8')) - len(digest) - 1
+   if room < 1:
+      return digest
+   # cut on a character boundary
+   stem = stem.encode('utf-8')[:room].decode('utf-8', 'ignore').rstrip(' .')
+   return f"{stem}-{digest}{extension}"
+
+
+class KeyBuilder:
+   """Builds the object keys of a message and its parts, see the module documentation."""
+
+   def __init__(self, max_filename_bytes=200, partition_chars=0):
+      self.max_filename_bytes = max_filename_bytes
+      self.partition_chars = partition_chars
+
+   def message_prefix(self, key):
+      """The key prefix of the parts of the message with this key or id."""
+      if not self.partition_chars:
+         return key
+      return hashlib.sha256(key.encode('utf-8')).hexdigest()[:self.partition_chars] + "/" + key
+
+   def _component(self, parent, name, fixed=0):
+      room = MAX_KEY_BYTES - len(parent.encode('utf-8')) - 1 - fixed
+      return shorten(name, max(min(self.max_filename_bytes, room), HASH_CHARS))
+
+   def part_name(self, key_prefix, part_idx, filename):
+      """The name of a part under key_prefix, filename is the decoded file name or the default name of the part."""
+      name = "mimepart" + str(part_idx) + "_"
+      return name + self._component(key_prefix, sanitise(filename) or "untitled", len(name))
+
+   def member_key(self, part_key, name):
+      """The key of an archive member, name is the relative path returned by ``archive_stage.member_name``."""
+      segments = [sanitise(segment) or "_" for segment in name.split('/')]
+      key = part_key
+      for segment in segments[:-1]:
+         key += "/" + shorten(segment, self.max_filename_bytes)
+      return key + "/" + self._component(key, segments[-1])
@@ -0,0 +1,319 @@
+"""Configuration and AWS clients shared by the email parser Lambda functions.
+
+The environment is read once per execution environment into a ParserConfig,
+and service clients are only created the first time a code path needs them,
+so an S3-only deployment never pays for the WorkMail client.
+"""
+import fnmatch
+import functools
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Mapping, Optional
+
+import boto3
+from botocore.config import Config
+
+import fan_out
+import metrics
+import part_rules
+from archive_stage import ArchiveLimits
+from object_keys import KeyBuilder
+from mime_stream import DEFAULT_CHUNK_SIZE
+from s3_writer import MIN_PART_SIZE
+
+# how text parts with a charset are stored: decoded to UTF-8 (failing on invalid bytes),
+# stored as the transfer-decoded bytes, or decoded to UTF-8 replacing invalid bytes
+CHARSET_MODES = ('decode', 'raw', 'normalize')
+
+# where parts up to small_part_threshold bytes go instead of an object of their own:
+# inlined in the manifest, or packed into one tar bundle per message
+SMALL_PART_MODES = ('manifest', 'bundle')
+
+# how the DMARC function writes the reports: the whole report as one JSON document,
+# or one row per record, as JSON lines or in a Parquet file
+DMARC_OUTPUTS = ('json', 'jsonl', 'parquet')
+
+
+class NameFilter:
+   """A comma separated list of names, matched case-insensitively.
+
+   Entries with ``*`` are wildcards, e.g. ``X-SES-*`` or ``image/*``. ``ALL``
+   matches every name.
+   """
+
+   def __init__(self, names):
+      names = [name for name in re.split(r',\s*', names.strip()) if name]
+      self.save_all = "ALL" in names
+      self.names = frozenset(name.casefold() for name in names if '*' not in name)
+      patterns = [fnmatch.translate(name.casefold()) for name in names if '*' in name]
+      self.pattern = re.compile('|'.join(patterns)) if patterns else None
+
+   def matches(self, name):
+      if self.save_all:
+         return True
+      name = name.casefold()
+      return name in self.names or (self.pattern is not None and self.pattern.match(name) is not None)
+
+
+class HeaderFilter(NameFilter):
+   """Header selection from the select_headers environment variable.
+
+   Names are matched case-insensitively and entries with ``*`` are wildcards,
+   e.g. ``From, Subject, X-SES-*, ARC-*``. ``ALL`` selects every header.
+   """
+
+   def select(self, all_headers):
+      if self.save_all:
+         return all_headers
+      return [this_header for this_header in all_headers if self.matches(this_header[0])]
+
+
+class PartFilter:
+   """The parts that are decoded and stored, from store_content_types and store_dispositions.
+
+   Content types may use wildcards, e.g. ``image/*, application/pdf``.
+   Dispositions are ``attachment``, ``inline``, or ``none`` for parts without
+   a Content-Disposition header. A part is stored when both lists match it.
+   The lists are applied as part rules, see ``part_rules.select``.
+   """
+
+   def __init__(self, content_types='ALL', dispositions='ALL'):
+      self.content_types = self._names(content_types)
+      self.dispositions = self._names(dispositions)
+      self._rules = part_rules.select(None, self.content_types, self.dispositions)
+
+   @staticmethod
+   def _names(names):
+      # None for ALL
+      names = [name for name in re.split(r',\s*', names.strip()) if name]
+      return None if 'ALL' in names else names
+
+   def accepts(self, content_type, disposition):
+      return self._rules is None or self._rules.decide(content_type, disposition) is True
+
+   def select(self, rule_set):
+      """The part_rules rule set narrowed to the parts the lists select."""
+      return part_rules.select(rule_set, self.content_types, self.dispositions)
+
+
+def _flag(environ, name):
+   return bool(environ.get(name))
+
+
+@dataclass(frozen=True)
+class ParserConfig:
+   destination_bucket: Optional[str] = None
+   select_headers: str = 'ALL'
+   modify_workmail_message: bool = False
+   streaming_mode: bool = False
+   scan_mode: bool = False
+   part_rules: str = ''
+   fan_out_mode: str = ''
+   fan_out_queue_url: Optional[str] = None
+   fan_out_function: Optional[str] = None
+   fan_out_min_size: int = 8 * 1024 * 1024
+   key_partition_chars: int = 0
+   key_filename_max_bytes: int = 200
+   stream_chunk_size: int = DEFAULT_CHUNK_SIZE
+   multipart_part_size: int = MIN_PART_SIZE
+   multipart_threshold: int = 8 * 1024 * 1024
+   multipart_concurrency: int = 4
+   batch_workers: int = 4
+   upload_workers: int = 8
+   s3_max_pool_connections: int = 12
+   dedup_parts: bool = False
+   dedup_min_size: int = 4096
+   write_manifest: bool = False
+   charset_mode: str = 'decode'
+   small_part_mode: str = ''
+   small_part_threshold: int = 16384
+   explode_nested: bool = False
+   nested_max_depth: int = 3
+   nested_max_bytes: int = 64 * 1024 * 1024
+   completion_markers: bool = False
+   metrics_sink: str = ''
+   metrics_namespace: str = 'EmailParser'
+   expand_archives: bool = False
+   archive_max_size: int = 64 * 1024 * 1024
+   archive_limits: ArchiveLimits = ArchiveLimits()
+   # used by the DMARC variant
+   dmarc_report_bucket: Optional[str] = None
+   dmarc_report_bucket_folder: Optional[str] = None
+   dmarc_output: str = 'json'
+   # aggregate reports are repetitive XML that compresses well past the archive_limits ratio
+   dmarc_archive_limits: ArchiveLimits = ArchiveLimits(max_ratio=1000.0)
+   dmarc_compaction_target_size: int = 128 * 1024 * 1024
+   source_bucket: Optional[str] = None
+   header_filter: Optional[HeaderFilter] = field(default=None, compare=False, repr=False)
+   part_filter: Optional[PartFilter] = field(default=None, compare=False, repr=False)
+   key_builder: KeyBuilder = field(default_factory=KeyBuilder, compare=False, repr=False)
+
+   @classmethod
+   def from_environ(cls, environ: Mapping[str, str] = os.environ) -> 'ParserConfig':
+      """Build the configuration from Lambda environment variables.
+
+      :param environ: environment mapping, os.environ by default
+      :return: ParserConfig
+      """
+      batch_workers = max(int(environ.get('batch_workers', 4)), 1)
+      upload_workers = max(int(environ.get('upload_workers', 8)), 1)
+      select_headers = str(environ.get('select_headers', 'ALL'))
+      store_content_types = str(environ.get('store_content_types', 'ALL'))
+      store_dispositions = str(environ.get('store_dispositions', 'ALL'))
+      charset_mode = environ.get('charset_mode', 'decode').strip().lower()
+      if charset_mode not in CHARSET_MODES:
+         raise ValueError(f"charset_mode must be one of {', '.join(CHARSET_MODES)}, not {charset_mode}")
+      metrics_sink = environ.get('metrics_sink', '').strip().lower()
+      if metrics_sink and metrics_sink not in metrics.SINKS:
+         raise ValueError(f"metrics_sink must be one of {', '.join(metrics.SINKS)}, not {metrics_sink}")
+      rules = environ.get('part_rules', '').strip()
+      if rules and not rules.startswith('s3://'):
+         # rules from S3 are checked when they are loaded
+         part_rules.parse(rules)
+      fan_out_mode = environ.get('fan_out_mode', '').strip().lower()
+      if fan_out_mode and fan_out_mode not in fan_out.DISPATCHERS:
+         raise ValueError(f"fan_out_mode must be one of {', '.join(fan_out.DISPATCHERS)}, not {fan_out_mode}")
+      key_partition_chars = int(environ.get('key_partition_chars', 0))
+      if not 0 <= key_partition_chars <= 8:
+         raise ValueError(f"key_partition_chars must be between 0 and 8, not {key_partition_chars}")
+      # room for the hash of a shortened name and a few characters of it
+      key_filename_max_bytes = max(int(environ.get('key_filename_max_bytes', 200)), 32)
+      dmarc_output = environ.get('dmarc_output', 'json').strip().lower()
+      if dmarc_output not in DMARC_OUTPUTS:
+         raise ValueError(f"dmarc_output must be one of {', '.join(DMARC_OUTPUTS)}, not {dmarc_output}")
+      small_part_mode = environ.get('small_part_mode', '').strip().lower()
+      if small_part_mode and small_part_mode not in SMALL_PART_MODES:
+         raise ValueError(f"small_part_mode must be one of {', '.join(SMALL_PART_MODES)}, not {small_part_mode}")
+      return cls(
+         destination_bucket = environ.get('destination_bucket'),
+         select_headers = select_headers,
+         modify_workmail_message = _flag(environ, 'modify_workmail_message'),
+         streaming_mode = _flag(environ, 'streaming_mode'),
+         scan_mode = _flag(environ, 'scan_mode'),
+         part_rules = rules,
+         fan_out_mode = fan_out_mode,
+         fan_out_queue_url = environ.get('fan_out_queue_url'),
+         # by default the coordinator invokes itself
+         fan_out_function = environ.get('fan_out_function', environ.get('AWS_LAMBDA_FUNCTION_NAME')),
+         fan_out_min_size = int(environ.get('fan_out_min_size', 8 * 1024 * 1024)),
+         key_partition_chars = key_partition_chars,
+         key_filename_max_bytes = key_filename_max_bytes,
+         stream_chunk_size = int(environ.get('stream_chunk_size', DEFAULT_CHUNK_SIZE)),
+         multipart_part_size = max(int(environ.get('multipart_part_size', MIN_PART_SIZE)), MIN_PART_SIZE),
+         multipart_threshold = int(environ.get('multipart_threshold', 8 * 1024 * 1024)),
+         multipart_concurrency = max(int(environ.get('multipart_concurrency', 4)), 1),
+         batch_workers = batch_workers,
+         upload_workers = upload_workers,
+         s3_max_pool_connections = int(environ.get('s3_max_pool_connections', batch_workers + upload_workers)),
+         dedup_parts = _flag(environ, 'dedup_parts'),
+         dedup_min_size = int(environ.get('dedup_min_size', 4096)),
+         write_manifest = _flag(environ, 'write_manifest'),
+         charset_mode = charset_mode,
+         small_part_mode = small_part_mode,
+         small_part_threshold = int(environ.get('small_part_threshold', 16384)),
+         explode_nested = _flag(environ, 'explode_nested'),
+         nested_max_depth = max(int(environ.get('nested_max_depth', 3)), 0),
+         nested_max_bytes = int(environ.get('nested_max_bytes', 64 * 1024 * 1024)),
+         completion_markers = _flag(environ, 'completion_markers'),
+         metrics_sink = metrics_sink,
+         metrics_namespace = environ.get('metrics_namespace', 'EmailParser'),
+         expand_archives = _flag(environ, 'expand_archives'),
+         archive_max_size = int(environ.get('archive_max_size', 64 * 1024 * 1024)),
+         archive_limits = ArchiveLimits(
+            max_members = int(environ.get('archive_max_members', ArchiveLimits.max_members)),
+            max_member_size = int(environ.get('archive_max_member_size', ArchiveLimits.max_member_size)),
+            max_ratio = float(environ.get('archive_max_ratio', ArchiveLimits.max_ratio)),
+         ),
+         dmarc_report_bucket = environ.get('dmarc_report_bucket'),
+         dmarc_report_bucket_folder = environ.get('dmarc_report_bucket_folder'),
+         dmarc_output = dmarc_output,
+         dmarc_archive_limits = ArchiveLimits(
+            max_members = int(environ.get('archive_max_members', ArchiveLimits.max_members)),
+            max_member_size = int(environ.get('dmarc_report_max_size', ArchiveLimits.max_member_size)),
+            max_ratio = float(environ.get('dmarc_report_max_ratio', 1000)),
+         ),
+         dmarc_compaction_target_size = int(environ.get('dmarc_compaction_target_size', 128 * 1024 * 1024)),
+         source_bucket = environ.get('source_bucket'),
+         # an empty select_headers saves no headers at all
+         header_filter = HeaderFilter(select_headers) if select_headers else None,
+         # every part is stored unless one of the lists is narrowed down
+         part_filter = (None if store_content_types == 'ALL' and store_dispositions == 'ALL'
+                        else PartFilter(store_content_types, store_dispositions)),
+         key_builder = KeyBuilder(key_filename_max_bytes, key_partition_chars),
+      )
+
+
+@functools.lru_cache(maxsize=None)
+def get_config() -> ParserConfig:
+   """The configuration of this execution environment, built on first use."""
+   return ParserConfig.from_environ()
+
+
+@functools.lru_cache(maxsize=None)
+def s3_client():
+   return boto3.client("s3", config=Config(max_pool_connections=get_config().s3_max_pool_connections))
+
+
+@functools.lru_cache(maxsize=None)
+def workmail_client():
+   return boto3.client('workmailmessageflow')
+
+
+@functools.lru_cache(maxsize=None)
+def sqs_client():
+   return boto3.client('sqs')
+
+
+@functools.lru_cache(maxsize=None)
+def lambda_client():
+   return boto3.client('lambda')
+
+
+@functools.lru_cache(maxsize=None)
+def fan_out_dispatcher():
+   """The dispatcher of fan_out_mode, None when large parts aren't fanned out."""
+   config = get_config()
+   if config.fan_out_mode == 'sqs':
+      return fan_out.SqsDispatcher(sqs_client(), config.fan_out_queue_url)
+   if config.fan_out_mode == 'invoke':
+      return fan_out.InvokeDispatcher(lambda_client(), config.fan_out_function)
+   return None
+
+
+@functools.lru_cache(maxsize=None)
+def metrics_sink():
+   """The sink selected with metrics_sink, None when metrics aren't collected."""
+   config = get_config()
+   return metrics.create_sink(config.metrics_sink, config.metrics_namespace)
+
+
+@functools.lru_cache(maxsize=None)
+def part_rule_set():
+   """The rules selected with part_rules, read from S3 for an s3:// URL, and store_content_types and
+   store_dispositions. None when there are no rules and every part is stored."""
+   config = get_config()
+   source = config.part_rules
+   rule_set = None
+   if source:
+      if source.startswith('s3://'):
+         bucket, _, key = source[len('s3://'):].partition('/')
+         source = s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+      rule_set = part_rules.parse(source)
+   if config.part_filter is not None:
+      rule_set = config.part_filter.select(rule_set)
+   return rule_set
+
+
+@functools.lru_cache(maxsize=None)
+def upload_executor():
+   """Thread pool shared by the part uploads of every message."""
+   return ThreadPoolExecutor(max_workers=get_config().upload_workers)
+
+
+def reset():
+   """Forget the cached configuration, clients and executor, e.g. after changing the environment in tests."""
+   for cached in (get_config, s3_client, workmail_client, sqs_client, lambda_client, fan_out_dispatcher, metrics_sink, part_rule_set,
+                  upload_executor):
+      cached.cache_clear()
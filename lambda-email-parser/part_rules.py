@@ -0,0 +1,185 @@
+"""Declarative rules for which MIME parts are decoded and stored.
+
+A rule set is a JSON document, set inline in the part_rules environment
+variable or stored in S3 (``part_rules=s3://bucket/key``)::
+
+   {"default": "include",
+    "rules": [
+       {"action": "exclude", "contentType": "image/*", "disposition": "inline", "maxSize": 4096},
+       {"action": "exclude", "filename": ["image0*.png", "*.p7s"]},
+       {"action": "include", "contentType": "application/pdf"}
+    ]}
+
+Rules are evaluated in order and the first rule whose conditions all match
+decides; ``default`` applies when no rule matches. A plain list is a rule set
+with the default ``include``. Conditions:
+
+- ``contentType``: content type, ``*`` wildcards, case-insensitive
+- ``disposition``: ``attachment``, ``inline``, or ``none`` for parts without one
+- ``filename``: file name pattern, case-insensitive; parts without a file name never match
+- ``minSize``, ``maxSize``: size of the part in bytes, inclusive
+
+Every condition but the sizes takes a single value or a list of them.
+Rules are evaluated before a part is decoded. When the decision depends on a
+size that isn't known yet, ``decide`` returns None and the caller asks again
+once it is.
+
+The store_content_types and store_dispositions lists are rules too:
+``select`` narrows a rule set to the parts the lists select. Every rule then
+only applies to those parts, the rule set's default to the selected parts no
+rule matches, and all other parts are excluded.
+"""
+import copy
+import fnmatch
+import json
+import re
+
+ACTIONS = {'include': True, 'exclude': False}
+_CONDITIONS = ('contentType', 'disposition', 'filename', 'minSize', 'maxSize')
+
+
+class _Discard:
+   """Sink for the parts that are excluded once their size is known."""
+
+   def write(self, data):
+      pass
+
+   def close(self):
+      return 0
+
+   def abort(self):
+      pass
+
+
+DISCARD = _Discard()
+
+
+class RuleError(ValueError):
+   """The rule set is not valid."""
+
+
+def _patterns(value, name):
+   values = [value] if isinstance(value, str) else value
+   if not isinstance(values, list) or not values or not all(isinstance(v, str) for v in values):
+      raise RuleError(f"{name} must be a string or a list of strings")
+   return re.compile('|'.join(fnmatch.translate(v.strip().casefold()) for v in values))
+
+
+def _size(value, name):
+   if value is None:
+      return None
+   if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+      raise RuleError(f"{name} must be a number of bytes")
+   return value
+
+
+class Rule:
+   """One include or exclude rule, see the module documentation for its conditions."""
+
+   def __init__(self, spec):
+      if not isinstance(spec, dict):
+         raise RuleError(f"A rule must be an object, not {spec!r}")
+      unknown = set(spec) - set(_CONDITIONS) - {'action'}
+      if unknown:
+         raise RuleError(f"Unknown rule conditions: {', '.join(sorted(unknown))}")
+      if spec.get('action') not in ACTIONS:
+         raise RuleError(f"action must be one of {', '.join(ACTIONS)}, not {spec.get('action')}")
+      self.include = ACTIONS[spec['action']]
+      # every pattern of a condition has to match, narrowed rules have more than one
+      self.content_type = [_patterns(spec['contentType'], 'contentType')] if 'contentType' in spec else []
+      self.disposition = [_patterns(spec['disposition'], 'disposition')] if 'disposition' in spec else []
+      self.filename = _patterns(spec['filename'], 'filename') if 'filename' in spec else None
+      self.min_size = _size(spec.get('minSize'), 'minSize')
+      self.max_size = _size(spec.get('maxSize'), 'maxSize')
+
+   def matches(self, content_type, disposition, filename, size):
+      """True or False, or None when only the unknown size can tell."""
+      if self.content_type and not all(pattern.match(content_type.casefold()) for pattern in self.content_type):
+         return False
+      if self.disposition and not all(pattern.match(str(disposition).casefold()) for pattern in self.disposition):
+         return False
+      if self.filename is not None and (not filename or not self.filename.match(filename.casefold())):
+         return False
+      if self.min_size is None and self.max_size is None:
+         return True
+      if size is None:
+         return None
+      return (self.min_size is None or size >= self.min_size) and (self.max_size is None or size <= self.max_size)
+
+   def narrowed(self, selection):
+      """A copy of the rule that also requires the contentType and disposition conditions of selection."""
+      selected = Rule({'action': 'include', **selection})
+      rule = copy.copy(self)
+      rule.content_type = self.content_type + selected.content_type
+      rule.disposition = self.disposition + selected.disposition
+      return rule
+
+
+class RuleSet:
+   def __init__(self, rules, default=True):
+      self.rules = rules
+      self.default = default
+      # a part larger than every size in the rules matches them all the same way
+      self.size_bound = max([size for rule in rules for size in (rule.min_size, rule.max_size) if size is not None], default=0)
+
+   def decide(self, content_type, disposition, filename=None, size=None):
+      """Whether a part is stored: True or False, or None when it depends on the size and size is None.
+
+      :param content_type: content type of the part
+      :param disposition: content disposition, None for parts without one
+      :param filename: file name of the part, if it has one
+      :param size: size of the part in bytes, None if it isn't known yet
+      """
+      for rule in self.rules:
+         matched = rule.matches(content_type, disposition, filename, size)
+         if matched is None:
+            return None
+         if matched:
+            return rule.include
+      return self.default
+
+
+def parse(document):
+   """Build a RuleSet from its JSON document.
+
+   :param document: JSON text or bytes
+   :return: RuleSet
+   :raises RuleError: if the document isn't a valid rule set
+   """
+   try:
+      spec = json.loads(document)
+   except ValueError as e:
+      raise RuleError(f"part_rules is not valid JSON: {e}") from e
+   if isinstance(spec, list):
+      spec = {'rules': spec}
+   if not isinstance(spec, dict) or not isinstance(spec.get('rules', []), list):
+      raise RuleError("part_rules must be a list of rules or an object with a rules list")
+   default = spec.get('default', 'include')
+   if default not in ACTIONS:
+      raise RuleError(f"default must be one of {', '.join(ACTIONS)}, not {default}")
+   return RuleSet([Rule(rule) for rule in spec.get('rules', [])], ACTIONS[default])
+
+
+def select(rule_set, content_types=None, dispositions=None):
+   """Narrow a rule set to the parts of some content types and dispositions, see the module documentation.
+
+   :param rule_set: RuleSet, None for no rules
+   :param content_types: content type patterns, None for all
+   :param dispositions: dispositions, ``none`` for parts without one, None for all
+   :return: RuleSet, or rule_set when neither list narrows it
+   """
+   selection = {}
+   if content_types is not None:
+      selection['contentType'] = content_types
+   if dispositions is not None:
+      selection['disposition'] = dispositions
+   if not selection:
+      return rule_set
+   if not all(selection.values()):
+      # an empty list selects nothing
+      return RuleSet([], default=False)
+   if rule_set is None:
+      rule_set = RuleSet([])
+   rules = [rule.narrowed(selection) for rule in rule_set.rules]
+   rules.append(Rule({'action': 'include' if rule_set.default else 'exclude', **selection}))
+   return RuleSet(rules, default=False)
@@ -0,0 +1,476 @@
+"""S3 upload helpers for the email parser Lambda functions."""
+import hashlib
+import io
+import json
+import logging
+import tarfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+# S3 rejects multipart upload parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# content addressed part payloads are stored under this prefix of the destination bucket
+BLOB_PREFIX = 'sha256/'
+
+# blobs known to exist, least recently used first, with the time they were last seen. A blob can be
+# removed behind the cache's back (a lifecycle rule), so entries older than BLOB_CACHE_TTL seconds are
+# checked again with a HEAD request, and at most BLOB_CACHE_SIZE entries are kept per execution environment
+BLOB_CACHE_SIZE = 10000
+BLOB_CACHE_TTL = 300
+_known_blobs = OrderedDict()
+_known_blobs_lock = threading.Lock()
+
+
+def is_not_found(error):
+   return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def head_object(s3, bucket, key):
+   """HEAD an object.
+
+   :return: the HeadObject response, or None if the object doesn't exist
+   """
+   try:
+      return s3.head_object(Bucket = bucket, Key = key)
+   except ClientError as e:
+      if is_not_found(e):
+         return None
+      raise
+
+
+def blob_exists(s3, bucket, key):
+   """Check whether a content addressed blob is already stored, using a HEAD request on a cache miss or expired entry.
+
+   :param s3: S3 boto3 client
+   :param bucket: bucket name
+   :param key: blob object key
+   :return: True if the object exists
+   """
+   with _known_blobs_lock:
+      seen = _known_blobs.get((bucket, key))
+      if seen is not None and time.monotonic() - seen < BLOB_CACHE_TTL:
+         _known_blobs.move_to_end((bucket, key))
+         return True
+   if head_object(s3, bucket, key) is None:
+      return False
+   remember_blob(bucket, key)
+   return True
+
+
+def remember_blob(bucket, key):
+   with _known_blobs_lock:
+      _known_blobs[(bucket, key)] = time.monotonic()
+      _known_blobs.move_to_end((bucket, key))
+      while len(_known_blobs) > BLOB_CACHE_SIZE:
+         _known_blobs.popitem(last=False)
+
+
+class BufferReader(io.RawIOBase):
+   """Seekable read-only file over a buffer, so a slice of a larger buffer can be uploaded without copying it first.
+
+   botocore accepts bytes or file objects as a ``Body`` but not a memoryview.
+   """
+
+   def __init__(self, buffer):
+      self._view = memoryview(buffer).cast('B')
+      self._pos = 0
+
+   def __len__(self):
+      return len(self._view)
+
+   def readable(self):
+      return True
+
+   def seekable(self):
+      return True
+
+   def readinto(self, b):
+      n = min(len(b), len(self._view) - self._pos)
+      b[:n] = self._view[self._pos:self._pos + n]
+      self._pos += n
+      return n
+
+   def seek(self, offset, whence=io.SEEK_SET):
+      if whence == io.SEEK_CUR:
+         offset += self._pos
+      elif whence == io.SEEK_END:
+         offset += len(self._view)
+      self._pos = max(offset, 0)
+      return self._pos
+
+   def tell(self):
+      return self._pos
+
+
+class UploadPool:
+   """Background S3 writes for one message on a shared ThreadPoolExecutor.
+
+   At most ``max_pending`` writes are queued or running at a time, ``submit``
+   blocks until a slot is free so buffered payloads can't pile up in memory.
+   ``observer(key, seconds)`` is called with the duration of every write.
+   """
+
+   def __init__(self, executor, max_pending, observer=None):
+      self.executor = executor
+      self._slots = threading.BoundedSemaphore(max(int(max_pending), 1))
+      self._futures = []
+      self._observer = observer
+
+   def submit(self, key, fn, *args, **kwargs):
+      if self._observer is not None:
+         fn = self._observed(key, fn)
+      self._slots.acquire()
+      try:
+         future = self.executor.submit(fn, *args, **kwargs)
+      except BaseException:
+         self._slots.release()
+         raise
+      future.add_done_callback(lambda _: self._slots.release())
+      self._futures.append((key, future))
+      return future
+
+   def put_object(self, s3, **kwargs):
+      return self.submit(kwargs['Key'], s3.put_object, **kwargs)
+
+   def _observed(self, key, fn):
+      def observed(*args, **kwargs):
+         start = time.perf_counter()
+         try:
+            return fn(*args, **kwargs)
+         finally:
+            self._observer(key, time.perf_counter() - start)
+      return observed
+
+   def wait(self):
+      """Wait for every submitted write.
+
+      :return: list of the object keys that failed to upload
+      """
+      failed = []
+      futures, self._futures = self._futures, []
+      for key, future in futures:
+         try:
+            future.result()
+         except Exception:
+            logger.exception(f"Failed to upload {key}")
+            failed.append(key)
+      return failed
+
+
+class S3StreamingUpload:
+   """Write-only sink that streams bytes into a single S3 object.
+
+   Data is buffered up to ``threshold`` bytes (``part_size`` by default).
+   Objects that never grow past it are stored with a plain ``put_object``;
+   larger ones are switched to a multipart upload of ``part_size`` parts so
+   memory stays bounded. Nothing is written for an empty object. With an
+   UploadPool the final write runs in the background and failures are
+   reported by ``UploadPool.wait``, and with ``concurrency`` above one up to
+   that many parts are uploaded in parallel on the pool's executor. With
+   ``hashed`` the SHA-256 of the object is available as ``digest`` after close.
+   """
+
+   def __init__(self, s3, bucket, key, part_size=MIN_PART_SIZE, pool=None, hashed=False, threshold=None, concurrency=1,
+                **put_args):
+      self.bucket = bucket
+      self.key = key
+      self.size = 0
+      self.digest = None
+      self._sha256 = hashlib.sha256() if hashed else None
+      self._s3 = s3
+      self._part_size = max(int(part_size), MIN_PART_SIZE)
+      self._threshold = self._part_size if threshold is None else int(threshold)
+      self._pool = pool
+      self._put_args = put_args
+      self._buffer = bytearray()
+      self._upload_id = None
+      self._parts = []
+      self._part_futures = []
+      self._next_part = 1
+      self._executor = pool.executor if pool is not None and concurrency > 1 else None
+      self._slots = threading.BoundedSemaphore(max(int(concurrency), 1))
+
+   def write(self, data):
+      if not data:
+         return
+      self._buffer += data
+      self.size += len(data)
+      if self._sha256 is not None:
+         self._sha256.update(data)
+      if self._upload_id is None and len(self._buffer) <= self._threshold:
+         return
+      offset = 0
+      while len(self._buffer) - offset >= self._part_size:
+         self._upload_part(bytes(self._buffer[offset:offset + self._part_size]))
+         offset += self._part_size
+      del self._buffer[:offset]
+
+   def close(self):
+      """Finish the object.
+
+      :return: number of bytes written
+      """
+      data, self._buffer = bytes(self._buffer), bytearray()
+      if self._sha256 is not None:
+         self.digest = self._sha256.hexdigest()
+      if self._pool is not None:
+         if self.size:
+            self._pool.submit(self.key, self._finish, data)
+      else:
+         self._finish(data)
+      return self.size
+
+   def _finish(self, data):
+      try:
+         if self._upload_id is None:
+            if self.size:
+               self._s3.put_object(Bucket = self.bucket, Key = self.key, Body = data, **self._put_args)
+         else:
+            # the last part is sent from this thread, it may be running on the executor itself
+            if data:
+               self._parts.append(self._send_part(self._next_part, data))
+            self._parts.extend(future.result() for future in self._part_futures)
+            self._parts.sort(key = lambda part: part['PartNumber'])
+            self._s3.complete_multipart_upload(Bucket = self.bucket, Key = self.key, UploadId = self._upload_id,
+                                               MultipartUpload = {'Parts': self._parts})
+            self._upload_id = None
+      except Exception:
+         self.abort()
+         raise
+
+   def abort(self):
+      self._buffer = bytearray()
+      # parts still in flight would be stored after the abort otherwise
+      for future in self._part_futures:
+         future.exception()
+      self._part_futures = []
+      if self._upload_id is not None:
+         logger.warning(f"Aborting multipart upload of s3://{self.bucket}/{self.key}")
+         self._s3.abort_multipart_upload(Bucket = self.bucket, Key = self.key, UploadId = self._upload_id)
+         self._upload_id = None
+
+   def _upload_part(self, data):
+      if self._upload_id is None:
+         response = self._s3.create_multipart_upload(Bucket = self.bucket, Key = self.key, **self._put_args)
+         self._upload_id = response['UploadId']
+      part_number = self._next_part
+      self._next_part += 1
+      if self._executor is None:
+         self._parts.append(self._send_part(part_number, data))
+         return
+      # blocks while `concurrency` parts are in flight, which bounds the buffered parts
+      self._slots.acquire()
+      try:
+         future = self._executor.submit(self._send_part, part_number, data)
+      except BaseException:
+         self._slots.release()
+         raise
+      future.add_done_callback(lambda _: self._slots.release())
+      self._part_futures.append(future)
+
+   def _send_part(self, part_number, data):
+      response = self._s3.upload_part(Bucket = self.bucket, Key = self.key, UploadId = self._upload_id,
+                                      PartNumber = part_number, Body = data)
+      return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+
+class StoredPart:
+   """Stands in for the upload of a part that an earlier attempt already stored.
+
+   Nothing is written; the content is only measured, and hashed with ``hashed``,
+   so the part can still be counted and described in the manifest.
+   """
+
+   def __init__(self, key, hashed=False):
+      self.key = key
+      self.size = 0
+      self.digest = None
+      self._sha256 = hashlib.sha256() if hashed else None
+
+   def write(self, data):
+      self.size += len(data)
+      if self._sha256 is not None:
+         self._sha256.update(data)
+
+   def close(self):
+      if self._sha256 is not None:
+         self.digest = self._sha256.hexdigest()
+      return self.size
+
+   def abort(self):
+      pass
+
+
+class TarBundle:
+   """Packs small parts of a message into one streamed tar object instead of one object per part.
+
+   Members are added as soon as a part is complete and the archive is written
+   through an S3StreamingUpload, so only the current member is held in memory.
+   """
+
+   def __init__(self, s3, bucket, key, pool=None):
+      self.key = key
+      self.members = 0
+      self._upload = S3StreamingUpload(s3, bucket, key, pool = pool, ContentType = 'application/x-tar')
+      self._tar = None
+
+   def add(self, name, data):
+      if self._tar is None:
+         self._tar = tarfile.open(fileobj = self._upload, mode = 'w|', format = tarfile.PAX_FORMAT)
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      info.mtime = int(time.time())
+      self._tar.addfile(info, io.BytesIO(data))
+      self.members += 1
+
+   def close(self):
+      if self._tar is not None:
+         self._tar.close()
+      return self._upload.close()
+
+   def abort(self):
+      self._upload.abort()
+
+
+class SizeRoutedSink:
+   """Routes a part by its size without knowing the size up front.
+
+   Up to ``threshold`` bytes are buffered. If the part grows past that, the
+   sink returned by ``open_large()`` is created and everything is streamed to
+   it; otherwise ``on_small(data)`` receives the whole part when it is closed.
+   """
+
+   def __init__(self, threshold, open_large, on_small):
+      self.size = 0
+      self.large = None
+      self._threshold = threshold
+      self._open_large = open_large
+      self._on_small = on_small
+      self._buffer = bytearray()
+
+   def write(self, data):
+      if not data:
+         return
+      self.size += len(data)
+      if self.large is not None:
+         self.large.write(data)
+         return
+      self._buffer += data
+      if len(self._buffer) > self._threshold:
+         self.large = self._open_large()
+         self.large.write(bytes(self._buffer))
+         self._buffer = bytearray()
+
+   def close(self):
+      if self.large is not None:
+         return self.large.close()
+      if self.size:
+         self._on_small(bytes(self._buffer))
+      self._buffer = bytearray()
+      return self.size
+
+   def abort(self):
+      self._buffer = bytearray()
+      if self.large is not None and hasattr(self.large, 'abort'):
+         self.large.abort()
+
+
+class ContentAddressedUpload:
+   """Write-only sink that stores a part once under ``sha256/<digest>``.
+
+   The payload is hashed while it is written. When it is complete the blob is
+   uploaded only if it isn't stored yet, and a small JSON pointer to the blob
+   is written at ``key``. Payloads larger than ``part_size`` are streamed into
+   a staging multipart upload that is dropped if the blob already exists, or
+   copied into place otherwise. Pass ``part_size=None`` when the payload is
+   already in memory. Parts smaller than ``min_size`` are stored at ``key`` as
+   is, since a pointer would cost as much as the part. ``put_args`` such as
+   ``Metadata`` apply to the stored payload.
+   """
+
+   def __init__(self, s3, bucket, key, part_size=MIN_PART_SIZE, pool=None, min_size=0, **put_args):
+      self.bucket = bucket
+      self.key = key
+      self.size = 0
+      self.digest = None
+      # False when the part was small enough to be stored in place
+      self.deduplicated = False
+      self._s3 = s3
+      self._part_size = part_size
+      self._pool = pool
+      self._min_size = min_size
+      self._put_args = put_args
+      self._sha256 = hashlib.sha256()
+      self._chunks = []
+      self._buffered = 0
+      self._staging = None
+
+   @property
+   def blob_key(self):
+      return BLOB_PREFIX + self.digest if self.deduplicated else None
+
+   def write(self, data):
+      if not data:
+         return
+      data = bytes(data)
+      self._sha256.update(data)
+      self.size += len(data)
+      if self._staging is not None:
+         self._staging.write(data)
+         return
+      self._chunks.append(data)
+      self._buffered += len(data)
+      if self._part_size is not None and self._buffered >= self._part_size:
+         staging_key = BLOB_PREFIX + 'staging/' + str(uuid.uuid4())
+         self._staging = S3StreamingUpload(self._s3, self.bucket, staging_key, self._part_size, **self._put_args)
+         for chunk in self._chunks:
+            self._staging.write(chunk)
+         self._chunks = []
+
+   def close(self):
+      """Finish the part.
+
+      :return: number of bytes written
+      """
+      if not self.size:
+         return 0
+      self.digest = self._sha256.hexdigest()
+      self.deduplicated = self._staging is not None or self.size >= self._min_size
+      data, self._chunks = b''.join(self._chunks), []
+      if self._pool is not None:
+         self._pool.submit(self.key, self._finish, data)
+      else:
+         self._finish(data)
+      return self.size
+
+   def abort(self):
+      self._chunks = []
+      if self._staging is not None:
+         self._staging.abort()
+
+   def _finish(self, data):
+      if not self.deduplicated:
+         self._s3.put_object(Bucket = self.bucket, Key = self.key, Body = data, **self._put_args)
+         return
+      if blob_exists(self._s3, self.bucket, self.blob_key):
+         if self._staging is not None:
+            self._staging.abort()
+      elif self._staging is None:
+         self._s3.put_object(Bucket = self.bucket, Key = self.blob_key, Body = data, **self._put_args)
+      else:
+         self._staging.close()
+         try:
+            self._s3.copy({'Bucket': self.bucket, 'Key': self._staging.key}, self.bucket, self.blob_key)
+         finally:
+            self._s3.delete_object(Bucket = self.bucket, Key = self._staging.key)
+      remember_blob(self.bucket, self.blob_key)
+      pointer = {'bucket': self.bucket, 'key': self.blob_key, 'sha256': self.digest, 'size': self.size}
+      self._s3.put_object(Bucket = self.bucket, Key = self.key, Body = json.dumps(pointer),
+                          ContentType = 'application/json', Metadata = {'sha256': self.digest})
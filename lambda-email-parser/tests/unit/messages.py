@@ -0,0 +1,164 @@
+import gzip
+import io
+import zipfile
+
+from email.message import Message
+from email.mime.application import MIMEApplication
+from email.mime.base import MIMEBase
+from email.mime.image import MIMEImage
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+def forwarded_message():
+   inner = MIMEMultipart('mixed')
+   inner['From'] = 'inner@example.com'
+   inner['Subject'] = 'Inner'
+   inner.attach(MIMEText('inner body\n', 'plain'))
+   inner.attach(MIMEApplication(b'%PDF-1.4 inner attachment', Name='inner.pdf'))
+   inner.get_payload()[1].add_header('Content-Disposition', 'attachment', filename='inner.pdf')
+   return inner
+
+
+def complex_message():
+   """multipart/mixed with alternative and related bodies, a binary attachment and a forwarded message."""
+   msg = MIMEMultipart('mixed')
+   msg['From'] = 'sender@example.com'
+   msg['To'] = 'recipient@example.com'
+   msg['Subject'] = 'Quarterly report'
+   msg['X-SES-Spam-Verdict'] = 'PASS'
+
+   alternative = MIMEMultipart('alternative')
+   alternative.attach(MIMEText('Caf\xe9 ol\xe9 ' * 40 + '\n', 'plain', 'iso-8859-1'))
+   related = MIMEMultipart('related')
+   related.attach(MIMEText('<html><body><img src="cid:logo"></body></html>', 'html', 'utf-8'))
+   logo = MIMEImage(bytes(range(256)) * 20, 'png')
+   logo.add_header('Content-ID', '<logo>')
+   related.attach(logo)
+   alternative.attach(related)
+   msg.attach(alternative)
+
+   attachment = MIMEApplication(bytes(range(256)) * 300, Name='report.bin')
+   attachment.add_header('Content-Disposition', 'attachment', filename='report.bin')
+   msg.attach(attachment)
+   msg.attach(MIMEMessage(forwarded_message()))
+   return msg
+
+
+def bounce_message():
+   """multipart/report with a delivery-status of two header blocks, returning complex_message as the original."""
+   msg = MIMEMultipart('report', report_type='delivery-status')
+   msg['From'] = 'MAILER-DAEMON@example.com'
+   msg['To'] = 'sender@example.com'
+   msg['Subject'] = 'Undelivered Mail Returned to Sender'
+   msg.attach(MIMEText('The message could not be delivered.\n', 'plain'))
+   blocks = []
+   for fields in ({'Reporting-MTA': 'dns; mx.example.com'},
+                  {'Final-Recipient': 'rfc822; gone@example.com', 'Action': 'failed', 'Status': '5.1.1'}):
+      block = Message()
+      for name, value in fields.items():
+         block[name] = value
+      blocks.append(block)
+   status = MIMEBase('message', 'delivery-status')
+   status.set_payload(blocks)
+   msg.attach(status)
+   msg.attach(MIMEMessage(complex_message()))
+   return msg
+
+
+def dmarc_report(records=2, org_name='google.com', begin=1760659200):
+   """A DMARC aggregate report with ``records`` records."""
+   rows = ''.join(f"""
+  <record>
+    <row>
+      <source_ip>192.0.2.{n % 256}</source_ip>
+      <count>{n + 1}</count>
+      <policy_evaluated>
+        <disposition>none</disposition>
+        <dkim>pass</dkim>
+        <spf>{'pass' if n % 2 else 'fail'}</spf>
+      </policy_evaluated>
+    </row>
+    <identifiers>
+      <header_from>example.com</header_from>
+    </identifiers>
+    <auth_results>
+      <dkim>
+        <domain>example.com</domain>
+        <result>pass</result>
+        <selector>s1</selector>
+      </dkim>
+      <spf>
+        <domain>bounce.example.com</domain>
+        <result>{'pass' if n % 2 else 'fail'}</result>
+      </spf>
+    </auth_results>
+  </record>""" for n in range(records))
+   return f"""<?xml version="1.0" encoding="UTF-8" ?>
+<feedback>
+  <report_metadata>
+    <org_name>{org_name}</org_name>
+    <email>noreply-dmarc-support@{org_name}</email>
+    <report_id>{begin}-{records}</report_id>
+    <date_range>
+      <begin>{begin}</begin>
+      <end>{begin + 86399}</end>
+    </date_range>
+  </report_metadata>
+  <policy_published>
+    <domain>example.com</domain>
+    <adkim>r</adkim>
+    <aspf>r</aspf>
+    <p>none</p>
+    <sp>none</sp>
+    <pct>100</pct>
+  </policy_published>{rows}
+</feedback>
+""".encode('utf-8')
+
+
+def dmarc_message(records=2, report=None):
+   """A report email with a gzip compressed report, ``dmarc_report(records)`` by default, and an uncompressed one."""
+   msg = MIMEMultipart('mixed')
+   msg['From'] = 'noreply-dmarc-support@google.com'
+   msg['Subject'] = 'Report domain: example.com'
+   msg.attach(MIMEText('This is an aggregate report from google.com.\n', 'plain'))
+   compressed = MIMEApplication(gzip.compress(report or dmarc_report(records)), 'gzip', Name='google.com!example.com.xml.gz')
+   compressed.add_header('Content-Disposition', 'attachment', filename='google.com!example.com.xml.gz')
+   msg.attach(compressed)
+   plain = MIMEApplication(dmarc_report(records, 'yahoo.com'), 'xml', Name='yahoo.com!example.com.xml')
+   plain.replace_header('Content-Type', 'text/xml; name="yahoo.com!example.com.xml"')
+   plain.add_header('Content-Disposition', 'attachment', filename='yahoo.com!example.com.xml')
+   msg.attach(plain)
+   return msg
+
+
+def mislabelled_dmarc_message(records=2):
+   """A report email with a zip and a gzip compressed report sent as application/octet-stream, and a text attachment."""
+   msg = MIMEMultipart('mixed')
+   msg['From'] = 'dmarcreport@microsoft.com'
+   msg['Subject'] = 'Report domain: example.com'
+   buffer = io.BytesIO()
+   with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+      archive.writestr('microsoft.com!example.com.xml', dmarc_report(records, 'microsoft.com'))
+   attachments = [(buffer.getvalue(), 'microsoft.com!example.com.zip'),
+                  (gzip.compress(dmarc_report(records)), 'google.com!example.com.xml.gz'),
+                  (b'<html>not a report</html>', 'notes.xml')]
+   for content, filename in attachments:
+      attachment = MIMEApplication(content, 'octet-stream', Name=filename)
+      attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+      msg.attach(attachment)
+   return msg
+
+
+def unnamed_dmarc_message(records=2):
+   """A report email with gzip compressed reports without a name and with a name that isn't .gz."""
+   msg = MIMEMultipart('mixed')
+   msg['From'] = 'noreply-dmarc-support@google.com'
+   msg['Subject'] = 'Report domain: example.com'
+   msg.attach(MIMEApplication(gzip.compress(dmarc_report(records)), 'octet-stream'))
+   misnamed = MIMEApplication(gzip.compress(dmarc_report(records, 'yahoo.com')), 'gzip', Name='yahoo.com!example.com.xml')
+   misnamed.add_header('Content-Disposition', 'attachment', filename='yahoo.com!example.com.xml')
+   msg.attach(misnamed)
+   return msg
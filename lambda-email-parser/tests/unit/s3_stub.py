@@ -0,0 +1,82 @@
+import io
+import itertools
+
+from botocore.exceptions import ClientError
+
+
+class StubS3Client:
+   """Minimal in-memory stand-in for the boto3 S3 client calls the parser makes."""
+
+   def __init__(self):
+      self.objects = {}
+      self.metadata = {}
+      self.calls = []
+      self.failing_keys = set()
+      self._uploads = {}
+      self._upload_ids = itertools.count(1)
+
+   def _body(self, body):
+      if isinstance(body, str):
+         return body.encode('utf-8')
+      if hasattr(body, 'read'):
+         return body.read()
+      return bytes(body)
+
+   def put_object(self, Bucket, Key, Body=b'', **kwargs):
+      self.calls.append(('put_object', Key))
+      if Key in self.failing_keys:
+         raise IOError(f"Simulated failure writing {Key}")
+      self.objects[(Bucket, Key)] = self._body(Body)
+      self.metadata[(Bucket, Key)] = kwargs.get('Metadata', {})
+      return {'ETag': '"stub"'}
+
+   def get_object(self, Bucket, Key, **kwargs):
+      self.calls.append(('get_object', Key))
+      if (Bucket, Key) not in self.objects:
+         raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, 'GetObject')
+      body = self.objects[(Bucket, Key)]
+      if 'Range' in kwargs:
+         start, end = kwargs['Range'][len('bytes='):].split('-')
+         body = body[int(start):int(end) + 1]
+      return {'Body': io.BytesIO(body)}
+
+   def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+      self.calls.append(('list_objects_v2', Prefix))
+      keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+      return {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in keys], 'IsTruncated': False}
+
+   def head_object(self, Bucket, Key, **kwargs):
+      self.calls.append(('head_object', Key))
+      if (Bucket, Key) not in self.objects:
+         raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+      return {'ContentLength': len(self.objects[(Bucket, Key)]), 'Metadata': self.metadata.get((Bucket, Key), {})}
+
+   def delete_object(self, Bucket, Key, **kwargs):
+      self.calls.append(('delete_object', Key))
+      self.objects.pop((Bucket, Key), None)
+
+   def copy(self, CopySource, Bucket, Key, **kwargs):
+      self.calls.append(('copy', Key))
+      self.objects[(Bucket, Key)] = self.objects[(CopySource['Bucket'], CopySource['Key'])]
+      self.metadata[(Bucket, Key)] = self.metadata.get((CopySource['Bucket'], CopySource['Key']), {})
+
+   def create_multipart_upload(self, Bucket, Key, **kwargs):
+      self.calls.append(('create_multipart_upload', Key))
+      upload_id = str(next(self._upload_ids))
+      self._uploads[upload_id] = {'metadata': kwargs.get('Metadata', {})}
+      return {'UploadId': upload_id}
+
+   def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+      self.calls.append(('upload_part', Key))
+      self._uploads[UploadId][PartNumber] = self._body(Body)
+      return {'ETag': f'"{PartNumber}"'}
+
+   def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+      self.calls.append(('complete_multipart_upload', Key))
+      parts = self._uploads.pop(UploadId)
+      self.objects[(Bucket, Key)] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+      self.metadata[(Bucket, Key)] = parts['metadata']
+
+   def abort_multipart_upload(self, Bucket, Key, UploadId):
+      self.calls.append(('abort_multipart_upload', Key))
+      self._uploads.pop(UploadId, None)
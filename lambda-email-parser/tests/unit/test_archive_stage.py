@@ -0,0 +1,87 @@
+import gzip
+import io
+import tarfile
+import unittest
+import zipfile
+
+import archive_stage
+
+
+def zip_archive(members):
+   buffer = io.BytesIO()
+   with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+      for name, data in members.items():
+         archive.writestr(name, data)
+   return buffer.getvalue()
+
+
+def tar_archive(members, mode='w:gz'):
+   buffer = io.BytesIO()
+   with tarfile.open(fileobj = buffer, mode = mode) as tar:
+      for name, data in members.items():
+         info = tarfile.TarInfo(name)
+         info.size = len(data)
+         tar.addfile(info, io.BytesIO(data))
+   return buffer.getvalue()
+
+
+class TestExpand(unittest.TestCase):
+   def expand(self, archive, content_type, filename, **limits):
+      sinks = {}
+
+      def open_sink(name):
+         sinks[name] = archive_stage.BytesSink()
+         return sinks[name]
+
+      expanded = archive_stage.expand(archive, content_type, filename, open_sink, archive_stage.ArchiveLimits(**limits))
+      return expanded, {name: bytes(sink.data) for name, sink in sinks.items()}
+
+   def test_zip(self):
+      expanded, members = self.expand(zip_archive({'a.xml': b'<a/>', 'dir/b.txt': b'b' * 5000}), 'application/zip', 'r.zip')
+      self.assertEqual(expanded, [('a.xml', 4), ('dir/b.txt', 5000)])
+      self.assertEqual(members['dir/b.txt'], b'b' * 5000)
+
+   def test_tar_gz_is_not_a_single_gzip_file(self):
+      expanded, members = self.expand(tar_archive({'report.xml': b'<r/>'}), 'application/gzip', 'reports.tar.gz')
+      self.assertEqual(members, {'report.xml': b'<r/>'})
+
+   def test_gzip(self):
+      expanded, members = self.expand(gzip.compress(b'<feedback/>'), 'application/octet-stream', 'report.xml.gz')
+      self.assertEqual(members, {'report.xml': b'<feedback/>'})
+
+   def test_sniff(self):
+      self.assertEqual(archive_stage.sniff(gzip.compress(b'<feedback/>')), 'application/gzip')
+      self.assertEqual(archive_stage.sniff(zip_archive({'a.xml': b'<a/>'})), 'application/zip')
+      self.assertEqual(archive_stage.sniff(zip_archive({})), 'application/zip')
+      self.assertEqual(archive_stage.sniff(tar_archive({'a.xml': b'<a/>'}, 'w')), 'application/x-tar')
+      self.assertIsNone(archive_stage.sniff(b'<?xml version="1.0"?><feedback/>'))
+      self.assertIsNone(archive_stage.sniff(b''))
+
+   def test_other_attachments_are_not_expanded(self):
+      self.assertEqual(self.expand(b'%PDF', 'application/pdf', 'a.pdf'), (None, {}))
+
+   def test_member_names_stay_below_the_prefix(self):
+      _, members = self.expand(zip_archive({'../../etc/passwd': b'x', '/abs/path': b'y', 'a/../../b': b'z'}), 'application/zip', 'r.zip')
+      self.assertEqual(sorted(members), ['abs/path'])
+
+   def test_limits(self):
+      archive = zip_archive({f'{i}.txt': b'0' * 10000 for i in range(5)})
+      for limits in ({'max_members': 3}, {'max_member_size': 9999}, {'max_ratio': 2}):
+         with self.subTest(**limits):
+            with self.assertRaises(archive_stage.ArchiveLimitExceeded):
+               self.expand(archive, 'application/zip', 'r.zip', **limits)
+
+   def test_bomb_is_stopped_while_reading(self):
+      bomb = gzip.compress(b'\0' * (64 * 1024 * 1024))
+      sink = archive_stage.BytesSink()
+      with self.assertRaises(archive_stage.ArchiveLimitExceeded):
+         archive_stage.expand(bomb, 'application/gzip', 'bomb.gz', lambda name: sink)
+      self.assertLess(len(sink.data), 100 * len(bomb) + archive_stage.READ_SIZE)
+
+   def test_corrupt_archive(self):
+      with self.assertRaises(archive_stage.ArchiveError):
+         self.expand(b'PK not really a zip', 'application/zip', 'r.zip')
+
+
+if __name__ == '__main__':
+   unittest.main()
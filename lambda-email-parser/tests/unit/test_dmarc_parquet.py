@@ -0,0 +1,104 @@
+import io
+import json
+import unittest
+
+import archive_stage
+import dmarc_parquet
+import dmarc_report
+
+from tests.unit.messages import dmarc_report as report_xml
+from tests.unit.s3_stub import StubS3Client
+
+if dmarc_parquet.pyarrow is not None:
+   import pyarrow.parquet
+
+
+def parquet_of(xml, row_group_size=dmarc_parquet.ROW_GROUP_SIZE):
+   sink = archive_stage.BytesSink()
+   opened = []
+   rows = dmarc_report.ReportRows(dmarc_parquet.ParquetRows(lambda row: opened.append(row) or sink, row_group_size))
+   rows.write(xml)
+   rows.close()
+   return bytes(sink.data), opened
+
+
+@unittest.skipIf(dmarc_parquet.pyarrow is None, "pyarrow is not installed")
+class TestParquetRows(unittest.TestCase):
+   def test_typed_columns(self):
+      data, opened = parquet_of(report_xml(3))
+      self.assertEqual(opened[0]['org_name'], 'google.com')
+      table = pyarrow.parquet.read_table(io.BytesIO(data))
+      self.assertNotIn('org_name', table.column_names)
+      self.assertEqual(str(table.schema.field('count').type), 'int64')
+      self.assertEqual(str(table.schema.field('date_begin').type), 'timestamp[ms, tz=UTC]')
+      row = table.to_pylist()[1]
+      self.assertEqual((row['source_ip'], row['count'], row['spf'], row['policy_pct']), ('192.0.2.1', 2, 'pass', 100))
+      self.assertEqual(row['dkim_results'], [{'domain': 'example.com', 'selector': 's1', 'result': 'pass'}])
+      self.assertEqual(row['date_begin'].isoformat(), '2025-10-17T00:00:00+00:00')
+
+   def test_row_groups(self):
+      data, _ = parquet_of(report_xml(5), row_group_size=2)
+      metadata = pyarrow.parquet.read_metadata(io.BytesIO(data))
+      self.assertEqual((metadata.num_rows, metadata.num_row_groups), (5, 3))
+
+   def test_no_records_no_file(self):
+      self.assertEqual(parquet_of(report_xml(0)), (b'', []))
+
+
+class TestPartitions(unittest.TestCase):
+   def test_partition(self):
+      self.assertEqual(dmarc_parquet.partition({'date_begin': 1760659200, 'org_name': 'google.com'}),
+                       'report_date=2025-10-17/org_name=google.com')
+      self.assertEqual(dmarc_parquet.partition({'date_begin': None, 'org_name': 'a/b=c'}),
+                       'report_date=__HIVE_DEFAULT_PARTITION__/org_name=a%2Fb%3Dc')
+
+   def test_object_key(self):
+      row = {'date_begin': 1760659200, 'org_name': 'google.com', 'report_id': '1234/5'}
+      self.assertEqual(dmarc_parquet.object_key('dmarc', row, 'mail/1/x.xml'),
+                       'dmarc/report_date=2025-10-17/org_name=google.com/1234_5.parquet')
+
+
+@unittest.skipIf(dmarc_parquet.pyarrow is None, "pyarrow is not installed")
+class TestCompaction(unittest.TestCase):
+   prefix = 'dmarc/report_date=2025-10-17/org_name=google.com/'
+
+   def setUp(self):
+      self.s3 = StubS3Client()
+      for n in range(3):
+         self.s3.objects[('reports', f'{self.prefix}{n}.parquet')] = parquet_of(report_xml(n + 1))[0]
+
+   def stored(self):
+      return sorted(key for bucket, key in self.s3.objects if bucket == 'reports')
+
+   def test_files_are_merged(self):
+      self.assertEqual(dmarc_parquet.compact(self.s3, 'reports', self.prefix), (3, 1))
+      merged, = self.stored()
+      self.assertTrue(merged.startswith(self.prefix + 'compacted-'))
+      table = pyarrow.parquet.read_table(io.BytesIO(self.s3.objects[('reports', merged)]))
+      self.assertEqual(table.num_rows, 6)
+      # nothing left to merge
+      self.assertEqual(dmarc_parquet.compact(self.s3, 'reports', self.prefix), (0, 0))
+
+   def test_target_size(self):
+      size = len(self.s3.objects[('reports', self.prefix + '2.parquet')])
+      merged, written = dmarc_parquet.compact(self.s3, 'reports', self.prefix, target_size=size + 1)
+      self.assertEqual((merged, written), (0, 0))
+
+   def test_interrupted_compaction_is_finished(self):
+      target = self.prefix + 'compacted-0.parquet'
+      self.s3.objects[('reports', target)] = self.s3.objects[('reports', self.prefix + '0.parquet')]
+      self.s3.objects[('reports', self.prefix + '_compaction-0.json')] = json.dumps(
+         {'target': target, 'sources': [self.prefix + '0.parquet']}).encode()
+      dmarc_parquet.compact(self.s3, 'reports', self.prefix)
+      merged, = self.stored()
+      self.assertEqual(pyarrow.parquet.read_table(io.BytesIO(self.s3.objects[('reports', merged)])).num_rows, 6)
+
+   def test_interrupted_compaction_is_rolled_back(self):
+      self.s3.objects[('reports', self.prefix + '_compaction-0.json')] = json.dumps(
+         {'target': self.prefix + 'compacted-0.parquet', 'sources': [self.prefix + '0.parquet']}).encode()
+      dmarc_parquet.compact(self.s3, 'reports', self.prefix, target_size=1)
+      self.assertEqual(self.stored(), [self.prefix + f'{n}.parquet' for n in range(3)])
+
+
+if __name__ == '__main__':
+   unittest.main()
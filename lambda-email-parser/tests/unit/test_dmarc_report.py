@@ -0,0 +1,90 @@
+import json
+import unittest
+
+import archive_stage
+import dmarc_report
+
+from tests.unit.messages import dmarc_report as report_xml
+
+
+def rows_of(xml, chunk_size=None):
+   sink = archive_stage.BytesSink()
+   rows = dmarc_report.ReportRows(dmarc_report.JsonLines(sink))
+   for offset in range(0, len(xml), chunk_size or len(xml)):
+      rows.write(xml[offset:offset + (chunk_size or len(xml))])
+   count = rows.close()
+   lines = [json.loads(line) for line in bytes(sink.data).splitlines()]
+   assert count == len(lines)
+   return lines
+
+
+class TestIsXml(unittest.TestCase):
+   def test_reports(self):
+      self.assertTrue(dmarc_report.is_xml(report_xml()))
+      self.assertTrue(dmarc_report.is_xml(b'\xef\xbb\xbf\r\n<feedback>'))
+      self.assertTrue(dmarc_report.is_xml('<?xml version="1.0" encoding="UTF-16"?>'.encode('utf-16')))
+      self.assertTrue(dmarc_report.is_xml(b'<dmarc:feedback xmlns:dmarc="urn:ietf:params:xml:ns:dmarc-2.0">'))
+
+   def test_other_content(self):
+      self.assertFalse(dmarc_report.is_xml(b'<html><body>'))
+      self.assertFalse(dmarc_report.is_xml(b'%PDF-1.4'))
+      self.assertFalse(dmarc_report.is_xml(b''))
+
+
+class TestReportRows(unittest.TestCase):
+   def test_rows(self):
+      rows = rows_of(report_xml(3))
+      self.assertEqual(len(rows), 3)
+      self.assertEqual(rows[1], {
+         'org_name': 'google.com', 'email': 'noreply-dmarc-support@google.com', 'report_id': '1760659200-3',
+         'date_begin': 1760659200, 'date_end': 1760745599,
+         'policy_domain': 'example.com', 'policy_adkim': 'r', 'policy_aspf': 'r', 'policy_p': 'none', 'policy_sp': 'none',
+         'policy_pct': 100, 'policy_fo': None,
+         'source_ip': '192.0.2.1', 'count': 2, 'disposition': 'none', 'dkim': 'pass', 'spf': 'pass', 'reasons': [],
+         'header_from': 'example.com', 'envelope_from': None, 'envelope_to': None,
+         'dkim_results': [{'domain': 'example.com', 'selector': 's1', 'result': 'pass'}],
+         'spf_results': [{'domain': 'bounce.example.com', 'scope': None, 'result': 'pass'}],
+      })
+
+   def test_chunks_split_anywhere(self):
+      xml = report_xml(5)
+      self.assertEqual(rows_of(xml, 7), rows_of(xml))
+
+   def test_repeated_results_and_namespaces(self):
+      xml = b'''<?xml version="1.0"?>
+<feedback xmlns="urn:ietf:params:xml:ns:dmarc-2.0">
+  <report_metadata><org_name>Microsoft</org_name></report_metadata>
+  <record>
+    <row><source_ip>2001:db8::1</source_ip><count>1</count>
+      <policy_evaluated><disposition>quarantine</disposition><dkim>fail</dkim><spf>fail</spf>
+        <reason><type>forwarded</type></reason><reason><type>mailing_list</type><comment>list</comment></reason>
+      </policy_evaluated>
+    </row>
+    <identifiers><header_from>example.com</header_from></identifiers>
+    <auth_results>
+      <dkim><domain>a.example</domain><result>fail</result></dkim>
+      <dkim><domain>b.example</domain><result>pass</result></dkim>
+    </auth_results>
+  </record>
+</feedback>'''
+      row, = rows_of(xml)
+      self.assertEqual(row['org_name'], 'Microsoft')
+      self.assertEqual(row['reasons'], [{'type': 'forwarded', 'comment': None}, {'type': 'mailing_list', 'comment': 'list'}])
+      self.assertEqual([r['domain'] for r in row['dkim_results']], ['a.example', 'b.example'])
+      self.assertEqual(row['spf_results'], [])
+
+   def test_records_are_dropped_once_written(self):
+      rows = dmarc_report.ReportRows(dmarc_report.JsonLines(archive_stage.BytesSink()))
+      rows.write(report_xml(200))
+      self.assertEqual(rows.records, 200)
+      self.assertEqual(len(rows._root), 0)
+
+   def test_not_xml(self):
+      with self.assertRaises(dmarc_report.ReportError):
+         rows_of(b'\x1f\x8b\x08 not a report')
+      with self.assertRaises(dmarc_report.ReportError):
+         rows_of(report_xml(1)[:-20])
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,76 @@
+import json
+import unittest
+from unittest import mock
+
+import fan_out
+
+
+class CollectingSink:
+   def __init__(self):
+      self.data = bytearray()
+      self.closed = self.aborted = False
+
+   def write(self, data):
+      self.data += data
+
+   def close(self):
+      self.closed = True
+      return len(self.data)
+
+   def abort(self):
+      self.aborted = True
+
+
+class TestRangeSink(unittest.TestCase):
+   def test_small_part_is_written_on_close(self):
+      inner = CollectingSink()
+      large = []
+      sink = fan_out.RangeSink(inner, 10, lambda: large.append(True))
+      sink.write(b'12345')
+      sink.write(b'67890')
+      self.assertEqual(inner.data, b'')
+      self.assertEqual(sink.close(), 10)
+      self.assertEqual((bytes(inner.data), inner.closed, large), (b'1234567890', True, []))
+
+   def test_large_part_is_dropped(self):
+      inner = CollectingSink()
+      large = []
+      sink = fan_out.RangeSink(inner, 10, lambda: large.append(True))
+      for _ in range(5):
+         sink.write(b'123456')
+      sink.close()
+      self.assertEqual((bytes(inner.data), inner.aborted, inner.closed, large), (b'', True, False, [True]))
+
+
+class TestDispatchers(unittest.TestCase):
+   def test_sqs_batches(self):
+      sqs = mock.Mock()
+      sqs.send_message_batch.return_value = {}
+      fan_out.SqsDispatcher(sqs, 'https://queue').send([{fan_out.TASK: {'index': n}} for n in range(23)])
+      self.assertEqual([len(call.kwargs['Entries']) for call in sqs.send_message_batch.call_args_list], [10, 10, 3])
+
+   def test_sqs_failures_raise(self):
+      sqs = mock.Mock()
+      sqs.send_message_batch.return_value = {'Failed': [{'Id': '0', 'Message': 'throttled'}]}
+      with self.assertRaises(RuntimeError):
+         fan_out.SqsDispatcher(sqs, 'https://queue').send([{fan_out.TASK: {}}])
+
+   def test_dispatchers_need_a_target(self):
+      with self.assertRaises(ValueError):
+         fan_out.SqsDispatcher(mock.Mock(), '')
+      with self.assertRaises(ValueError):
+         fan_out.InvokeDispatcher(mock.Mock(), None)
+
+
+class TestTaskOf(unittest.TestCase):
+   def test_events(self):
+      task = {'index': 6}
+      self.assertEqual(fan_out.task_of({fan_out.TASK: task}), task)
+      self.assertEqual(fan_out.task_of({'eventSource': 'aws:sqs', 'body': json.dumps({fan_out.TASK: task})}), task)
+      self.assertIsNone(fan_out.task_of({'eventSource': 'aws:sqs', 'body': '{"Records": []}'}))
+      self.assertIsNone(fan_out.task_of({'eventSource': 'aws:sqs', 'body': 'not json'}))
+      self.assertIsNone(fan_out.task_of({'Records': []}))
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,615 @@
+import base64
+import contextlib
+import email
+import hashlib
+import io
+import json
+import os
+import quopri
+import tarfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambda_function
+import mime_stream
+import parser_config
+import s3_writer
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from tests.unit.messages import bounce_message, complex_message, forwarded_message
+from tests.unit.test_archive_stage import zip_archive
+from tests.unit.s3_stub import StubS3Client
+
+
+def s3_event(bucket, key):
+   return {'Records': [{'s3': {'bucket': {'name': bucket}, 'object': {'key': key}}}]}
+
+
+def sqs_record(message_id, bucket, key):
+   return {'eventSource': 'aws:sqs', 'messageId': message_id, 'body': json.dumps(s3_event(bucket, key))}
+
+
+class TestHeaderFilter(unittest.TestCase):
+   headers = [('From', 'a@example.com'), ('X-SES-Spam-Verdict', 'PASS'), ('ARC-Seal', 'i=1'),
+              ('Received', 'by mx'), ('subject', 'hi'), ('X-SESSION', 'no')]
+
+   def test_names_are_case_insensitive(self):
+      self.assertEqual(parser_config.HeaderFilter('FROM,Subject').select(self.headers),
+                       [('From', 'a@example.com'), ('subject', 'hi')])
+
+   def test_wildcards(self):
+      self.assertEqual(parser_config.HeaderFilter('x-ses-*, ARC-*').select(self.headers),
+                       [('X-SES-Spam-Verdict', 'PASS'), ('ARC-Seal', 'i=1')])
+
+   def test_all(self):
+      self.assertEqual(parser_config.HeaderFilter('ALL').select(self.headers), self.headers)
+
+   def test_filter_is_parsed_once(self):
+      with mock.patch.dict(os.environ, {'select_headers': 'From'}):
+         parser_config.reset()
+         self.assertIs(parser_config.get_config().header_filter, parser_config.get_config().header_filter)
+      parser_config.reset()
+
+   def test_empty_selection_saves_no_headers(self):
+      self.assertIsNone(parser_config.ParserConfig.from_environ({'select_headers': ''}).header_filter)
+
+
+class TestLambdaHandler(unittest.TestCase):
+   def setUp(self):
+      self.s3 = StubS3Client()
+      self.raw = complex_message().as_bytes()
+      self.s3.objects[('inbound', 'mail/1')] = self.raw
+      patcher = mock.patch.object(lambda_function, 's3_client', lambda: self.s3)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+   def handle(self, event, **env):
+      with mock.patch.dict(os.environ, {'destination_bucket': 'parts', **env}):
+         parser_config.reset()
+         try:
+            return lambda_function.lambda_handler(event, None)
+         finally:
+            parser_config.reset()
+
+   def run_handler(self, **env):
+      return self.handle(s3_event('inbound', 'mail/1'), **env)
+
+   def saved(self):
+      return {key: body for (bucket, key), body in self.s3.objects.items() if bucket == 'parts'}
+
+   def test_in_memory_parts(self):
+      response = self.run_handler()
+      self.assertEqual(response['statusCode'], 200)
+      self.assertIn('mail/1/headers.json', self.saved())
+      self.assertIn('mail/1/mimepart7_report.bin', self.saved())
+      self.assertEqual(self.saved()['mail/1/mimepart7_report.bin'], bytes(range(256)) * 300)
+
+   def test_streaming_matches_in_memory(self):
+      in_memory = self.run_handler()
+      expected = self.saved()
+      self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+      streamed = self.run_handler(streaming_mode='true', stream_chunk_size='4096')
+      self.assertEqual(streamed, in_memory)
+      self.assertEqual(sorted(self.saved()), sorted(expected))
+      for key, body in expected.items():
+         self.assertEqual(self.saved()[key], body, key)
+
+   def test_scan_mode_matches_in_memory(self):
+      in_memory = self.run_handler(write_manifest = 'true')
+      expected = self.saved()
+      self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+      self.assertEqual(self.run_handler(scan_mode = 'true', write_manifest = 'true'), in_memory)
+      self.assertEqual(self.saved(), expected)
+
+   def test_bounce_parts_match_in_every_mode(self):
+      # the header blocks of the delivery-status are parts, so the original message is part 6 in every mode
+      self.s3.objects[('inbound', 'mail/1')] = bounce_message().as_bytes()
+      in_memory = self.run_handler(write_manifest = 'true')
+      expected = self.saved()
+      self.assertIn('mail/1/mimepart6_untitled', expected)
+      for env in ({'streaming_mode': 'true'}, {'scan_mode': 'true'}):
+         with self.subTest(**env):
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+            self.assertEqual(self.run_handler(write_manifest = 'true', **env), in_memory)
+            self.assertEqual(self.saved(), expected)
+
+   def test_part_filter(self):
+      for env in ({}, {'streaming_mode': 'true'}, {'scan_mode': 'true'}):
+         with self.subTest(**env):
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+            response = self.run_handler(store_content_types = 'application/*, image/*', store_dispositions = 'attachment',
+                                        write_manifest = 'true', **env)
+            # the attachment of the forwarded message is stored too, the forwarded message itself isn't
+            stored = ['mail/1/mimepart7_report.bin', 'mail/1/mimepart11_inner.pdf']
+            self.assertEqual(sorted(self.saved()), sorted(['mail/1/headers.json', 'mail/1/manifest.json'] + stored))
+            self.assertTrue(response['body'].endswith(': 2'))
+            manifest = json.loads(self.saved()['mail/1/manifest.json'])
+            self.assertEqual([part['key'] for part in manifest['parts'] if part['key']], stored)
+
+   def test_part_filter_with_part_rules(self):
+      rules = json.dumps([{'action': 'exclude', 'filename': '*.pdf'}, {'action': 'include', 'contentType': 'text/*'}])
+      for env in ({}, {'streaming_mode': 'true'}, {'scan_mode': 'true'}):
+         with self.subTest(**env):
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+            self.run_handler(store_content_types = 'application/*, image/*', store_dispositions = 'attachment',
+                             part_rules = rules, **env)
+            # the rules only decide among the parts the lists select
+            self.assertEqual(sorted(self.saved()), ['mail/1/headers.json', 'mail/1/mimepart7_report.bin'])
+
+   def test_part_rules(self):
+      rules = json.dumps([
+         {'action': 'exclude', 'contentType': 'image/*', 'maxSize': 8192},
+         {'action': 'exclude', 'filename': '*.PDF'},
+         {'action': 'include', 'contentType': 'text/*', 'disposition': 'none'},
+         {'action': 'exclude', 'minSize': 50000},
+      ])
+      self.s3.objects[('config', 'rules.json')] = rules.encode()
+      expected = ['mail/1/headers.json', 'mail/1/mimepart10_body.txt', 'mail/1/mimepart3_body.txt', 'mail/1/mimepart5_body.html',
+                  'mail/1/mimepart8_untitled']
+      with mock.patch.object(parser_config, 's3_client', mock.Mock(return_value = self.s3)):
+         for env in ({}, {'streaming_mode': 'true'}, {'scan_mode': 'true'}, {'streaming_mode': 'true', 'part_rules': 's3://config/rules.json'}):
+            with self.subTest(**env):
+               self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+               self.s3.calls.clear()
+               self.run_handler(**{'part_rules': rules, **env})
+               self.assertEqual(sorted(self.saved()), expected)
+               # excluded parts are never uploaded
+               self.assertEqual(sorted(key for call, key in self.s3.calls if call == 'put_object'), expected)
+
+   def test_part_rule_sizes_are_decoded_sizes_in_every_mode(self):
+      msg = MIMEMultipart('related')
+      msg.attach(MIMEText('body\n', 'plain'))
+      for size in (4080, 4096, 4097):
+         image = MIMEImage(bytes(range(256)) * (size // 256) + b'x' * (size % 256), 'png')
+         image.add_header('Content-Disposition', 'inline', filename=f'{size}.png')
+         msg.attach(image)
+      # quoted-printable: 3000 bytes that take 9000 characters to encode
+      text = MIMEText('\xe9' * 3000, 'plain', 'iso-8859-1')
+      text.replace_header('Content-Transfer-Encoding', 'quoted-printable')
+      text.set_payload(quopri.encodestring(b'\xe9' * 3000).decode('ascii'))
+      text.add_header('Content-Disposition', 'attachment', filename='accents.txt')
+      msg.attach(text)
+      self.s3.objects[('inbound', 'mail/1')] = msg.as_bytes()
+      rules = json.dumps([{'action': 'exclude', 'contentType': 'image/*', 'maxSize': 4096},
+                          {'action': 'exclude', 'contentType': 'text/*', 'disposition': 'attachment', 'maxSize': 3000}])
+      for env in ({}, {'streaming_mode': 'true'}, {'scan_mode': 'true'}):
+         with self.subTest(**env):
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+            self.run_handler(part_rules = rules, **env)
+            self.assertEqual(sorted(self.saved()), ['mail/1/headers.json', 'mail/1/mimepart2_body.txt', 'mail/1/mimepart5_4097.png'])
+
+   def test_fan_out(self):
+      streamed = self.run_handler(streaming_mode = 'true', write_manifest = 'true')
+      expected = self.saved()
+      self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+      invocations = mock.Mock()
+      with mock.patch.object(parser_config, 'lambda_client', mock.Mock(return_value = invocations)):
+         response = self.run_handler(fan_out_mode = 'invoke', fan_out_function = 'parser', fan_out_min_size = '1000',
+                                     write_manifest = 'true')
+      self.assertEqual(response, streamed)
+      tasks = [json.loads(call.kwargs['Payload']) for call in invocations.invoke.call_args_list]
+      # the png and report.bin parts of the message
+      self.assertEqual([task['fanOutPart']['index'] for task in tasks], [6, 7])
+      self.assertNotIn('mail/1/mimepart7_report.bin', self.saved())
+      manifest = json.loads(self.saved()['mail/1/manifest.json'])
+      self.assertEqual([part['key'] for part in manifest['parts'] if part.get('fanOut')],
+                       ['mail/1/mimepart6_untitled', 'mail/1/mimepart7_report.bin'])
+      for task in tasks:
+         self.assertEqual(self.handle(task)['statusCode'], 200)
+      self.assertEqual(sorted(self.saved()), sorted(expected))
+      for key, body in expected.items():
+         if key != 'mail/1/manifest.json':
+            self.assertEqual(self.saved()[key], body, key)
+
+   def test_fan_out_tasks_through_sqs(self):
+      self.run_handler(streaming_mode = 'true')
+      expected = self.saved()
+      self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+      queue = mock.Mock()
+      queue.send_message_batch.return_value = {'Successful': []}
+      with mock.patch.object(parser_config, 'sqs_client', mock.Mock(return_value = queue)):
+         self.run_handler(fan_out_mode = 'sqs', fan_out_queue_url = 'https://queue', fan_out_min_size = '1000')
+      entries = queue.send_message_batch.call_args.kwargs['Entries']
+      records = [{'eventSource': 'aws:sqs', 'messageId': entry['Id'], 'body': entry['MessageBody']} for entry in entries]
+      self.assertEqual(self.handle({'Records': records})['batchItemFailures'], [])
+      self.assertEqual(self.saved(), expected)
+
+   def test_fan_out_applies_size_rules(self):
+      attachment = MIMEApplication(bytes(range(256)) * 1200, Name='large.bin')
+      attachment.add_header('Content-Disposition', 'attachment', filename='large.bin')
+      self.s3.objects[('inbound', 'mail/2')] = attachment.as_bytes()
+      queue = mock.Mock()
+      queue.send_message_batch.return_value = {'Successful': []}
+      for rule, stored in (({'action': 'exclude', 'minSize': 200000}, []), ({'action': 'exclude', 'minSize': 400000}, ['mail/2/mimepart1_large.bin'])):
+         with self.subTest(**rule):
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+            env = {'part_rules': json.dumps([rule]), 'fan_out_mode': 'sqs', 'fan_out_queue_url': 'https://queue', 'fan_out_min_size': '100000'}
+            with mock.patch.object(parser_config, 'sqs_client', mock.Mock(return_value = queue)):
+               self.handle(s3_event('inbound', 'mail/2'), **env)
+            # the 300 KB part is handed to a worker before it is decoded, the worker applies the rule
+            entries = queue.send_message_batch.call_args.kwargs['Entries']
+            self.assertEqual(len(entries), 1)
+            response = self.handle({'Records': [{'eventSource': 'aws:sqs', 'messageId': '0', 'body': entries[0]['MessageBody']}]}, **env)
+            self.assertEqual(response['batchItemFailures'], [])
+            self.assertEqual(sorted(key for key in self.saved() if 'mimepart' in key), stored)
+
+   def test_keys_are_sanitised_and_partitioned(self):
+      attachment = MIMEApplication(b'%PDF', 'pdf')
+      attachment['Content-Disposition'] = 'attachment; filename="=?UTF-8?B?Li4vUmVjaG51bmcgw6QucGRm?="'
+      self.s3.objects[('inbound', 'mail/2')] = attachment.as_bytes()
+      prefix = hashlib.sha256(b'mail/2').hexdigest()[:2] + '/mail/2'
+      for env in ({}, {'streaming_mode': 'true'}, {'scan_mode': 'true'}):
+         with self.subTest(**env):
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] != 'parts'}
+            self.handle(s3_event('inbound', 'mail/2'), key_partition_chars = '2', write_manifest = 'true', **env)
+            self.assertEqual(self.saved()[prefix + '/mimepart1__Rechnung ä.pdf'], b'%PDF')
+            manifest = json.loads(self.saved()[prefix + '/manifest.json'])
+            self.assertEqual(manifest['parts'][0]['filename'], '../Rechnung ä.pdf')
+
+   def test_invalid_part_rules(self):
+      for rules in ('{', '[{"action": "drop"}]', '[{"action": "exclude", "size": 1}]', '[{"action": "exclude", "maxSize": "1k"}]'):
+         with self.subTest(rules=rules), self.assertRaises(ValueError):
+            parser_config.ParserConfig.from_environ({'part_rules': rules})
+
+   def test_forwarded_message_is_stored_byte_identical(self):
+      nested = mime_stream.locate_parts(self.raw)[7]
+      self.assertEqual(nested.get_content_type(), 'message/rfc822')
+      for env in ({}, {'streaming_mode': 'true'}, {'dedup_parts': 'true', 'dedup_min_size': '1000000'}):
+         with self.subTest(**env):
+            self.run_handler(**env)
+            self.assertEqual(self.saved()['mail/1/mimepart8_untitled'], self.raw[nested.body_offset:nested.end])
+
+   def test_forwarded_message_of_a_large_message_is_located_by_scanning(self):
+      msg = email.message_from_bytes(self.raw)
+      large = MIMEApplication(bytes(range(256)) * 48 * 1024, Name='large.bin')
+      msg.attach(large)
+      self.s3.objects[('inbound', 'mail/1')] = raw = msg.as_bytes()
+      nested = mime_stream.scan_parts(raw)[7]
+      # the line by line parser is far too slow to run a second time over large messages
+      with mock.patch.object(mime_stream, 'locate_parts', side_effect=AssertionError("message parsed twice")):
+         self.run_handler()
+      self.assertEqual(self.saved()['mail/1/mimepart8_untitled'], raw[nested.body_offset:nested.end])
+
+   def test_original_message_of_a_bounce_is_stored_raw(self):
+      self.s3.objects[('inbound', 'mail/1')] = raw = bounce_message().as_bytes()
+      original = mime_stream.scan_parts(raw)[5]
+      self.run_handler()
+      saved = self.saved()['mail/1/mimepart6_untitled']
+      self.assertEqual(saved, raw[original.body_offset:original.end])
+      self.assertEqual(email.message_from_bytes(saved)['Subject'], 'Quarterly report')
+
+   def test_forwarded_message_is_not_stored_as_another_located_one(self):
+      self.s3.objects[('inbound', 'mail/1')] = raw = bounce_message().as_bytes()
+      scan_parts = mime_stream.scan_parts
+
+      def misnumbered(raw):
+         # the forwarded message within the original at the walk position of the original
+         located = scan_parts(raw)
+         located[5] = located[13]
+         return located
+
+      with mock.patch.object(mime_stream, 'scan_parts', misnumbered):
+         self.run_handler()
+      saved = email.message_from_bytes(self.saved()['mail/1/mimepart6_untitled'])
+      self.assertEqual(saved['Subject'], 'Quarterly report')
+      self.assertEqual(len(list(saved.walk())), len(list(complex_message().walk())))
+
+   def test_streaming_uses_multipart_upload_for_large_parts(self):
+      self.s3.objects[('inbound', 'mail/1')] = (
+         b'Content-Type: application/octet-stream\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' + b'z' * (11 * 1024 * 1024))
+      self.run_handler(streaming_mode='true')
+      self.assertEqual(len(self.saved()['mail/1/mimepart1_untitled']), 11 * 1024 * 1024)
+      self.assertEqual([call for call, key in self.s3.calls].count('upload_part'), 3)
+
+
+   def test_sqs_batch_reports_partial_failures(self):
+      self.s3.objects[('inbound', 'mail/2')] = self.raw
+      event = {'Records': [sqs_record('m1', 'inbound', 'mail/1'), sqs_record('m2', 'inbound', 'missing'),
+                           sqs_record('m3', 'inbound', 'mail/2')]}
+      response = self.handle(event, batch_workers = '2')
+      self.assertEqual(response['batchItemFailures'], [{'itemIdentifier': 'm2'}])
+      self.assertEqual([result['itemIdentifier'] for result in response['results']], ['m1', 'm2', 'm3'])
+      self.assertIn('mail/1/headers.json', self.saved())
+      self.assertIn('mail/2/headers.json', self.saved())
+
+   def test_unsupported_records_fail_on_their_own(self):
+      event = {'Records': [sqs_record('m1', 'inbound', 'mail/1'), {'eventSource': 'aws:sns', 'EventSubscriptionArn': 'arn'},
+                           {'eventSource': 'aws:sns', 'eventID': 'e3'}]}
+      response = self.handle(event)
+      self.assertEqual(response['batchItemFailures'], [{'itemIdentifier': 'unknown'}, {'itemIdentifier': 'e3'}])
+      self.assertIn('mail/1/headers.json', self.saved())
+
+   def test_s3_batch_processes_every_record(self):
+      self.s3.objects[('inbound', 'mail/2')] = self.raw
+      event = {'Records': s3_event('inbound', 'mail/1')['Records'] + s3_event('inbound', 'mail/2')['Records']}
+      response = self.handle(event)
+      self.assertEqual(response['statusCode'], 200)
+      self.assertEqual(response['batchItemFailures'], [])
+      self.assertIn('mail/2/mimepart7_report.bin', self.saved())
+
+   def test_s3_batch_failure_is_raised_for_retry(self):
+      event = {'Records': s3_event('inbound', 'mail/1')['Records'] + s3_event('inbound', 'missing')['Records']}
+      with self.assertRaises(RuntimeError):
+         self.handle(event)
+
+
+   def test_failed_part_uploads_are_counted(self):
+      self.s3.failing_keys.add('mail/1/mimepart7_report.bin')
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            with self.assertRaisesRegex(RuntimeError, 'Number of uploads failed: 1'):
+               self.run_handler(**env)
+            self.assertIn('mail/1/mimepart10_body.txt', self.saved())
+
+   def test_failed_part_uploads_fail_the_batch_item(self):
+      self.s3.failing_keys.add('mail/1/mimepart7_report.bin')
+      self.s3.objects[('inbound', 'mail/2')] = self.raw
+      event = {'Records': [sqs_record('m1', 'inbound', 'mail/1'), sqs_record('m2', 'inbound', 'mail/2')]}
+      response = self.handle(event)
+      self.assertEqual(response['batchItemFailures'], [{'itemIdentifier': 'm1'}])
+      self.assertEqual(response['results'][0]['failedParts'], 1)
+      self.assertEqual(response['results'][0]['savedParts'], 6)
+
+
+   def test_dedup_stores_attachments_once(self):
+      s3_writer._known_blobs.clear()
+      self.s3.objects[('inbound', 'mail/2')] = self.raw
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            for key in ('mail/1', 'mail/2'):
+               self.handle(s3_event('inbound', key), dedup_parts = 'true', **env)
+            pointers = [json.loads(self.saved()[key + '/mimepart7_report.bin']) for key in ('mail/1', 'mail/2')]
+            self.assertEqual(pointers[0], pointers[1])
+            self.assertEqual(self.saved()[pointers[0]['key']], bytes(range(256)) * 300)
+            blob_puts = [key for call, key in self.s3.calls if call == 'put_object' and key == pointers[0]['key']]
+            self.assertEqual(len(blob_puts), 1)
+
+
+   def test_manifest_lists_every_part(self):
+      manifests = []
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            self.run_handler(write_manifest='true', select_headers='From, Subject', **env)
+            manifest = json.loads(self.saved()['mail/1/manifest.json'])
+            self.assertEqual(manifest['headers'], [['From', 'sender@example.com'], ['Subject', 'Quarterly report']])
+            self.assertEqual(manifest['headers'], json.loads(self.saved()['mail/1/headers.json']))
+            self.assertEqual(len(manifest['parts']), 11)
+            for entry in manifest['parts']:
+               if entry['key']:
+                  body = self.saved()[entry['key']]
+                  self.assertEqual(entry['size'], len(body))
+                  self.assertEqual(entry['sha256'], hashlib.sha256(body).hexdigest())
+            report = manifest['parts'][6]
+            self.assertEqual((report['index'], report['filename'], report['disposition']), (7, 'report.bin', 'attachment'))
+            self.assertEqual(report['key'], 'mail/1/mimepart7_report.bin')
+            self.assertIsNone(manifest['parts'][0]['key'])
+            manifests.append(manifest)
+      self.assertEqual([entry['key'] for entry in manifests[0]['parts']], [entry['key'] for entry in manifests[1]['parts']])
+
+   def test_manifest_is_not_written_when_uploads_fail(self):
+      self.s3.failing_keys.add('mail/1/mimepart7_report.bin')
+      with self.assertRaises(RuntimeError):
+         self.run_handler(write_manifest='true')
+      self.assertNotIn('mail/1/manifest.json', self.saved())
+
+   def test_small_parts_are_bundled(self):
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            self.s3.objects = {key: body for key, body in self.s3.objects.items() if key[0] != 'parts'}
+            self.assertEqual(self.run_handler(small_part_mode = 'bundle', write_manifest = 'true', **env)['statusCode'], 200)
+            manifest = json.loads(self.saved()['mail/1/manifest.json'])
+            bundled = [entry for entry in manifest['parts'] if 'bundle' in entry]
+            self.assertTrue(bundled)
+            with tarfile.open(fileobj = io.BytesIO(self.saved()['mail/1/parts.tar'])) as tar:
+               for entry in bundled:
+                  content = tar.extractfile(entry['member']).read()
+                  self.assertEqual((entry['size'], entry['sha256']), (len(content), hashlib.sha256(content).hexdigest()))
+                  self.assertIsNone(entry['key'])
+            # report.bin is larger than small_part_threshold
+            self.assertEqual(self.saved()['mail/1/mimepart7_report.bin'], bytes(range(256)) * 300)
+            self.assertEqual([key for key in self.saved() if '/mimepart' in key], ['mail/1/mimepart7_report.bin'])
+
+   def test_small_parts_are_inlined_in_the_manifest(self):
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            self.run_handler(small_part_mode = 'manifest', **env)
+            manifest = json.loads(self.saved()['mail/1/manifest.json'])
+            inlined = [entry for entry in manifest['parts'] if 'content' in entry]
+            self.assertTrue(inlined)
+            for entry in inlined:
+               self.assertEqual(len(base64.b64decode(entry['content'])), entry['size'])
+            self.assertEqual(manifest['parts'][6]['key'], 'mail/1/mimepart7_report.bin')
+
+   def test_nested_messages_are_exploded(self):
+      outer = complex_message()
+      outer.get_payload()[2].get_payload()[0].attach(MIMEMessage(forwarded_message()))
+      self.s3.objects[('inbound', 'mail/1')] = outer.as_bytes()
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            self.s3.objects = {key: body for key, body in self.s3.objects.items() if key[0] != 'parts'}
+            self.run_handler(explode_nested = 'true', write_manifest = 'true', **env)
+            saved = self.saved()
+            self.assertIn(['Subject', 'Inner'], json.loads(saved['mail/1/nested1/headers.json']))
+            self.assertEqual(saved['mail/1/nested1/mimepart3_inner.pdf'], b'%PDF-1.4 inner attachment')
+            self.assertEqual(saved['mail/1/nested1/nested1/mimepart3_inner.pdf'], b'%PDF-1.4 inner attachment')
+            self.assertNotIn('mail/1/nested2/headers.json', saved)
+            manifest = json.loads(saved['mail/1/manifest.json'])
+            self.assertEqual(manifest['parts'][7]['nested'], 'mail/1/nested1')
+            self.assertIn('mail/1/nested1/nested1/manifest.json', saved)
+
+            self.s3.objects = {key: body for key, body in self.s3.objects.items() if key[0] != 'parts'}
+            self.run_handler(explode_nested = 'true', nested_max_depth = '1', **env)
+            self.assertIn('mail/1/nested1/headers.json', self.saved())
+            self.assertNotIn('mail/1/nested1/nested1/headers.json', self.saved())
+
+            self.s3.objects = {key: body for key, body in self.s3.objects.items() if key[0] != 'parts'}
+            self.run_handler(explode_nested = 'true', nested_max_bytes = '100', **env)
+            self.assertNotIn('mail/1/nested1/headers.json', self.saved())
+            self.assertIn('mail/1/mimepart7_report.bin', self.saved())
+
+   def test_forwards_over_the_nested_budget(self):
+      msg = complex_message()
+      for n in range(4):
+         inner = forwarded_message()
+         inner.attach(MIMEApplication(bytes([n]) * 30000, Name=f'{n}.bin'))
+         msg.attach(MIMEMessage(inner))
+      self.s3.objects[('inbound', 'mail/1')] = msg.as_bytes()
+      held = []
+
+      class MeasuredTeeSink(mime_stream.TeeSink):
+         copies = []
+
+         def __init__(self, *args):
+            super().__init__(*args)
+            self.copies.append(self)
+
+         def write(self, data):
+            super().write(data)
+            held.append(sum(len(copy.data) for copy in self.copies if copy.data is not None))
+
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env), mock.patch.object(mime_stream, 'TeeSink', MeasuredTeeSink):
+            self.s3.objects = {key: body for key, body in self.s3.objects.items() if key[0] != 'parts'}
+            self.run_handler(explode_nested = 'true', nested_max_depth = '1', nested_max_bytes = '100000', **env)
+            exploded = sorted({key.split('/')[2] for key in self.saved() if key.startswith('mail/1/nested')})
+            # the forwarded message of complex_message and two of the four, about 41 KB each, fit
+            self.assertEqual(exploded, ['nested1', 'nested2', 'nested3'])
+            self.assertLessEqual(max(held or [0]), 100000)
+            MeasuredTeeSink.copies.clear()
+      self.assertTrue(held)
+
+   def test_archives_are_expanded(self):
+      msg = complex_message()
+      attachment = MIMEApplication(zip_archive({'report.xml': b'<feedback/>', 'data/rows.csv': b'a,b\n' * 1000}), 'zip', Name='r.zip')
+      attachment.add_header('Content-Disposition', 'attachment', filename='r.zip')
+      msg.attach(attachment)
+      self.s3.objects[('inbound', 'mail/1')] = msg.as_bytes()
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            self.run_handler(expand_archives = 'true', write_manifest = 'true', **env)
+            self.assertEqual(self.saved()['mail/1/mimepart12_r.zip/report.xml'], b'<feedback/>')
+            self.assertEqual(self.saved()['mail/1/mimepart12_r.zip/data/rows.csv'], b'a,b\n' * 1000)
+            entry = json.loads(self.saved()['mail/1/manifest.json'])['parts'][11]
+            self.assertEqual(entry['members'], [{'name': 'report.xml', 'key': 'mail/1/mimepart12_r.zip/report.xml', 'size': 11},
+                                                {'name': 'data/rows.csv', 'key': 'mail/1/mimepart12_r.zip/data/rows.csv', 'size': 4000}])
+
+   def test_archives_over_the_limits_are_stored_unexpanded(self):
+      msg = complex_message()
+      attachment = MIMEApplication(zip_archive({f'{i}.txt': b'x' for i in range(5)}), 'zip', Name='r.zip')
+      msg.attach(attachment)
+      self.s3.objects[('inbound', 'mail/1')] = msg.as_bytes()
+      response = self.run_handler(expand_archives = 'true', archive_max_members = '2')
+      self.assertEqual(response['statusCode'], 200)
+      self.assertIn('mail/1/mimepart12_r.zip', self.saved())
+      self.assertNotIn('mail/1/mimepart12_r.zip/2.txt', self.saved())
+
+   def test_workmail_message_headers_are_rewritten_in_place(self):
+      workmail = mock.Mock()
+      workmail.get_raw_message_content.return_value = {'messageContent': io.BytesIO(self.raw)}
+      with mock.patch.object(lambda_function, 'workmail_client', lambda: workmail):
+         response = self.handle({'messageId': 'm1', 'subject': 'Quarterly report'}, modify_workmail_message = 'true')
+      self.assertEqual(response['statusCode'], 200)
+      reference = workmail.put_raw_message_content.call_args.kwargs['content']['s3Reference']
+      modified = self.saved()[reference['key']]
+      header_end = mime_stream.header_block_end(self.raw)
+      # the body is the original bytes, only the headers change
+      self.assertTrue(modified.endswith(self.raw[header_end:]))
+      headers = email.message_from_bytes(modified)
+      self.assertEqual(headers['Subject'], '[PROCESSED] Quarterly report')
+      self.assertEqual(headers['X-AWS-Mailsploder-Bucket-Prefix'], 's3://parts/m1')
+      self.assertEqual(headers['X-AWS-Mailsploder-Parts-Saved'], str(response['body'].rsplit(' ', 1)[1]))
+      self.assertEqual(headers.get_all('From'), ['sender@example.com'])
+
+   def test_completed_messages_are_a_single_head_request(self):
+      event = s3_event('inbound', 'mail/1')
+      event['Records'][0]['s3']['object']['eTag'] = 'etag1'
+      first = self.handle(event, completion_markers = 'true')
+      self.s3.calls.clear()
+      self.assertEqual(self.handle(event, completion_markers = 'true'), first)
+      self.assertEqual(self.s3.calls, [('head_object', 'mail/1/_completed.json')])
+      # a new version of the source object is processed again
+      event['Records'][0]['s3']['object']['eTag'] = 'etag2'
+      self.handle(event, completion_markers = 'true')
+      self.assertIn(('get_object', 'mail/1'), self.s3.calls)
+
+   def test_retries_resume_after_failed_uploads(self):
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            self.s3.objects = {key: body for key, body in self.s3.objects.items() if key[0] != 'parts'}
+            self.s3.failing_keys.add('mail/1/mimepart7_report.bin')
+            with self.assertRaises(RuntimeError):
+               self.run_handler(completion_markers = 'true', write_manifest = 'true', **env)
+            progress = json.loads(self.saved()['mail/1/_progress.json'])
+            self.assertIn('mail/1/mimepart3_body.txt', progress['keys'])
+            self.assertNotIn('mail/1/mimepart7_report.bin', progress['keys'])
+
+            self.s3.failing_keys.clear()
+            self.s3.calls.clear()
+            response = self.run_handler(completion_markers = 'true', write_manifest = 'true', **env)
+            self.assertEqual(response['statusCode'], 200)
+            uploaded = [key for call, key in self.s3.calls if call == 'put_object']
+            self.assertIn('mail/1/mimepart7_report.bin', uploaded)
+            self.assertNotIn('mail/1/mimepart3_body.txt', uploaded)
+            self.assertIn('mail/1/_completed.json', self.saved())
+            self.assertNotIn('mail/1/_progress.json', self.saved())
+            manifest = json.loads(self.saved()['mail/1/manifest.json'])
+            self.assertEqual(manifest['parts'][2]['sha256'], hashlib.sha256(self.saved()['mail/1/mimepart3_body.txt']).hexdigest())
+
+   def test_metrics_are_emitted_per_message(self):
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+               self.run_handler(metrics_sink = 'emf', **env)
+            document = json.loads(output.getvalue())
+            self.assertEqual(document['Mode'], 'streaming' if env else 'in_memory')
+            self.assertEqual(document['BytesIn'], len(self.raw))
+            parts = {part['key']: part for part in document['PartDetails']}
+            report = parts['mail/1/mimepart7_report.bin']
+            self.assertEqual(report['bytesOut'], 256 * 300)
+            self.assertGreater(report['bytesIn'], report['bytesOut'])
+            self.assertIn('decodeMs', report)
+            self.assertIn('uploadMs', report)
+            self.assertEqual(report['contentType'], 'application/octet-stream')
+
+   def test_no_metrics_by_default(self):
+      output = io.StringIO()
+      with contextlib.redirect_stdout(output):
+         self.run_handler()
+      self.assertEqual(output.getvalue(), '')
+
+   def test_invalid_small_part_mode(self):
+      with self.assertRaises(ValueError):
+         parser_config.ParserConfig.from_environ({'small_part_mode': 'inline'})
+
+   def test_charset_modes(self):
+      # windows-1252 bytes declared as utf-8
+      self.s3.objects[('inbound', 'mail/1')] = (b'Content-Type: text/plain; charset="utf-8"\r\n'
+                                                b'Content-Transfer-Encoding: 8bit\r\n\r\ncaf\xe9')
+      for env in ({}, {'streaming_mode': 'true'}):
+         with self.subTest(**env):
+            with self.assertRaises(UnicodeDecodeError):
+               self.run_handler(**env)
+            self.run_handler(charset_mode = 'raw', write_manifest = 'true', **env)
+            self.assertEqual(self.saved()['mail/1/mimepart1_body.txt'], b'caf\xe9')
+            self.assertEqual(self.s3.metadata[('parts', 'mail/1/mimepart1_body.txt')], {'charset': 'utf-8'})
+            self.assertEqual(json.loads(self.saved()['mail/1/manifest.json'])['parts'][0]['storedCharset'], 'utf-8')
+            self.run_handler(charset_mode = 'normalize', **env)
+            self.assertEqual(self.saved()['mail/1/mimepart1_body.txt'], 'caf\ufffd'.encode('utf-8'))
+            self.assertEqual(self.s3.metadata[('parts', 'mail/1/mimepart1_body.txt')], {})
+
+   def test_normalize_keeps_parts_with_unknown_charsets(self):
+      self.s3.objects[('inbound', 'mail/1')] = (b'Content-Type: text/plain; charset="x-unknown"\r\n\r\nbytes')
+      self.run_handler(charset_mode = 'normalize')
+      self.assertEqual(self.saved()['mail/1/mimepart1_body.txt'], b'bytes')
+      self.assertEqual(self.s3.metadata[('parts', 'mail/1/mimepart1_body.txt')], {'charset': 'x-unknown'})
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,198 @@
+import gzip
+import json
+import os
+import unittest
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from unittest import mock
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import dmarc_parquet
+import lambda_function_dmarc
+import lambda_function_dmarc_compaction
+import parser_config
+
+from tests.unit.messages import dmarc_message, dmarc_report, mislabelled_dmarc_message, unnamed_dmarc_message
+from tests.unit.s3_stub import StubS3Client
+from tests.unit.test_lambda_function import s3_event, sqs_record
+
+
+class TestDmarcHandler(unittest.TestCase):
+   def setUp(self):
+      self.s3 = StubS3Client()
+      self.s3.objects[('inbound', 'mail/1')] = dmarc_message().as_bytes()
+      patcher = mock.patch.object(lambda_function_dmarc, 's3_client', lambda: self.s3)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+   def handle(self, event, **env):
+      env = {'destination_bucket': 'parts', 'dmarc_report_bucket': 'reports', 'dmarc_report_bucket_folder': 'dmarc', **env}
+      with mock.patch.dict(os.environ, env):
+         parser_config.reset()
+         try:
+            return lambda_function_dmarc.lambda_handler(event, None)
+         finally:
+            parser_config.reset()
+
+   def run_handler(self, **env):
+      return self.handle(s3_event('inbound', 'mail/1'), **env)
+
+   def saved(self, bucket):
+      return {key: body for (name, key), body in self.s3.objects.items() if name == bucket}
+
+   def test_reports(self):
+      response = self.run_handler()
+      self.assertTrue(response['body'].endswith(': 3'))
+      parts = self.saved('parts')
+      self.assertEqual(parts['mail/1/mimepart3_google.com!example.com.xml'], dmarc_report())
+      self.assertEqual(parts['mail/1/mimepart4_yahoo.com!example.com'], dmarc_report(2, 'yahoo.com'))
+      reports = self.saved('reports')
+      self.assertEqual(sorted(reports), ['dmarc/mail/1/mimepart3_google.com!example.com.json', 'dmarc/mail/1/mimepart4_yahoo.com!example.com.json'])
+      report = json.loads(reports['dmarc/mail/1/mimepart3_google.com!example.com.json'])
+      self.assertEqual(report['feedback']['report_metadata']['org_name'], 'google.com')
+      self.assertEqual(len(report['feedback']['record']), 2)
+
+   def test_json_lines(self):
+      response = self.run_handler(dmarc_output = 'jsonl')
+      self.assertTrue(response['body'].endswith(': 3'))
+      parts = self.saved('parts')
+      self.assertEqual(parts['mail/1/mimepart3_google.com!example.com.xml'], dmarc_report())
+      self.assertEqual(parts['mail/1/mimepart4_yahoo.com!example.com'], dmarc_report(2, 'yahoo.com'))
+      reports = self.saved('reports')
+      self.assertEqual(sorted(reports), ['dmarc/mail/1/mimepart3_google.com!example.com.jsonl',
+                                         'dmarc/mail/1/mimepart4_yahoo.com!example.com.jsonl'])
+      rows = [json.loads(line) for line in reports['dmarc/mail/1/mimepart4_yahoo.com!example.com.jsonl'].splitlines()]
+      self.assertEqual([(row['org_name'], row['source_ip'], row['spf']) for row in rows],
+                       [('yahoo.com', '192.0.2.0', 'fail'), ('yahoo.com', '192.0.2.1', 'pass')])
+
+   @unittest.skipIf(dmarc_parquet.pyarrow is None, "pyarrow is not installed")
+   def test_parquet(self):
+      for n in (1, 2):
+         self.s3.objects[('inbound', f'mail/{n}')] = dmarc_message().as_bytes()
+         with mock.patch.dict(os.environ, {'destination_bucket': 'parts', 'dmarc_report_bucket': 'reports',
+                                           'dmarc_report_bucket_folder': 'dmarc', 'dmarc_output': 'parquet'}):
+            parser_config.reset()
+            response = lambda_function_dmarc.lambda_handler(s3_event('inbound', f'mail/{n}'), None)
+            parser_config.reset()
+         self.assertTrue(response['body'].endswith(': 3'))
+      # the same reports delivered twice replace their files
+      self.assertEqual(sorted(self.saved('reports')), [
+         'dmarc/report_date=2025-10-17/org_name=google.com/1760659200-2.parquet',
+         'dmarc/report_date=2025-10-17/org_name=yahoo.com/1760659200-2.parquet',
+      ])
+      self.s3.objects[('reports', 'dmarc/report_date=2025-10-17/org_name=google.com/other.parquet')] = (
+         self.s3.objects[('reports', 'dmarc/report_date=2025-10-17/org_name=google.com/1760659200-2.parquet')])
+      with mock.patch.object(lambda_function_dmarc_compaction, 's3_client', lambda: self.s3), \
+           mock.patch.dict(os.environ, {'dmarc_report_bucket': 'reports', 'dmarc_report_bucket_folder': 'dmarc'}):
+         parser_config.reset()
+         response = lambda_function_dmarc_compaction.lambda_handler({'date': '2025-10-17'}, None)
+         parser_config.reset()
+      self.assertEqual(response['body'], 'Compacted 2 files of 2025-10-17 into 1')
+      self.assertEqual(len(self.saved('reports')), 2)
+
+   def test_mislabelled_reports(self):
+      self.s3.objects[('inbound', 'mail/1')] = mislabelled_dmarc_message().as_bytes()
+      response = self.run_handler()
+      self.assertTrue(response['body'].endswith(': 3'))
+      parts = self.saved('parts')
+      self.assertEqual(parts['mail/1/mimepart2_microsoft.com!example.com.zip/microsoft.com!example.com.xml'],
+                       dmarc_report(2, 'microsoft.com'))
+      self.assertEqual(parts['mail/1/mimepart3_google.com!example.com.xml'], dmarc_report())
+      reports = self.saved('reports')
+      self.assertEqual(sorted(reports), ['dmarc/mail/1/mimepart2_microsoft.com!example.com.zip/microsoft.com!example.com.json',
+                                         'dmarc/mail/1/mimepart3_google.com!example.com.json'])
+
+   def test_mislabelled_reports_as_rows(self):
+      self.s3.objects[('inbound', 'mail/1')] = mislabelled_dmarc_message().as_bytes()
+      self.run_handler(dmarc_output = 'jsonl')
+      reports = self.saved('reports')
+      self.assertEqual(sorted(reports), ['dmarc/mail/1/mimepart2_microsoft.com!example.com.zip/microsoft.com!example.com.jsonl',
+                                         'dmarc/mail/1/mimepart3_google.com!example.com.jsonl'])
+      rows = [json.loads(line) for line in reports['dmarc/mail/1/mimepart2_microsoft.com!example.com.zip/microsoft.com!example.com.jsonl'].splitlines()]
+      self.assertEqual([row['org_name'] for row in rows], ['microsoft.com', 'microsoft.com'])
+
+   def test_gzip_reports_without_gz_name(self):
+      self.s3.objects[('inbound', 'mail/1')] = unnamed_dmarc_message().as_bytes()
+      for output, extension in (('json', '.json'), ('jsonl', '.jsonl')):
+         with self.subTest(output = output):
+            response = self.run_handler(dmarc_output = output)
+            self.assertTrue(response['body'].endswith(': 2'))
+            parts = self.saved('parts')
+            # the compressed parts are kept, the reports are stored next to them
+            self.assertEqual(gzip.decompress(parts['mail/1/mimepart2_untitled']), dmarc_report())
+            self.assertEqual(parts['mail/1/mimepart2_untitled.xml'], dmarc_report())
+            self.assertEqual(gzip.decompress(parts['mail/1/mimepart3_yahoo.com!example.com.xml']), dmarc_report(2, 'yahoo.com'))
+            self.assertEqual(parts['mail/1/mimepart3_yahoo.com!example.com.xml.xml'], dmarc_report(2, 'yahoo.com'))
+            self.assertEqual(sorted(self.saved('reports')), ['dmarc/mail/1/mimepart2_untitled' + extension,
+                                                             'dmarc/mail/1/mimepart3_yahoo.com!example.com.xml' + extension])
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] == 'inbound'}
+
+   def test_xml_reports_without_xml_name(self):
+      msg = MIMEMultipart('mixed')
+      msg.attach(MIMEApplication(dmarc_report(), 'octet-stream'))
+      self.s3.objects[('inbound', 'mail/1')] = msg.as_bytes()
+      for output, extension in (('json', '.json'), ('jsonl', '.jsonl')):
+         with self.subTest(output = output):
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] == 'inbound'}
+            self.run_handler(dmarc_output = output)
+            # the part isn't overwritten by the copy of the report, nor the copy by the JSON
+            parts = self.saved('parts')
+            self.assertEqual(parts['mail/1/mimepart2_untitled'], dmarc_report())
+            self.assertEqual(parts['mail/1/mimepart2_untitled.xml'], dmarc_report())
+            self.assertEqual(sorted(self.saved('reports')), ['dmarc/mail/1/mimepart2_untitled' + extension])
+
+   def test_report_limits(self):
+      # whitespace between the records compresses far past the archive_max_ratio of attachments
+      report = dmarc_report().replace(b'<record>', b'<record>' + b' ' * 100000)
+      self.s3.objects[('inbound', 'mail/1')] = dmarc_message(report = report).as_bytes()
+      for env, converted in (({}, True), ({'dmarc_report_max_ratio': '10'}, False)):
+         with self.subTest(**env):
+            self.s3.objects = {key: value for key, value in self.s3.objects.items() if key[0] == 'inbound'}
+            response = self.run_handler(dmarc_output = 'jsonl', **env)
+            self.assertTrue(response['body'].endswith(': 3'))
+            self.assertIn('mail/1/mimepart3_google.com!example.com.xml.gz', self.saved('parts'))
+            self.assertEqual('dmarc/mail/1/mimepart3_google.com!example.com.jsonl' in self.saved('reports'), converted)
+            # the report after the one over the limits is still converted
+            self.assertIn('dmarc/mail/1/mimepart4_yahoo.com!example.com.jsonl', self.saved('reports'))
+
+   def test_invalid_output(self):
+      with self.assertRaises(ValueError):
+         parser_config.ParserConfig.from_environ({'dmarc_output': 'csv'})
+
+   def test_parts_are_not_read_back(self):
+      self.run_handler()
+      self.assertEqual([key for call, key in self.s3.calls if call == 'get_object'], ['mail/1'])
+
+   def test_failed_writes_are_not_counted(self):
+      self.s3.failing_keys.add('dmarc/mail/1/mimepart3_google.com!example.com.json')
+      # the invocation fails so Lambda retries it
+      with self.assertRaisesRegex(RuntimeError, ': 2. Number of uploads failed: 1'):
+         self.run_handler()
+
+   def test_every_record_is_processed(self):
+      self.s3.objects[('inbound', 'mail/2')] = mislabelled_dmarc_message().as_bytes()
+      records = s3_event('inbound', 'mail/1')['Records'] + s3_event('inbound', 'mail/2')['Records']
+      response = self.handle({'Records': records})
+      self.assertEqual(response['batchItemFailures'], [])
+      self.assertEqual([result['savedParts'] for result in response['results']], [3, 3])
+      self.assertIn('dmarc/mail/2/mimepart3_google.com!example.com.json', self.saved('reports'))
+
+   def test_sqs_batch_reports_partial_failures(self):
+      self.s3.objects[('inbound', 'mail/2')] = dmarc_message().as_bytes()
+      event = {'Records': [sqs_record('m1', 'inbound', 'mail/1'), sqs_record('m2', 'inbound', 'missing'),
+                           sqs_record('m3', 'inbound', 'mail/2')]}
+      response = self.handle(event)
+      self.assertEqual(response['batchItemFailures'], [{'itemIdentifier': 'm2'}])
+      self.assertEqual(response['body'], 'Number of parts saved to S3 bucket: parts: 6')
+      self.assertIn('dmarc/mail/2/mimepart3_google.com!example.com.json', self.saved('reports'))
+
+   def test_failed_s3_records_fail_the_invocation(self):
+      records = s3_event('inbound', 'mail/1')['Records'] + s3_event('inbound', 'missing')['Records']
+      with self.assertRaisesRegex(RuntimeError, '1 of 2 records failed: s3://inbound/missing'):
+         self.handle({'Records': records})
+      self.assertIn('dmarc/mail/1/mimepart3_google.com!example.com.json', self.saved('reports'))
+
+
+if __name__ == '__main__':
+   unittest.main()
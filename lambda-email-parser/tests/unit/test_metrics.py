@@ -0,0 +1,87 @@
+import io
+import json
+import time
+import unittest
+
+import metrics
+import mime_stream
+
+
+class SlowSink:
+   def __init__(self):
+      self.data = bytearray()
+
+   def write(self, data):
+      time.sleep(0.02)
+      self.data += data
+
+   def close(self):
+      return len(self.data)
+
+
+class TestMessageMetrics(unittest.TestCase):
+   def test_no_sink_is_a_no_op(self):
+      self.assertIs(metrics.for_message('m', None, 'streaming'), metrics.NULL_METRICS)
+      body = io.BytesIO(b'x')
+      self.assertIs(metrics.NULL_METRICS.reader(body), body)
+      with metrics.NULL_METRICS.timer('fetch'), metrics.NULL_METRICS.parse_timer():
+         pass
+
+   def test_unknown_sink(self):
+      with self.assertRaises(ValueError):
+         metrics.create_sink('statsd', 'EmailParser')
+
+   def test_reader_counts_bytes_in(self):
+      collected = metrics.MessageMetrics('m', None, 'streaming')
+      reader = collected.reader(io.BytesIO(b'x' * 10))
+      while reader.read(4):
+         pass
+      self.assertEqual(collected.bytes_in, 10)
+
+   def test_decode_time_excludes_upload_time(self):
+      collected = metrics.MessageMetrics('m', None, 'streaming')
+      uploaded = SlowSink()
+      sink = collected.decoding_sink(collected.upload_sink(uploaded, 'm/part'), mime_stream.transfer_decoder('base64'))
+      sink.write(b'aGVsbG8=\r\n')
+      sink.close()
+      self.assertEqual(bytes(uploaded.data), b'hello')
+      part = collected.record()['parts'][0]
+      self.assertEqual((part['key'], part['bytesIn'], part['bytesOut']), ('m/part', 10, 5))
+      self.assertGreaterEqual(part['uploadMs'], 20)
+      self.assertLess(part['decodeMs'], part['uploadMs'])
+
+   def test_parse_time_excludes_the_other_stages(self):
+      collected = metrics.MessageMetrics('m', None, 'in_memory')
+      with collected.parse_timer():
+         with collected.timer('fetch'):
+            time.sleep(0.02)
+      self.assertGreaterEqual(collected.seconds['fetch'], 0.02)
+      self.assertLess(collected.seconds['parse'], 0.02)
+
+   def test_upload_observer_records_background_writes(self):
+      collected = metrics.MessageMetrics('m', None, 'in_memory')
+      collected.upload_observer('m/part', 0.5)
+      self.assertEqual(collected.record()['parts'], [{'key': 'm/part', 'uploadMs': 500.0}])
+
+
+class TestEmfSink(unittest.TestCase):
+   def test_document(self):
+      written = []
+      collected = metrics.MessageMetrics('mail/1', metrics.EmfSink('Mail', written.append), 'streaming')
+      collected.add('upload', 0.25, 'mail/1/part')
+      collected.count('mail/1/part', 100, 75)
+      collected.emit()
+      document = json.loads(written[0])
+      directive = document['_aws']['CloudWatchMetrics'][0]
+      self.assertEqual(directive['Namespace'], 'Mail')
+      self.assertEqual(directive['Dimensions'], [['Mode']])
+      for metric in directive['Metrics']:
+         self.assertIn(metric['Name'], document)
+      self.assertEqual(document['Mode'], 'streaming')
+      self.assertEqual(document['UploadTime'], 250.0)
+      self.assertEqual((document['BytesOut'], document['Parts']), (75, 1))
+      self.assertEqual(document['PartDetails'], [{'key': 'mail/1/part', 'uploadMs': 250.0, 'bytesIn': 100, 'bytesOut': 75}])
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,207 @@
+import email
+import unittest
+
+import mime_stream
+from tests.unit.messages import bounce_message, complex_message
+
+
+class CollectingSink:
+   def __init__(self):
+      self.data = b''
+      self.closed = False
+
+   def write(self, data):
+      self.data += data
+
+   def close(self):
+      self.closed = True
+      return len(self.data)
+
+
+def stream(raw, chunk_size=7):
+   sinks = {}
+
+   def on_part(part):
+      sinks[part.index] = CollectingSink()
+      return sinks[part.index]
+
+   chunks = (raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size))
+   parts = mime_stream.MimeStreamParser(on_part, max_line=1024).parse(chunks)
+   return parts, sinks
+
+
+class TestMimeStreamParser(unittest.TestCase):
+   def test_parts_match_walk(self):
+      """Decoded part content and metadata match msg.walk() for the same message"""
+      raw = complex_message().as_bytes()
+      expected = list(email.message_from_bytes(raw).walk())
+      parts, sinks = stream(raw)
+      self.assertEqual(len(parts), len(expected))
+      for part, walked in zip(parts, expected):
+         self.assertEqual(part.get_content_type(), walked.get_content_type())
+         self.assertEqual(part.get_filename(), walked.get_filename())
+         self.assertEqual(part.get_content_charset(), walked.get_content_charset())
+         if not walked.is_multipart():
+            self.assertEqual(sinks[part.index].data, walked.get_payload(decode=True))
+            self.assertTrue(sinks[part.index].closed)
+
+   def test_delivery_status_blocks_match_walk(self):
+      """Every header block of a message/delivery-status part is a part, as in msg.walk()"""
+      raw = bounce_message().as_bytes()
+      for raw in (raw, raw.replace(b'\n', b'\r\n'), raw.replace(b'Status: 5.1.1\n', b'Status: 5.1.1\n\n')):
+         expected = list(email.message_from_bytes(raw).walk())
+         parts, sinks = stream(raw)
+         self.assertEqual([part.get_content_type() for part in parts], [walked.get_content_type() for walked in expected])
+         self.assertEqual([part.items() for part in parts], [walked.items() for walked in expected])
+         for part, walked in zip(parts, expected):
+            if not walked.is_multipart():
+               self.assertEqual(sinks[part.index].data, walked.get_payload(decode=True))
+         status = parts[2]
+         self.assertEqual([child.index for child in status.children], list(range(4, 4 + len(expected[2].get_payload()))))
+         self.assertEqual(sinks[status.index].data, raw[status.body_offset:status.end])
+
+   def test_headers_match(self):
+      raw = complex_message().as_bytes()
+      parts, _ = stream(raw)
+      self.assertEqual(parts[0].items(), email.message_from_bytes(raw).items())
+
+   def test_forwarded_message_is_captured_raw(self):
+      raw = complex_message().as_bytes()
+      parts, sinks = stream(raw)
+      nested = [part for part in parts if part.get_content_type() == 'message/rfc822'][0]
+      self.assertEqual(sinks[nested.index].data, raw[nested.body_offset:nested.end])
+      self.assertTrue(sinks[nested.index].data.startswith(b'Content-Type: multipart/mixed'))
+      self.assertEqual(email.message_from_bytes(sinks[nested.index].data)['Subject'], 'Inner')
+
+   def test_offsets_locate_raw_body(self):
+      raw = complex_message().as_bytes()
+      expected = list(email.message_from_bytes(raw).walk())
+      parts, _ = stream(raw)
+      for part, walked in zip(parts, expected):
+         if not walked.is_multipart():
+            self.assertEqual(raw[part.body_offset:part.end], walked.get_payload(decode=False).encode('ascii'))
+
+   def test_long_lines_are_split_without_losing_bytes(self):
+      body = b'x' * 5000 + b'\r\n' + b'y' * 3000
+      raw = b'Content-Type: application/octet-stream\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' + body
+      parts, sinks = stream(raw, chunk_size=4096)
+      self.assertEqual(len(parts), 1)
+      self.assertEqual(sinks[1].data, body)
+
+   def test_crlf_multipart_strips_line_break_before_boundary(self):
+      raw = (b'Content-Type: multipart/mixed; boundary="b"\r\n\r\npreamble\r\n--b\r\n'
+             b'Content-Type: text/plain\r\n\r\nline one\r\nline two\r\n--b--\r\nepilogue\r\n')
+      parts, sinks = stream(raw, chunk_size=3)
+      self.assertEqual(sinks[2].data, b'line one\r\nline two')
+      self.assertEqual(sinks[2].data, email.message_from_bytes(raw).get_payload()[0].get_payload(decode=True))
+
+   def test_transcoding_sink(self):
+      sink = CollectingSink()
+      transcoder = mime_stream.TranscodingSink(sink, 'utf-16')
+      encoded = 'h\xe9llo'.encode('utf-16')
+      for i in range(len(encoded)):
+         transcoder.write(encoded[i:i + 1])
+      transcoder.close()
+      self.assertEqual(sink.data, 'h\xe9llo'.encode('utf-8'))
+
+
+class TestScanParts(unittest.TestCase):
+   messages = [
+      complex_message().as_bytes(),
+      b'Subject: plain\n\nhello\n',
+      # preamble, epilogue, a part without headers and a delimiter lookalike
+      b'Content-Type: multipart/mixed; boundary=b\n\npre\n--b\nContent-Type: text/plain\n\none\n--bb\n--b \n\ntwo\n--b--\nepi\n',
+      # no close delimiter
+      b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n--b\r\n\r\ntruncated',
+      # missing blank line after the headers
+      b'Content-Type: text/plain\r\nnot a header\r\nbody\r\n',
+      # a delivery-status part of two header blocks
+      bounce_message().as_bytes(),
+      # header blocks without headers, with a body, and ending the message
+      b'Content-Type: message/delivery-status\n\nA: 1\n\n\nB: 2\nnot a header\n\nC: 3\n\n',
+   ]
+
+   def test_matches_locate_parts(self):
+      for raw in self.messages:
+         with self.subTest(raw=raw[:40]):
+            scanned = mime_stream.scan_parts(raw)
+            located = mime_stream.locate_parts(raw)
+            self.assertEqual([(part.get_content_type(), part.depth, part.offset, part.body_offset, part.end) for part in scanned],
+                             [(part.get_content_type(), part.depth, part.offset, part.body_offset, part.end) for part in located])
+            self.assertEqual([part.get_content_type() for part in scanned],
+                             [part.get_content_type() for part in email.message_from_bytes(raw).walk()])
+
+   def test_walk_order(self):
+      raw = complex_message().as_bytes()
+      for parts in (mime_stream.scan_parts(raw), stream(raw)[0]):
+         self.assertEqual([part.index for part in parts[0].walk()], [part.index for part in parts])
+
+   def test_decode_body_matches_walk(self):
+      raw = complex_message().as_bytes()
+      for part, walked in zip(mime_stream.scan_parts(raw), email.message_from_bytes(raw).walk()):
+         if not walked.is_multipart():
+            self.assertEqual(bytes(mime_stream.decode_body(raw, part)), walked.get_payload(decode=True))
+
+
+class TestTransferDecoders(unittest.TestCase):
+   def decode(self, cte, data, step=5):
+      decoder = mime_stream.transfer_decoder(cte)
+      out = b''.join(decoder.decode(data[i:i + step]) for i in range(0, len(data), step))
+      return out + decoder.flush()
+
+   def test_base64(self):
+      self.assertEqual(self.decode('base64', b'aGVsbG8g\r\nd29ybGQ=\r\n'), b'hello world')
+
+   def test_base64_missing_padding(self):
+      self.assertEqual(self.decode('base64', b'aGVsbG8gd29ybGQ'), b'hello world')
+
+   def test_quoted_printable_soft_breaks(self):
+      self.assertEqual(self.decode('quoted-printable', b'caf=C3=A9 =\r\nau lait=3D\r\nok'), 'caf\xe9 au lait=\r\nok'.encode('utf-8'))
+
+   def test_identity(self):
+      self.assertEqual(self.decode('7bit', b'plain text'), b'plain text')
+
+
+class TestHeaderRewrite(unittest.TestCase):
+   raw = b'From: a@example.com\r\nSubject: old\r\n  folded\r\nX-Raw: caf\xe9\r\n\r\nbody\r\n'
+
+   def test_header_block_end(self):
+      self.assertEqual(self.raw[mime_stream.header_block_end(self.raw):], b'\r\nbody\r\n')
+      self.assertEqual(mime_stream.header_block_end(b'From: a\n'), 8)
+
+   def test_replace_and_add(self):
+      block = self.raw[:mime_stream.header_block_end(self.raw)]
+      rewritten = mime_stream.rewrite_headers(block, {'subject': 'new \u2713'}, [('X-Added', 'yes')])
+      self.assertEqual(rewritten, b'From: a@example.com\r\nsubject: =?utf-8?b?bmV3IOKckw==?=\r\nX-Raw: caf\xe9\r\nX-Added: yes\r\n')
+      self.assertEqual(mime_stream.rewrite_headers(b'From: a\n', {'Subject': 'x'}), b'From: a\nSubject: x\n')
+
+
+
+class TestTeeSink(unittest.TestCase):
+   def test_copies_share_the_budget(self):
+      budget = {'bytes': 10}
+      first, second, third = (mime_stream.TeeSink(CollectingSink(), 100, budget) for _ in range(3))
+      first.write(b'123456')
+      second.write(b'1234')
+      second.write(b'5')
+      self.assertEqual((bytes(first.data), second.data, budget['bytes']), (b'123456', None, 4))
+      # the dropped copy gave its bytes back
+      third.write(b'1234')
+      self.assertEqual((bytes(third.data), budget['bytes']), (b'1234', 0))
+      self.assertEqual(second.sink.data, b'12345')
+
+   def test_aborted_copy_gives_its_bytes_back(self):
+      budget = {'bytes': 10}
+      tee = mime_stream.TeeSink(CollectingSink(), 100, budget)
+      tee.write(b'123')
+      tee.abort()
+      self.assertEqual((tee.data, budget['bytes']), (None, 10))
+
+   def test_limit_without_budget(self):
+      tee = mime_stream.TeeSink(CollectingSink(), 4)
+      tee.write(b'12345')
+      self.assertIsNone(tee.data)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,56 @@
+import email
+import hashlib
+import unittest
+
+import object_keys
+
+
+class TestFilenames(unittest.TestCase):
+   def test_rfc2047_encoded_words(self):
+      self.assertEqual(object_keys.decode_filename('=?UTF-8?B?UmVjaG51bmcgw6QucGRm?='), 'Rechnung ä.pdf')
+      self.assertEqual(object_keys.decode_filename('=?iso-8859-1?Q?r=E9sum=E9.doc?='), 'résumé.doc')
+      self.assertEqual(object_keys.decode_filename('=?x-unknown?Q?a?='), '=?x-unknown?Q?a?=')
+      self.assertIsNone(object_keys.decode_filename(None))
+
+   def test_rfc2231_parameters(self):
+      part = email.message_from_string("Content-Type: application/pdf\n"
+                                       "Content-Disposition: attachment; filename*=utf-8''%E2%82%AC%20report.pdf\n\nx")
+      self.assertEqual(object_keys.decode_filename(part.get_filename()), '€ report.pdf')
+
+   def test_sanitise(self):
+      self.assertEqual(object_keys.sanitise('../../etc/passwd'), '_.._etc_passwd')
+      self.assertEqual(object_keys.sanitise(' a\tb\r\n{c}#.txt. '), 'a b _c__.txt')
+      self.assertEqual(object_keys.sanitise('a‮b\x00c\udcff'), 'a_b_c_')
+      # decomposed characters are composed
+      self.assertEqual(object_keys.sanitise('é.txt'), 'é.txt')
+      self.assertEqual(object_keys.sanitise(' .. '), '')
+
+   def test_shorten(self):
+      name = 'ä' * 150 + '.pdf'
+      short = object_keys.shorten(name, 100)
+      self.assertLessEqual(len(short.encode('utf-8')), 100)
+      self.assertTrue(short.endswith('-' + hashlib.sha256(name.encode('utf-8')).hexdigest()[:8] + '.pdf'))
+      self.assertNotEqual(short, object_keys.shorten('ä' * 151 + '.pdf', 100))
+      self.assertEqual(object_keys.shorten('short.pdf', 100), 'short.pdf')
+
+
+class TestKeyBuilder(unittest.TestCase):
+   def test_partition_prefix(self):
+      self.assertEqual(object_keys.KeyBuilder().message_prefix('mail/1'), 'mail/1')
+      prefix = object_keys.KeyBuilder(partition_chars=2).message_prefix('mail/1')
+      self.assertEqual(prefix, hashlib.sha256(b'mail/1').hexdigest()[:2] + '/mail/1')
+
+   def test_keys_fit_the_key_limit(self):
+      builder = object_keys.KeyBuilder(max_filename_bytes=200)
+      self.assertEqual(builder.part_name('mail/1', 3, 'a/b.txt'), 'mimepart3_a_b.txt')
+      self.assertEqual(builder.part_name('mail/1', 3, '..'), 'mimepart3_untitled')
+      self.assertEqual(len(builder.part_name('mail/1', 3, 'x' * 300).encode('utf-8')), len('mimepart3_') + 200)
+      prefix = 'p' * 900
+      key = prefix + '/' + builder.part_name(prefix, 3, 'x' * 300)
+      self.assertEqual(len(key.encode('utf-8')), object_keys.MAX_KEY_BYTES)
+      member = builder.member_key(key[:1000], 'dir/' + 'y' * 100)
+      self.assertEqual(len(member.encode('utf-8')), object_keys.MAX_KEY_BYTES)
+
+
+if __name__ == '__main__':
+   unittest.main()
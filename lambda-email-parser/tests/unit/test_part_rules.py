@@ -0,0 +1,77 @@
+import unittest
+
+import part_rules
+
+
+class TestPartRules(unittest.TestCase):
+   def test_first_matching_rule_decides(self):
+      rules = part_rules.parse('''{"default": "exclude", "rules": [
+         {"action": "exclude", "contentType": "application/pdf", "filename": "draft-*"},
+         {"action": "include", "contentType": ["application/*", "image/*"]}
+      ]}''')
+      self.assertTrue(rules.decide('application/pdf', 'attachment', 'final.pdf'))
+      self.assertFalse(rules.decide('application/pdf', 'attachment', 'Draft-1.pdf'))
+      self.assertTrue(rules.decide('image/gif', None))
+      self.assertFalse(rules.decide('text/plain', None))
+
+   def test_list_defaults_to_include(self):
+      rules = part_rules.parse('[{"action": "exclude", "disposition": "none"}]')
+      self.assertFalse(rules.decide('text/plain', None))
+      self.assertTrue(rules.decide('text/plain', 'inline'))
+
+   def test_filename_never_matches_parts_without_one(self):
+      rules = part_rules.parse('[{"action": "exclude", "filename": "*"}]')
+      self.assertTrue(rules.decide('image/png', 'inline', None))
+
+   def test_sizes(self):
+      rules = part_rules.parse('''[
+         {"action": "exclude", "contentType": "image/*", "disposition": "inline", "maxSize": 4096},
+         {"action": "exclude", "minSize": 1000000}
+      ]''')
+      self.assertFalse(rules.decide('image/gif', 'inline', size=43))
+      self.assertTrue(rules.decide('image/gif', 'inline', size=4097))
+      self.assertFalse(rules.decide('text/plain', None, size=1000000))
+      self.assertEqual(rules.size_bound, 1000000)
+
+   def test_unknown_size(self):
+      rules = part_rules.parse('[{"action": "exclude", "contentType": "image/*", "maxSize": 4096}]')
+      self.assertIsNone(rules.decide('image/gif', 'inline'))
+      # the other conditions don't match, the size doesn't matter
+      self.assertTrue(rules.decide('text/plain', None))
+
+   def test_lists_narrow_the_rules(self):
+      rules = part_rules.select(part_rules.parse('''[
+         {"action": "exclude", "filename": "*.p7s"},
+         {"action": "include", "contentType": "text/*"}
+      ]'''), ['application/*', 'image/*'], ['attachment'])
+      # the rules decide among the parts the lists select
+      self.assertTrue(rules.decide('application/pdf', 'attachment', 'a.pdf'))
+      self.assertFalse(rules.decide('application/pkcs7-signature', 'attachment', 'smime.p7s'))
+      # the rules can't store a part the lists don't select
+      self.assertFalse(rules.decide('text/plain', 'attachment', 'a.txt'))
+      self.assertFalse(rules.decide('image/png', 'inline', 'logo.png'))
+
+   def test_lists_keep_the_default(self):
+      rules = part_rules.parse('{"default": "exclude", "rules": [{"action": "include", "maxSize": 100}]}')
+      selected = part_rules.select(rules, ['image/*'], None)
+      self.assertTrue(selected.decide('image/png', None, size=10))
+      self.assertFalse(selected.decide('image/png', None, size=1000))
+      self.assertIsNone(selected.decide('image/png', None))
+      self.assertFalse(selected.decide('text/plain', None, size=10))
+
+   def test_lists_without_rules(self):
+      rules = part_rules.select(None, None, ['attachment', 'none'])
+      self.assertTrue(rules.decide('text/plain', None))
+      self.assertFalse(rules.decide('text/plain', 'inline'))
+      self.assertIsNone(part_rules.select(None, None, None))
+      self.assertFalse(part_rules.select(None, [], None).decide('text/plain', None))
+
+   def test_invalid(self):
+      for document in ('{"rules": {}}', '{"default": "keep"}', '[{"action": "include", "contentType": 1}]',
+                       '[{"action": "include", "minSize": -1}]', '["include"]'):
+         with self.subTest(document=document), self.assertRaises(part_rules.RuleError):
+            part_rules.parse(document)
+
+
+if __name__ == '__main__':
+   unittest.main()
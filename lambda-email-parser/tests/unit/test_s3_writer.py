@@ -0,0 +1,175 @@
+import io
+import json
+import tarfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import s3_writer
+from tests.unit.s3_stub import StubS3Client
+
+MiB = 1024 * 1024
+
+
+class TestS3StreamingUpload(unittest.TestCase):
+   def test_small_object_is_a_single_put(self):
+      s3 = StubS3Client()
+      upload = s3_writer.S3StreamingUpload(s3, 'b', 'k')
+      upload.write(b'abc')
+      upload.write(b'def')
+      self.assertEqual(upload.close(), 6)
+      self.assertEqual(s3.objects[('b', 'k')], b'abcdef')
+      self.assertEqual([call for call, _ in s3.calls], ['put_object'])
+
+   def test_empty_object_is_not_written(self):
+      s3 = StubS3Client()
+      self.assertEqual(s3_writer.S3StreamingUpload(s3, 'b', 'k').close(), 0)
+      self.assertEqual(s3.objects, {})
+
+   def test_failed_multipart_upload_is_aborted(self):
+      s3 = StubS3Client()
+      s3.complete_multipart_upload = None
+      upload = s3_writer.S3StreamingUpload(s3, 'b', 'k')
+      upload.write(b'x' * (6 * MiB))
+      with self.assertRaises(TypeError):
+         upload.close()
+      self.assertEqual(s3.calls[-1], ('abort_multipart_upload', 'k'))
+
+   def test_pool_reports_failed_keys(self):
+      s3 = StubS3Client()
+      s3.failing_keys.add('bad')
+      with ThreadPoolExecutor(max_workers = 2) as executor:
+         pool = s3_writer.UploadPool(executor, 1)
+         for key in ('good', 'bad'):
+            upload = s3_writer.S3StreamingUpload(s3, 'b', key, pool = pool)
+            upload.write(b'data')
+            upload.close()
+         self.assertEqual(pool.wait(), ['bad'])
+      self.assertIn(('b', 'good'), s3.objects)
+
+   def test_objects_up_to_the_threshold_are_a_single_put(self):
+      s3 = StubS3Client()
+      upload = s3_writer.S3StreamingUpload(s3, 'b', 'k', threshold = 8 * MiB)
+      upload.write(b'x' * (6 * MiB))
+      upload.close()
+      self.assertEqual([call for call, _ in s3.calls], ['put_object'])
+
+   def test_parallel_parts_are_completed_in_order(self):
+      s3 = StubS3Client()
+      data = bytes(range(256)) * (4 * 17 * MiB // 256)
+      with ThreadPoolExecutor(max_workers = 4) as executor:
+         pool = s3_writer.UploadPool(executor, 2)
+         upload = s3_writer.S3StreamingUpload(s3, 'b', 'k', pool = pool, threshold = 8 * MiB, concurrency = 3)
+         upload.write(data)
+         upload.close()
+         self.assertEqual(pool.wait(), [])
+      self.assertEqual(s3.objects[('b', 'k')], data)
+      self.assertEqual(len([call for call, _ in s3.calls if call == 'upload_part']), 14)
+
+
+class TestBufferReader(unittest.TestCase):
+   def test_reads_a_slice_without_copying_the_buffer(self):
+      raw = bytearray(b'0123456789')
+      reader = s3_writer.BufferReader(memoryview(raw)[2:8])
+      self.assertEqual(len(reader), 6)
+      self.assertEqual(reader.read(4), b'2345')
+      self.assertEqual(reader.read(), b'67')
+      reader.seek(0)
+      raw[2:4] = b'ab'
+      self.assertEqual(reader.read(), b'ab4567')
+
+
+class TestSizeRouting(unittest.TestCase):
+   def test_small_and_large_parts(self):
+      s3 = StubS3Client()
+      small = []
+      for data in (b'abc', b'abcdef'):
+         sink = s3_writer.SizeRoutedSink(4, lambda: s3_writer.S3StreamingUpload(s3, 'b', 'large'), small.append)
+         sink.write(data[:3])
+         sink.write(data[3:])
+         self.assertEqual(sink.close(), len(data))
+      self.assertEqual(small, [b'abc'])
+      self.assertEqual(s3.objects, {('b', 'large'): b'abcdef'})
+
+   def test_tar_bundle(self):
+      s3 = StubS3Client()
+      bundle = s3_writer.TarBundle(s3, 'b', 'm/parts.tar')
+      bundle.add('mimepart2_body.txt', b'hello')
+      bundle.add('mimepart3_a.bin', b'\x00\x01')
+      bundle.close()
+      with tarfile.open(fileobj = io.BytesIO(s3.objects[('b', 'm/parts.tar')])) as tar:
+         self.assertEqual(tar.getnames(), ['mimepart2_body.txt', 'mimepart3_a.bin'])
+         self.assertEqual(tar.extractfile('mimepart3_a.bin').read(), b'\x00\x01')
+
+   def test_empty_bundle_is_not_written(self):
+      s3 = StubS3Client()
+      s3_writer.TarBundle(s3, 'b', 'm/parts.tar').close()
+      self.assertEqual(s3.objects, {})
+
+
+class TestContentAddressedUpload(unittest.TestCase):
+   def setUp(self):
+      s3_writer._known_blobs.clear()
+      self.s3 = StubS3Client()
+
+   def store(self, key, data, part_size=s3_writer.MIN_PART_SIZE, min_size=0):
+      upload = s3_writer.ContentAddressedUpload(self.s3, 'b', key, part_size, min_size = min_size)
+      for i in range(0, len(data), MiB):
+         upload.write(data[i:i + MiB])
+      upload.close()
+      return upload
+
+   def test_duplicate_payload_is_stored_once(self):
+      first = self.store('m1/mimepart2_logo.png', b'logo')
+      second = self.store('m2/mimepart2_logo.png', b'logo')
+      self.assertEqual(first.blob_key, second.blob_key)
+      self.assertEqual(self.s3.objects[('b', first.blob_key)], b'logo')
+      self.assertEqual(json.loads(self.s3.objects[('b', 'm2/mimepart2_logo.png')])['key'], first.blob_key)
+      self.assertEqual([key for call, key in self.s3.calls if call == 'put_object'].count(first.blob_key), 1)
+      # the second message is answered from the existence cache
+      self.assertEqual([call for call, _ in self.s3.calls].count('head_object'), 1)
+
+   def test_existing_blob_skips_upload(self):
+      upload = self.store('m1/a', b'payload')
+      s3_writer._known_blobs.clear()
+      self.s3.calls = []
+      self.store('m2/a', b'payload')
+      self.assertEqual([call for call, _ in self.s3.calls], ['head_object', 'put_object'])
+
+   def test_existence_cache_expires(self):
+      first = self.store('m1/a', b'payload')
+      del self.s3.objects[('b', first.blob_key)]
+      with mock.patch.object(s3_writer.time, 'monotonic', return_value = time.monotonic() + s3_writer.BLOB_CACHE_TTL):
+         self.store('m2/a', b'payload')
+      # the removed blob is written again instead of being pointed to
+      self.assertEqual(self.s3.objects[('b', first.blob_key)], b'payload')
+
+   def test_existence_cache_is_bounded(self):
+      with mock.patch.object(s3_writer, 'BLOB_CACHE_SIZE', 2):
+         for key in ('a', 'b', 'c'):
+            s3_writer.remember_blob('b', key)
+         self.assertFalse(s3_writer.blob_exists(self.s3, 'b', 'a'))
+         self.assertEqual(list(s3_writer._known_blobs), [('b', 'b'), ('b', 'c')])
+
+   def test_large_payload_is_staged_and_copied(self):
+      data = b'y' * (7 * MiB)
+      upload = self.store('m1/big.bin', data)
+      self.assertEqual(self.s3.objects[('b', upload.blob_key)], data)
+      self.assertEqual([key for (_, key) in self.s3.objects if 'staging' in key], [])
+
+   def test_large_duplicate_aborts_staging_upload(self):
+      data = b'y' * (7 * MiB)
+      self.store('m1/big.bin', data)
+      self.s3.calls = []
+      self.store('m2/big.bin', data)
+      self.assertIn('abort_multipart_upload', [call for call, _ in self.s3.calls])
+      self.assertNotIn('copy', [call for call, _ in self.s3.calls])
+
+   def test_small_parts_are_stored_in_place(self):
+      self.store('m1/body.txt', b'short', min_size = 1024)
+      self.assertEqual(self.s3.objects, {('b', 'm1/body.txt'): b'short'})
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,67 @@
+import gzip
+import io
+import unittest
+
+import xmltodict
+
+from tests.unit.messages import dmarc_report
+
+DOCUMENTS = [
+   dmarc_report(3),
+   b'<a x="1"><b>1</b><b>2</b> text <c/><d y="2">v</d></a>',
+   '<a>é<b>  </b><b/></a>',
+   b'<?xml version="1.0"?><!-- comment --><a><b><c>1</c></b><b><c>2</c><c>3</c></b></a>',
+]
+
+OPTIONS = [
+   {},
+   {'force_list': ('b', 'record')},
+   {'force_list': True},
+   {'force_cdata': True},
+   {'xml_attribs': False},
+   {'strip_whitespace': False},
+   {'attr_prefix': '', 'cdata_key': 'text'},
+]
+
+
+class TestParseFast(unittest.TestCase):
+   def test_same_document_as_parse(self):
+      for document in DOCUMENTS:
+         for options in OPTIONS:
+            with self.subTest(document = document[:20], options = options):
+               self.assertEqual(xmltodict.parse_fast(document, **options), xmltodict.parse(document, **options))
+
+   def test_input_types(self):
+      report = dmarc_report(2)
+      expected = xmltodict.parse(report)
+      self.assertEqual(xmltodict.parse_fast(report.decode('utf-8')), expected)
+      self.assertEqual(xmltodict.parse_fast(gzip.GzipFile(fileobj = io.BytesIO(gzip.compress(report)))), expected)
+      self.assertEqual(xmltodict.parse_fast(chunk for chunk in (report[:100], report[100:])), expected)
+
+   def test_plain_dicts_and_interned_keys(self):
+      first = xmltodict.parse_fast(dmarc_report(1))
+      second = xmltodict.parse_fast(dmarc_report(1, 'yahoo.com'))
+      self.assertIs(type(first['feedback']), dict)
+      self.assertIs(next(iter(first['feedback'])), next(iter(second['feedback'])))
+
+   def test_namespaces_and_callbacks_fall_back_to_parse(self):
+      document = b'<a xmlns="urn:x"><b>1</b><b>2</b></a>'
+      self.assertEqual(xmltodict.parse_fast(document, process_namespaces=True), {'urn:x:a': {'urn:x:b': ['1', '2']}})
+      self.assertEqual(xmltodict.parse_fast(document), {'a': {'@xmlns': 'urn:x', 'b': ['1', '2']}})
+      force = lambda path, key, value: key == 'a'
+      self.assertEqual(xmltodict.parse_fast(document, force_list=force), xmltodict.parse(document, force_list=force))
+      items = []
+      xmltodict.parse_fast(document, item_depth=2, item_callback=lambda path, item: items.append(item) or True)
+      self.assertEqual(items, ['1', '2'])
+
+   def test_entities_are_not_expanded(self):
+      document = b'<!DOCTYPE a [<!ENTITY e "expanded">]><a>&e;</a>'
+      self.assertEqual(xmltodict.parse_fast(document), xmltodict.parse(document))
+
+   def test_malformed_documents(self):
+      with self.assertRaises(xmltodict.expat.ExpatError):
+         xmltodict.parse_fast(b'<a><b></a>')
+
+
+if __name__ == '__main__':
+   unittest.main()
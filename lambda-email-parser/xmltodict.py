@@ -21,6 +21,7 @@ if tuple(map(int, platform.python_version_tuple()[:2])) < (3, 7):
     from collections import OrderedDict as _dict
 
 from inspect import isgenerator
+from sys import intern as _intern
 
 try:  # pragma no cover
     _basestring = basestring
@@ -379,6 +380,128 @@ def parse(xml_input, encoding=None, expat=expat, process_namespaces=False,
     return handler.item
 
 
+
+# names shared by the parsers of parse_fast, so the keys of all documents are
+# the same string objects; cleared when untrusted input makes it grow too large
+_interned_names = {}
+_MAX_INTERNED_NAMES = 4096
+
+
+class _ForceAll(object):
+    def __contains__(self, key):
+        return True
+
+
+def parse_fast(xml_input, encoding=None, expat=expat, process_namespaces=False,
+               disable_entities=True, xml_attribs=True, attr_prefix='@',
+               cdata_key='#text', force_cdata=False, cdata_separator='',
+               strip_whitespace=True, force_list=None, **kwargs):
+    """Parse the given XML input like `parse`, with less work per element.
+
+    Returns the same dictionary as `parse` with the same options, built from
+    plain dicts. Element and attribute names are interned across calls, the
+    `force_list` names are a precomputed set and the SAX callbacks are
+    closures without per-element path or namespace bookkeeping.
+
+    Options that need that bookkeeping, namespace processing, `namespaces`,
+    `postprocessor`, `item_depth`, `process_comments`, `dict_constructor` or a
+    callable `force_list`, fall back to `parse`.
+
+        >>> xmltodict.parse_fast('<a><b>1</b><b>2</b></a>', force_list=('a',))
+        {'a': [{'b': ['1', '2']}]}
+    """
+    options = dict(xml_attribs=xml_attribs, attr_prefix=attr_prefix,
+                   cdata_key=cdata_key, force_cdata=force_cdata,
+                   cdata_separator=cdata_separator,
+                   strip_whitespace=strip_whitespace, force_list=force_list)
+    if (process_namespaces or kwargs
+            or (callable(force_list) and not isinstance(force_list, bool))):
+        options.update(kwargs)
+        return parse(xml_input, encoding, expat, process_namespaces,
+                     disable_entities=disable_entities, **options)
+
+    if force_list is True:
+        forced = _ForceAll()
+    else:
+        forced = frozenset(force_list or ())
+    attr_names = {}
+    stack = []
+    item = None
+    data = []
+
+    def push(parent, key, value):
+        if parent is None:
+            return {key: [value] if key in forced else value}
+        try:
+            existing = parent[key]
+        except KeyError:
+            parent[key] = [value] if key in forced else value
+            return parent
+        if type(existing) is list:
+            existing.append(value)
+        else:
+            parent[key] = [existing, value]
+        return parent
+
+    def start(name, attrs):
+        nonlocal item, data
+        stack.append((item, data))
+        if attrs and xml_attribs:
+            item = {}
+            for i in range(0, len(attrs), 2):
+                key = attr_names.get(attrs[i])
+                if key is None:
+                    key = attr_names[attrs[i]] = _intern(attr_prefix + attrs[i])
+                item[key] = attrs[i + 1]
+        else:
+            item = None
+        data = []
+
+    def end(name):
+        nonlocal item, data
+        text = cdata_separator.join(data) if data else None
+        child = item
+        item, data = stack.pop()
+        if strip_whitespace and text:
+            text = text.strip() or None
+        if text and force_cdata and child is None:
+            child = {}
+        if child is not None:
+            if text:
+                push(child, cdata_key, text)
+            item = push(item, name, child)
+        else:
+            item = push(item, name, text)
+
+    def characters(text):
+        data.append(text)
+
+    if isinstance(xml_input, _unicode):
+        xml_input = xml_input.encode(encoding or 'utf-8')
+        encoding = encoding or 'utf-8'
+    if len(_interned_names) > _MAX_INTERNED_NAMES:
+        _interned_names.clear()
+    parser = expat.ParserCreate(encoding, None, _interned_names)
+    parser.ordered_attributes = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = characters
+    parser.buffer_text = True
+    if disable_entities:
+        # entities aren't expanded, see parse
+        parser.DefaultHandler = lambda x: None
+        parser.ExternalEntityRefHandler = lambda *x: 1
+    if hasattr(xml_input, 'read'):
+        parser.ParseFile(xml_input)
+    elif isgenerator(xml_input):
+        for chunk in xml_input:
+            parser.Parse(chunk, False)
+        parser.Parse(b'', True)
+    else:
+        parser.Parse(xml_input, True)
+    return item
+
+
 def _process_namespace(name, namespaces, ns_sep=':', attr_prefix='@'):
     if not namespaces:
         return name